@@ -4,6 +4,7 @@
     this.BuildUpdater = function(buildId) {
         this.buildId = buildId;
         this.buildUrl = '/api/v1/build/' + this.buildId + '/';
+        this.logUrl = '/api/v2/build/' + this.buildId + '/log/';
         this.buildDiv = 'div#build-' + this.buildId;
         this.buildLoadingImg = this.buildDiv + ' img.build-loading';
         this.intervalId = null;
@@ -25,7 +26,8 @@
         var _this = this;
 
         for (var prop in data) {
-            if (data.hasOwnProperty(prop)) {
+            // Output is appended from the build log instead, see getLog
+            if (data.hasOwnProperty(prop) && prop != 'output') {
                 var val = data[prop];
                 var el = $(this.buildDiv + ' span#build-' + prop);
 
@@ -59,6 +61,24 @@
         $.get(this.buildUrl, function(data) {
             _this.render(data);
         });
+        this.getLog();
+    };
+
+    // Append build output written since the last request to the
+    // span#build-output node, which holds the offset to read from next.
+    BuildUpdater.prototype.getLog = function() {
+        var outputSpan = $(this.buildDiv + ' span#build-output');
+
+        if (outputSpan.length === 0) {
+            return;
+        }
+
+        $.get(this.logUrl, {offset: outputSpan.data('offset')}, function(data) {
+            if (data.offset != outputSpan.data('offset')) {
+                outputSpan.append(document.createTextNode(data.output));
+                outputSpan.data('offset', data.offset);
+            }
+        });
     };
 
     // If the build with ID `this.buildId` has a state other than finished, poll
@@ -84,7 +104,7 @@
         this.getBuild();
 
         // Get build data and render every 5 seconds until finished.
-        var intervalId = setInterval(function () {
+        this.intervalId = setInterval(function () {
             _this.getBuild();
         }, 5000);
 
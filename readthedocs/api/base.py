@@ -202,9 +202,11 @@ class BuildResource(ModelResource):
         authorization = DjangoAuthorization()
         filtering = {
             "project": ALL_WITH_RELATIONS,
+            "version": ALL_WITH_RELATIONS,
             "slug": ALL_WITH_RELATIONS,
             "type": ALL_WITH_RELATIONS,
             "state": ALL_WITH_RELATIONS,
+            "success": ALL,
         }
 
     def get_object_list(self, request):
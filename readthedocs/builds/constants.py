@@ -43,3 +43,14 @@ NON_REPOSITORY_VERSIONS = (
     LATEST,
     STABLE,
 )
+
+# Build priority classes, builds with a higher priority are started first.
+# Builds of the latest and stable versions are moved up a step within their
+# class.
+BUILD_PRIORITY_BULK = 0
+BUILD_PRIORITY_INTERACTIVE = 2
+
+BUILD_PHASE_TYPES = (
+    ('phase', _('Phase')),
+    ('command', _('Command')),
+)
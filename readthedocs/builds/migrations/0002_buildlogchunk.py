@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builds', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildLogChunk',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('offset', models.PositiveIntegerField(verbose_name='Offset')),
+                ('output', models.TextField(verbose_name='Output', blank=True)),
+                ('build', models.ForeignKey(related_name='log_chunks', verbose_name='Build', to='builds.Build')),
+            ],
+            options={
+                'ordering': ['offset'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='buildlogchunk',
+            unique_together=set([('build', 'offset')]),
+        ),
+    ]
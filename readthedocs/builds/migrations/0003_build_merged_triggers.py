@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builds', '0002_buildlogchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='merged_triggers',
+            field=models.PositiveIntegerField(default=0, verbose_name='Merged triggers'),
+        ),
+    ]
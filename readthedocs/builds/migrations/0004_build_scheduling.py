@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builds', '0003_build_merged_triggers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='basic',
+            field=models.BooleanField(default=False, verbose_name='Basic'),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='dispatched',
+            field=models.DateTimeField(null=True, verbose_name='Dispatched', blank=True),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='force',
+            field=models.BooleanField(default=False, verbose_name='Force'),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='priority',
+            field=models.IntegerField(default=0, verbose_name='Priority'),
+        ),
+        migrations.AlterIndexTogether(
+            name='build',
+            index_together=set([('version', 'state', 'type'), ('state', 'dispatched')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builds', '0004_build_scheduling'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildPhase',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('type', models.CharField(default=b'phase', max_length=16, verbose_name='Type', choices=[(b'phase', 'Phase'), (b'command', 'Command')])),
+                ('name', models.CharField(max_length=255, verbose_name='Name')),
+                ('phase', models.CharField(max_length=255, verbose_name='Phase', blank=True)),
+                ('start', models.FloatField(verbose_name='Start')),
+                ('wall_time', models.FloatField(verbose_name='Wall clock time')),
+                ('cpu_time', models.FloatField(null=True, verbose_name='CPU time', blank=True)),
+                ('build', models.ForeignKey(related_name='phases', verbose_name='Build', to='builds.Build')),
+            ],
+            options={
+                'ordering': ['start'],
+            },
+        ),
+    ]
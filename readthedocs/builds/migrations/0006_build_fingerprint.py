@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('builds', '0005_buildphase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='fingerprint',
+            field=models.CharField(max_length=40, null=True, verbose_name='Fingerprint', blank=True),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='up_to_date',
+            field=models.BooleanField(default=False, verbose_name='Up to date'),
+        ),
+    ]
@@ -15,7 +15,8 @@ from readthedocs.privacy.loader import VersionManager, RelatedProjectManager
 from readthedocs.projects.models import Project
 from readthedocs.projects import constants
 from .constants import (BUILD_STATE, BUILD_TYPES, VERSION_TYPES,
-                        LATEST, NON_REPOSITORY_VERSIONS, STABLE
+                        LATEST, NON_REPOSITORY_VERSIONS, STABLE,
+                        BUILD_PHASE_TYPES
                         )
 
 from .version_slug import VersionSlugField
@@ -342,6 +343,24 @@ class Build(models.Model):
 
     builder = models.CharField(_('Builder'), max_length=255, null=True, blank=True)
 
+    # Build triggers merged into this build while it was queued
+    merged_triggers = models.PositiveIntegerField(_('Merged triggers'),
+                                                  default=0)
+
+    # Options the build was triggered with, kept for the build scheduler to
+    # pass on when the build is dispatched to a builder
+    priority = models.IntegerField(_('Priority'), default=0)
+    force = models.BooleanField(_('Force'), default=False)
+    basic = models.BooleanField(_('Basic'), default=False)
+    dispatched = models.DateTimeField(_('Dispatched'), null=True, blank=True)
+
+    # Hash of the commit and configuration the build was built from. Builds
+    # with the same fingerprint as the last successful build are skipped, and
+    # recorded as up to date.
+    fingerprint = models.CharField(_('Fingerprint'), max_length=40,
+                                   null=True, blank=True)
+    up_to_date = models.BooleanField(_('Up to date'), default=False)
+
     # Manager
 
     objects = RelatedProjectManager()
@@ -350,7 +369,8 @@ class Build(models.Model):
         ordering = ['-date']
         get_latest_by = 'date'
         index_together = [
-            ['version', 'state', 'type']
+            ['version', 'state', 'type'],
+            ['state', 'dispatched'],
         ]
 
     def __unicode__(self):
@@ -369,3 +389,91 @@ class Build(models.Model):
     def finished(self):
         '''Return if build has a finished state'''
         return self.state == 'finished'
+
+    def get_log(self, offset=0, limit=None):
+        """
+        Build output from character ``offset`` on
+
+        Output is stored as chunks appended by the builder while the build
+        runs. Builds recorded before that only have :py:attr:`output`. Output
+        starts within the chunk holding ``offset``, and chunks that failed to
+        be appended are skipped.
+
+        :param limit: maximum number of chunks to return
+        :returns: the output and the offset to read the next output from, the
+            end of the last chunk returned
+        :rtype: tuple
+        """
+        if offset == 0 and not self.log_chunks.exists():
+            return (self.output, len(self.output))
+        chunks = []
+        first = (self.log_chunks.filter(offset__lte=offset)
+                 .order_by('-offset').first())
+        if first is not None and first.offset + len(first.output) > offset:
+            chunks.append(first)
+        if limit is None or len(chunks) < limit:
+            following = self.log_chunks.filter(offset__gt=offset)
+            if limit is not None:
+                following = following[:limit - len(chunks)]
+            chunks.extend(following)
+        if not chunks:
+            return (u'', offset)
+        output = u''.join(chunk.output for chunk in chunks)
+        if chunks[0].offset < offset:
+            output = output[offset - chunks[0].offset:]
+        return (output, chunks[-1].offset + len(chunks[-1].output))
+
+
+class BuildLogChunk(models.Model):
+
+    """
+    A piece of build output, appended to the build log exactly once
+
+    ``offset`` is the position, in characters, of the chunk in the build log.
+    """
+
+    build = models.ForeignKey(Build, verbose_name=_('Build'),
+                              related_name='log_chunks')
+    offset = models.PositiveIntegerField(_('Offset'))
+    output = models.TextField(_('Output'), blank=True)
+
+    class Meta:
+        ordering = ['offset']
+        unique_together = [('build', 'offset')]
+
+    def __unicode__(self):
+        return ugettext(u"Log for build %(build)s at %(offset)s" % {
+            'build': self.build_id,
+            'offset': self.offset,
+        })
+
+
+class BuildPhase(models.Model):
+
+    """
+    Time spent on a phase of a build, or on a command run during a build
+
+    ``start`` is the number of seconds from the start of the build. Commands,
+    and phases inside other phases, name the phase they were run in as
+    ``phase``. CPU time includes time spent in commands the phase ran, and
+    is unknown for commands run in containers.
+    """
+
+    build = models.ForeignKey(Build, verbose_name=_('Build'),
+                              related_name='phases')
+    type = models.CharField(_('Type'), max_length=16,
+                            choices=BUILD_PHASE_TYPES, default='phase')
+    name = models.CharField(_('Name'), max_length=255)
+    phase = models.CharField(_('Phase'), max_length=255, blank=True)
+    start = models.FloatField(_('Start'))
+    wall_time = models.FloatField(_('Wall clock time'))
+    cpu_time = models.FloatField(_('CPU time'), null=True, blank=True)
+
+    class Meta:
+        ordering = ['start']
+
+    def __unicode__(self):
+        return ugettext(u"%(name)s for build %(build)s" % {
+            'name': self.name,
+            'build': self.build_id,
+        })
@@ -0,0 +1,183 @@
+"""
+Fair share scheduling of queued builds.
+
+With the scheduler enabled, triggered builds are not sent to the build queue
+straight away. They wait as builds in the triggered state, and
+:py:meth:`BuildScheduler.schedule` dispatches them to the build queue as
+builders free up. Builds are dispatched by priority class first. Between
+projects with builds of the same priority, the project with the fewest builds
+dispatched in the last hour, relative to its weight, goes first. No project or
+user gets more builds running at once than their limits allow.
+"""
+
+import datetime
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from readthedocs.builds.constants import (BUILD_STATE_TRIGGERED,
+                                          BUILD_STATE_FINISHED)
+from readthedocs.builds.models import Build
+from readthedocs.projects.models import Project
+
+log = logging.getLogger(__name__)
+
+BUILD_SCHEDULER_ENABLE = getattr(settings, 'BUILD_SCHEDULER_ENABLE', False)
+
+
+class BuildScheduler(object):
+
+    """
+    Dispatch waiting builds while there is build capacity
+
+    :param concurrency: Number of builds to run at once
+    :param project_limit: Number of builds to run at once for a project
+    :param user_limit: Number of builds to run at once for the projects of
+                       a user
+    :param weights: Weight of each project, keyed by project slug. Projects
+                    have a weight of 1 by default.
+    """
+
+    # Builds running longer than this are assumed to be lost
+    max_runtime = datetime.timedelta(
+        seconds=getattr(settings, 'CELERYD_TASK_TIME_LIMIT', 60 * 60))
+    # Recent use of build capacity by projects is counted over this period
+    window = datetime.timedelta(hours=1)
+
+    def __init__(self, concurrency=None, project_limit=None, user_limit=None,
+                 weights=None):
+        if concurrency is None:
+            concurrency = getattr(settings, 'BUILD_SCHEDULER_CONCURRENCY', 4)
+        if project_limit is None:
+            project_limit = getattr(settings,
+                                    'BUILD_SCHEDULER_PROJECT_LIMIT', 2)
+        if user_limit is None:
+            user_limit = getattr(settings, 'BUILD_SCHEDULER_USER_LIMIT', 4)
+        if weights is None:
+            weights = getattr(settings, 'BUILD_SCHEDULER_PROJECT_WEIGHTS', {})
+        self.concurrency = concurrency
+        self.project_limit = project_limit
+        self.user_limit = user_limit
+        self.weights = weights
+
+    def waiting(self):
+        return Build.objects.filter(state=BUILD_STATE_TRIGGERED,
+                                    dispatched__isnull=True)
+
+    def running(self, now):
+        return (Build.objects
+                .filter(dispatched__isnull=False,
+                        dispatched__gte=now - self.max_runtime)
+                .exclude(state=BUILD_STATE_FINISHED))
+
+    def schedule(self):
+        """
+        Dispatch as many waiting builds as capacity allows
+
+        :returns: the dispatched builds
+        """
+        # Avoid circular import
+        from readthedocs.projects.tasks import update_docs
+
+        now = timezone.now()
+        with transaction.atomic():
+            # Locking the waiting builds keeps schedulers running at the same
+            # time from dispatching a build twice
+            waiting = list(self.waiting().select_for_update()
+                           .select_related('project').order_by('date'))
+            if not waiting:
+                return []
+            running = list(self.running(now)
+                           .values_list('project_id', flat=True))
+            slots = self.concurrency - len(running)
+            if slots <= 0:
+                return []
+
+            project_ids = set(running)
+            project_ids.update(build.project_id for build in waiting)
+            project_users = defaultdict(set)
+            for (project_id, user_id) in (Project.users.through.objects
+                                          .filter(project__in=project_ids)
+                                          .values_list('project', 'user')):
+                project_users[project_id].add(user_id)
+
+            project_running = defaultdict(int)
+            user_running = defaultdict(int)
+            for project_id in running:
+                project_running[project_id] += 1
+                for user_id in project_users[project_id]:
+                    user_running[user_id] += 1
+            usage = defaultdict(int)
+            for project_id in (Build.objects
+                               .filter(dispatched__gte=now - self.window)
+                               .values_list('project_id', flat=True)):
+                usage[project_id] += 1
+
+            def can_run(build):
+                return (project_running[build.project_id] < self.project_limit and
+                        all(user_running[user_id] < self.user_limit
+                            for user_id in project_users[build.project_id]))
+
+            def share(build):
+                weight = self.weights.get(build.project.slug, 1)
+                return (float(usage[build.project_id]) / weight, build.date)
+
+            dispatched = []
+            while slots > 0:
+                candidates = [build for build in waiting if can_run(build)]
+                if not candidates:
+                    break
+                priority = max(build.priority for build in candidates)
+                build = min((build for build in candidates
+                             if build.priority == priority), key=share)
+                waiting.remove(build)
+                build.dispatched = now
+                build.save(update_fields=['dispatched'])
+                dispatched.append(build)
+                slots -= 1
+                usage[build.project_id] += 1
+                project_running[build.project_id] += 1
+                for user_id in project_users[build.project_id]:
+                    user_running[user_id] += 1
+
+        for build in dispatched:
+            log.info("Dispatching build %s of %s", build.pk, build.project.slug)
+            update_docs.delay(pk=build.project_id, version_pk=build.version_id,
+                              record=True, force=build.force,
+                              basic=build.basic, build_pk=build.pk)
+        return dispatched
+
+    def stats(self):
+        """
+        Queue depth and wait times
+
+        :returns: the number of builds waiting and running, waiting builds by
+                  priority, and the longest current wait and the average wait
+                  of builds dispatched recently, in seconds
+        :rtype: dict
+        """
+        now = timezone.now()
+        waiting = list(self.waiting().values_list('priority', 'date'))
+        by_priority = defaultdict(int)
+        for (priority, _) in waiting:
+            by_priority[priority] += 1
+        longest_wait = 0
+        if waiting:
+            longest_wait = (now - min(date for (_, date) in waiting)).total_seconds()
+        waits = [(dispatched - date).total_seconds()
+                 for (date, dispatched) in
+                 Build.objects.filter(dispatched__gte=now - self.window)
+                 .values_list('date', 'dispatched')]
+        average_wait = 0
+        if waits:
+            average_wait = sum(waits) / len(waits)
+        return {
+            'waiting': len(waiting),
+            'waiting_by_priority': dict(by_priority),
+            'running': self.running(now).count(),
+            'longest_wait': longest_wait,
+            'average_wait': average_wait,
+        }
@@ -132,12 +132,7 @@ class VersionSlugField(models.CharField):
         # increases the number while searching for the next valid slug
         # depending on the given slug, clean-up
         while not slug or queryset.filter(**kwargs):
-            slug = original_slug
-            end = self.uniquifying_suffix(next)
-            end_len = len(end)
-            if slug_len and len(slug) + end_len > slug_len:
-                slug = slug[:slug_len - end_len]
-            slug = slug + end
+            slug = self.suffixed_slug(original_slug, next, slug_len)
             kwargs[self.attname] = slug
             next += 1
 
@@ -145,6 +140,36 @@ class VersionSlugField(models.CharField):
             'Invalid generated slug: {slug}'.format(slug=slug))
         return slug
 
+    def create_unique_slug(self, content, taken):
+        """
+        Create a slug for ``content`` that isn't in the set ``taken``
+
+        This makes the same slugs as :py:meth:`create_slug`, but checks them
+        against slugs known up front instead of querying for each, to create
+        the slugs of many instances at once. The slug is added to ``taken``.
+        """
+        slug_len = self.max_length
+        slug = self.slugify(content)
+        if slug_len:
+            slug = slug[:slug_len]
+        original_slug = slug
+        next = 0
+        while not slug or slug in taken:
+            slug = self.suffixed_slug(original_slug, next, slug_len)
+            next += 1
+
+        assert self.test_pattern.match(slug), (
+            'Invalid generated slug: {slug}'.format(slug=slug))
+        taken.add(slug)
+        return slug
+
+    def suffixed_slug(self, slug, iteration, slug_len):
+        end = self.uniquifying_suffix(iteration)
+        end_len = len(end)
+        if slug_len and len(slug) + end_len > slug_len:
+            slug = slug[:slug_len - end_len]
+        return slug + end
+
     def pre_save(self, model_instance, add):
         value = getattr(model_instance, self.attname)
         # We only create a new slug if none was set yet.
@@ -63,6 +63,8 @@ class BuildDetail(DetailView):
     def get_context_data(self, **kwargs):
         context = super(BuildDetail, self).get_context_data(**kwargs)
         context['project'] = self.project
+        (context['build_output'],
+         context['build_log_offset']) = self.object.get_log()
         return context
 
 
@@ -0,0 +1,27 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from readthedocs.core.utils.publish import ArtifactPool
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = ('Remove files from the artifact pool that no published release '
+            'links to anymore')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dryrun',
+                    action='store_true',
+                    dest='dryrun',
+                    help='Perform dry run on pool cleanup'),
+    )
+
+    def handle(self, *args, **options):
+        (removed, removed_bytes) = ArtifactPool().collect(
+            dryrun=options['dryrun'])
+        log.info('Removed %s unreferenced files, %s bytes, from the artifact '
+                 'pool' % (removed, removed_bytes))
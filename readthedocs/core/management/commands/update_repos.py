@@ -2,9 +2,10 @@ import logging
 from optparse import make_option
 
 from django.core.management.base import BaseCommand
-from readthedocs.projects import tasks
 from readthedocs.projects.models import Project
+from readthedocs.builds.constants import BUILD_PRIORITY_BULK
 from readthedocs.builds.models import Version
+from readthedocs.builds.scheduler import BUILD_SCHEDULER_ENABLE
 from readthedocs.core.utils import trigger_build
 
 log = logging.getLogger(__name__)
@@ -37,38 +38,43 @@ class Command(BaseCommand):
         record = options['record']
         force = options['force']
         version = options['version']
+        # The scheduler only dispatches recorded builds, so builds triggered
+        # in bulk are always recorded with it, to share out build capacity
+        bulk_record = record or BUILD_SCHEDULER_ENABLE
+
+        def build(project, version=None, record=True):
+            trigger_build(project=project,
+                          version=version,
+                          record=record,
+                          force=force,
+                          priority=BUILD_PRIORITY_BULK)
+
         if len(args):
             for slug in args:
                 if version and version != "all":
                     log.info("Updating version %s for %s" % (version, slug))
                     for version in Version.objects.filter(project__slug=slug, slug=version):
-                        trigger_build(project=version.project, version=version)
+                        build(version.project, version)
                 elif version == "all":
                     log.info("Updating all versions for %s" % slug)
                     for version in Version.objects.filter(project__slug=slug,
                                                           active=True,
                                                           uploaded=False):
-                        tasks.update_docs.run(pk=version.project_id,
-                                              record=False,
-                                              version_pk=version.pk)
+                        build(version.project, version, record=bulk_record)
                 else:
                     p = Project.all_objects.get(slug=slug)
                     log.info("Building %s" % p)
-                    trigger_build(project=p, force=force)
+                    build(p)
         else:
             if version == "all":
                 log.info("Updating all versions")
                 for version in Version.objects.filter(active=True,
                                                       uploaded=False):
-                    tasks.update_docs.run(pk=version.project_id,
-                                          record=record,
-                                          force=force,
-                                          version_pk=version.pk)
+                    build(version.project, version, record=bulk_record)
             else:
                 log.info("Updating all docs")
                 for project in Project.objects.all():
-                    tasks.update_docs.run(pk=project.pk, record=record,
-                                          force=force)
+                    build(project, record=bulk_record)
 
     @property
     def help(self):
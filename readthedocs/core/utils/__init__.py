@@ -1,38 +1,54 @@
+import datetime
 import getpass
 import logging
-import os
 
 from urlparse import urlparse
 
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
 from django.template.loader import get_template
 from django.template import Context
 
 from readthedocs.builds.constants import LATEST
 from readthedocs.builds.constants import LATEST_VERBOSE_NAME
+from readthedocs.builds.constants import NON_REPOSITORY_VERSIONS
+from readthedocs.builds.constants import BUILD_STATE_TRIGGERED
+from readthedocs.builds.constants import BUILD_PRIORITY_INTERACTIVE
 from readthedocs.builds.models import Build
+from readthedocs.builds.scheduler import BUILD_SCHEDULER_ENABLE
+from readthedocs.core.utils.servers import run_on_servers
 
 log = logging.getLogger(__name__)
 
 SYNC_USER = getattr(settings, 'SYNC_USER', getpass.getuser())
+BUILD_COALESCE_MAX_AGE = getattr(settings, 'BUILD_COALESCE_MAX_AGE', 60 * 60)
 
 
 def run_on_app_servers(command):
     """
-    A helper to copy a single file across app servers
+    A helper to run a command on all app servers at once
+
+    :returns: list of :py:class:`ServerResult`, one for each app server, or
+        for this host without ``MULTIPLE_APP_SERVERS``
     """
     log.info("Running %s on app servers" % command)
-    ret_val = 0
     if getattr(settings, "MULTIPLE_APP_SERVERS", None):
-        for server in settings.MULTIPLE_APP_SERVERS:
-            ret = os.system("ssh %s@%s %s" % (SYNC_USER, server, command))
-            if ret != 0:
-                ret_val = ret
-        return ret_val
+        results = run_on_servers(
+            settings.MULTIPLE_APP_SERVERS,
+            lambda server: ["ssh %s@%s %s" % (SYNC_USER, server, command)])
     else:
-        ret = os.system(command)
-        return ret
+        results = run_on_servers([None], lambda server: [command])
+    failed = [result for result in results if not result.successful]
+    if failed:
+        log.error("Running %s failed on %s" % (
+            command,
+            ', '.join('%s (exit code %s)' % (result.server or 'this host',
+                                             result.exit_code)
+                      for result in failed)))
+    return results
 
 
 def clean_url(url):
@@ -54,12 +70,25 @@ def cname_to_slug(host):
     return slug
 
 
-def trigger_build(project, version=None, record=True, force=False, basic=False):
+def trigger_build(project, version=None, record=True, force=False, basic=False,
+                  commit=None, priority=BUILD_PRIORITY_INTERACTIVE):
     """
     An API to wrap the triggering of a build.
+
+    If a recorded build of the version is already queued, and hasn't started
+    yet, the trigger is merged into that build instead of queueing another
+    one. The queued build will check out the newest commit when it starts
+    anyway, ``commit`` is only recorded on it until then. Queued builds older
+    than :py:data:`BUILD_COALESCE_MAX_AGE` seconds are assumed to be lost and
+    are never merged into.
+
+    With the build scheduler enabled, recorded builds wait for the scheduler
+    to dispatch them, by ``priority``, see :py:mod:`readthedocs.builds.scheduler`.
+    The scheduler tracks builds by their record, builds that aren't recorded
+    are sent to the build queue straight away.
     """
     # Avoid circular import
-    from readthedocs.projects.tasks import update_docs
+    from readthedocs.projects.tasks import update_docs, schedule_builds
 
     if project.skip:
         return None
@@ -67,17 +96,49 @@ def trigger_build(project, version=None, record=True, force=False, basic=False):
     if not version:
         version = project.versions.get(slug=LATEST)
 
+    if version.slug in NON_REPOSITORY_VERSIONS:
+        priority += 1
+
     if record:
-        build = Build.objects.create(
-            project=project,
-            version=version,
-            type='html',
-            state='triggered',
-            success=True,
-        )
-        update_docs.delay(pk=project.pk, version_pk=version.pk, record=record,
-                          force=force, basic=basic, build_pk=build.pk)
+        with transaction.atomic():
+            build = get_queued_build(project, version)
+            if build is not None:
+                build.merged_triggers = F('merged_triggers') + 1
+                if commit:
+                    build.commit = commit
+                update_fields = ['merged_triggers', 'commit']
+                if build.dispatched is None:
+                    # Not sent to a builder yet, so options can still change
+                    build.force = build.force or force
+                    build.priority = max(build.priority, priority)
+                    update_fields.extend(['force', 'priority'])
+                build.save(update_fields=update_fields)
+                build.refresh_from_db(fields=['merged_triggers'])
+                log.info("Merged build trigger into queued build %s of %s:%s",
+                         build.pk, project.slug, version.slug)
+                return build
+            build = Build.objects.create(
+                project=project,
+                version=version,
+                type='html',
+                state=BUILD_STATE_TRIGGERED,
+                success=True,
+                commit=commit,
+                priority=priority,
+                force=force,
+                basic=basic,
+                dispatched=None if BUILD_SCHEDULER_ENABLE else timezone.now(),
+            )
+        if BUILD_SCHEDULER_ENABLE:
+            schedule_builds.delay()
+        else:
+            update_docs.delay(pk=project.pk, version_pk=version.pk,
+                              record=record, force=force, basic=basic,
+                              build_pk=build.pk)
     else:
+        if BUILD_SCHEDULER_ENABLE:
+            log.warning("Unrecorded build of %s:%s bypasses the scheduler",
+                        project.slug, version.slug)
         build = None
         update_docs.delay(pk=project.pk, version_pk=version.pk, record=record,
                           force=force, basic=basic)
@@ -85,6 +146,31 @@ def trigger_build(project, version=None, record=True, force=False, basic=False):
     return build
 
 
+def get_queued_build(project, version):
+    """
+    Return the newest build of ``version`` that is queued, but not started
+
+    Builds waiting for the build scheduler are never lost, and are merged into
+    regardless of their age. The build row is locked for the rest of the
+    transaction.
+    """
+    if not BUILD_COALESCE_MAX_AGE:
+        return None
+    max_age = datetime.timedelta(seconds=BUILD_COALESCE_MAX_AGE)
+    queued = (Build.objects.select_for_update()
+              .filter(project=project,
+                      version=version,
+                      type='html',
+                      state=BUILD_STATE_TRIGGERED)
+              .filter(Q(dispatched__isnull=True) |
+                      Q(date__gte=timezone.now() - max_age))
+              .order_by('-date'))
+    try:
+        return queued[0]
+    except IndexError:
+        return None
+
+
 def send_email(recipient, subject, template, template_html, context=None,
                request=None):
     '''
@@ -0,0 +1,449 @@
+"""
+Publish directories of built documentation atomically
+
+A published directory is a symlink to a release directory. Publishing writes a
+new release next to the current one and then swaps the symlink, so readers see
+either the old or the new tree, never a partial one. Files that didn't change
+since the previous release are hardlinked from it instead of copied.
+
+Each release has a manifest listing the size and md5 hash of its files, so
+later steps can tell which files changed without hashing the tree again.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+PUBLISH_GRACE_PERIOD = getattr(settings, 'PUBLISH_GRACE_PERIOD', 10 * 60)
+
+ARTIFACT_POOL_ENABLE = getattr(settings, 'ARTIFACT_POOL_ENABLE', False)
+ARTIFACT_POOL_ROOT = getattr(settings, 'ARTIFACT_POOL_ROOT',
+                             os.path.join(settings.SITE_ROOT, 'artifact_pool'))
+ARTIFACT_POOL_DIRS = getattr(settings, 'ARTIFACT_POOL_DIRS', ('_static',))
+
+
+class ArtifactPool(object):
+    """
+    Content addressed store of files shared by many releases
+
+    Files in the pooled directories of a release, like the theme files in
+    ``_static``, are stored once in the pool, keyed by the sha256 hash of
+    their contents, and hardlinked into each release that has them. The pool
+    is shared by all projects, so the md5 hashes of the manifests aren't used
+    as keys, as files with the same md5 hash could be made on purpose. Files
+    only the pool links to are removed by :py:meth:`collect`. Files are only
+    pooled on the host publishing the release, copies sent to app servers
+    don't share files.
+
+    :param root: Directory to keep the pool in, on the same filesystem as the
+        releases
+    :param dirs: Names of the directories whose files are pooled
+    """
+
+    def __init__(self, root=ARTIFACT_POOL_ROOT, dirs=ARTIFACT_POOL_DIRS):
+        self.root = root
+        self.dirs = set(dirs)
+        self.device = None
+
+    def pooled(self, name):
+        """Whether the file at relative path ``name`` is pooled"""
+        return bool(self.dirs.intersection(name.split(os.sep)[:-1]))
+
+    def entry_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def usable(self, path):
+        """
+        Whether files at ``path`` can be linked from the pool
+
+        Files can only be hardlinked on the same filesystem.
+        """
+        if self.device is None:
+            try:
+                if not os.path.isdir(self.root):
+                    os.makedirs(self.root)
+                self.device = os.stat(self.root).st_dev
+            except OSError:
+                log.warning('Failed to create pool %s' % self.root,
+                            exc_info=True)
+                return False
+        try:
+            return os.stat(path).st_dev == self.device
+        except OSError:
+            return False
+
+    def link(self, src, dst):
+        """
+        Link ``dst`` to the pooled copy of ``src``
+
+        The file is added to the pool first, if it isn't pooled yet.
+
+        :returns: whether ``dst`` was linked
+        """
+        path = self.entry_path(hash_file(src, algorithm=hashlib.sha256))
+        try:
+            os.link(path, dst)
+            return True
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                return False
+        tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(), uuid.uuid4().hex)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            shutil.copy2(src, tmp_path)
+            # Other publishers pooling the same file write the same content
+            os.rename(tmp_path, path)
+            os.link(path, dst)
+            return True
+        except (IOError, OSError):
+            log.warning('Failed to pool %s' % src, exc_info=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    def collect(self, grace=PUBLISH_GRACE_PERIOD, dryrun=False):
+        """
+        Remove pooled files no release links to anymore
+
+        Files added less than ``grace`` seconds ago are kept, as they may be
+        about to be linked.
+
+        :returns: tuple of the number of files and bytes removed
+        """
+        expired = time.time() - grace
+        removed = 0
+        removed_bytes = 0
+        for (root, dirs, files) in os.walk(self.root):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    continue
+                if stat.st_nlink > 1 or stat.st_ctime > expired:
+                    continue
+                log.debug('Removing unreferenced pool file %s' % path)
+                if not dryrun:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                removed += 1
+                removed_bytes += stat.st_size
+        return (removed, removed_bytes)
+
+
+def releases_path(target):
+    """
+    The directory releases of ``target`` are kept in
+
+    Releases are kept in a hidden directory next to ``target``, so the symlink
+    can be relative and trees keep working when copied to other servers.
+    """
+    (parent, name) = os.path.split(target.rstrip('/'))
+    return os.path.join(parent, '.releases', name)
+
+
+def current_release(target):
+    """
+    The release ``target`` points to, or ``None``
+
+    A ``target`` that is still a plain directory, published before releases
+    were used, counts as the current release.
+    """
+    if os.path.islink(target) or os.path.isdir(target):
+        release = os.path.realpath(target)
+        if os.path.isdir(release):
+            return release
+    return None
+
+
+def hash_file(path, chunk_size=64 * 1024, algorithm=hashlib.md5):
+    """The md5 hex digest of the contents of ``path``, or of ``algorithm``"""
+    digest = algorithm()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(path):
+    """
+    List the files in the tree at ``path``
+
+    :returns: dict of each file's path, relative to ``path``, to a list of its
+        size and the md5 hex digest of its contents
+    """
+    manifest = {}
+    for (root, dirs, files) in os.walk(path):
+        for name in files:
+            full_path = os.path.join(root, name)
+            manifest[os.path.relpath(full_path, path)] = [
+                os.path.getsize(full_path), hash_file(full_path)]
+    return manifest
+
+
+def manifest_path(release):
+    """The path the manifest of ``release`` is kept at"""
+    return release.rstrip('/') + '.manifest'
+
+
+def read_manifest(path):
+    """Read the manifest at ``path``, or return ``None`` if there is none"""
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+def write_manifest(path, manifest):
+    """Write ``manifest`` to ``path``, replacing it atomically"""
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as fh:
+        json.dump(manifest, fh)
+    os.rename(tmp_path, path)
+
+
+def current_manifest(target):
+    """
+    The manifest of the release ``target`` points to, or ``None``
+
+    Trees that weren't published as a release have no manifest.
+    """
+    if not os.path.islink(target):
+        return None
+    release = current_release(target)
+    if release is None:
+        return None
+    return read_manifest(manifest_path(release))
+
+
+def synced_manifest_path(path, server, target):
+    """
+    The path to the manifest of the tree at ``path`` last copied to ``target``
+    on ``server``
+    """
+    key = hashlib.sha1('%s:%s' % (server, target)).hexdigest()
+    return os.path.join(releases_path(path), '.synced', key + '.manifest')
+
+
+def forget_synced(path):
+    """
+    Forget the manifests of the tree at ``path`` copied to any server
+
+    The next copy of the tree sends all of its files.
+    """
+    shutil.rmtree(os.path.join(releases_path(path), '.synced'),
+                  ignore_errors=True)
+
+
+def sync_marker_path(target):
+    """
+    The path of the marker of the tree copied to ``target`` on a server
+
+    The marker holds the :py:func:`manifest_digest` of the manifest copied
+    last. Servers keep it with their copy, so a copy that was removed or
+    replaced since is noticed before only the changes are sent to it.
+    """
+    return os.path.join(releases_path(target), '.synced-manifest')
+
+
+def manifest_digest(manifest):
+    """A hex digest identifying ``manifest``"""
+    return hashlib.md5(json.dumps(manifest, sort_keys=True)).hexdigest()
+
+
+def diff_manifests(old, new):
+    """
+    Compare two manifests
+
+    :returns: tuple of the sorted paths added or changed in ``new``, and the
+        sorted paths removed from ``old``
+    """
+    changed = sorted(name for (name, entry) in new.items()
+                     if old.get(name) != entry)
+    deleted = sorted(set(old) - set(new))
+    return (changed, deleted)
+
+
+def copy_release(path, release, previous=None, manifest=None,
+                 previous_manifest=None, pool=None):
+    """
+    Copy the tree at ``path`` into ``release``
+
+    Files with the same content as in the ``previous`` release are hardlinked
+    from it. Releases are never changed once published, so sharing files
+    between them is safe. Files are compared by their entries in ``manifest``
+    and ``previous_manifest``, where given, instead of by their contents.
+    Other files that are pooled in ``pool`` are hardlinked from the pool.
+
+    :returns: tuple of the manifest of the release, and the number of files
+        linked and copied
+    """
+    if manifest is None:
+        manifest = {}
+    else:
+        manifest = dict(manifest)
+    linked = 0
+    copied = 0
+    for (root, dirs, files) in os.walk(path):
+        rel_root = os.path.relpath(root, path)
+        dst_root = os.path.normpath(os.path.join(release, rel_root))
+        if not os.path.isdir(dst_root):
+            os.makedirs(dst_root)
+        for name in files:
+            src = os.path.join(root, name)
+            dst = os.path.join(dst_root, name)
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            if rel_path not in manifest:
+                manifest[rel_path] = [os.path.getsize(src), hash_file(src)]
+            if previous is not None:
+                old = os.path.join(previous, rel_path)
+                if previous_manifest is not None:
+                    unchanged = previous_manifest.get(rel_path) == \
+                        manifest[rel_path]
+                else:
+                    unchanged = (os.path.isfile(old) and
+                                 os.path.getsize(old) == os.path.getsize(src) and
+                                 hash_file(old) == manifest[rel_path][1])
+                if unchanged:
+                    try:
+                        os.link(old, dst)
+                        linked += 1
+                        continue
+                    except OSError:
+                        pass
+            if (pool is not None and pool.pooled(rel_path) and
+                    pool.link(src, dst)):
+                linked += 1
+                continue
+            shutil.copy2(src, dst)
+            copied += 1
+        shutil.copystat(root, dst_root)
+    return (manifest, linked, copied)
+
+
+def collect_releases(target, grace=PUBLISH_GRACE_PERIOD):
+    """
+    Remove releases of ``target`` superseded more than ``grace`` seconds ago
+
+    Superseded releases are kept around for a while, so requests that already
+    resolved the old symlink can finish reading from them.
+    """
+    releases = releases_path(target)
+    if not os.path.isdir(releases):
+        return []
+    current = current_release(target)
+    expired = time.time() - grace
+    removed = []
+    for name in os.listdir(releases):
+        release = os.path.join(releases, name)
+        if (name.startswith('.') or os.path.islink(release) or
+                not os.path.isdir(release) or
+                os.path.realpath(release) == current):
+            continue
+        try:
+            if os.path.getmtime(release) > expired:
+                continue
+        except OSError:
+            continue
+        log.info("Removing superseded release %s" % release)
+        shutil.rmtree(release, ignore_errors=True)
+        try:
+            os.remove(manifest_path(release))
+        except OSError:
+            pass
+        removed.append(release)
+    return removed
+
+
+def publish(path, target, grace=PUBLISH_GRACE_PERIOD, manifest=None,
+            prepare=None, pool=None, fence=None):
+    """
+    Publish the tree at ``path`` to ``target`` atomically
+
+    The manifest of the release is written next to it. When ``path`` is itself
+    a published tree, its manifest is reused instead of hashing every file.
+
+    :param manifest: manifest of ``path``, if it is known already
+    :param prepare: function called with the new release, its manifest, and
+        the previous release and its manifest, before the release is
+        published. It may add files to the release and the manifest.
+    :param pool: :py:class:`ArtifactPool` to share files through, defaults to
+        the pool at ``ARTIFACT_POOL_ROOT`` if ``ARTIFACT_POOL_ENABLE`` is set
+    :param fence: function called right before the release is published,
+        which raises to keep the current release, see
+        :py:meth:`readthedocs.vcs_support.utils.Lock.fence`
+    :returns: path of the new release
+    """
+    target = target.rstrip('/')
+    releases = releases_path(target)
+    if not os.path.isdir(releases):
+        try:
+            os.makedirs(releases)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    if manifest is None:
+        manifest = current_manifest(path)
+    if pool is None and ARTIFACT_POOL_ENABLE:
+        pool = ArtifactPool()
+    if pool is not None and not pool.usable(releases):
+        log.warning("Pool %s isn't on the filesystem of %s, not pooling"
+                    % (pool.root, releases))
+        pool = None
+    previous = current_release(target)
+    previous_manifest = None
+    if previous is not None and os.path.islink(target):
+        previous_manifest = read_manifest(manifest_path(previous))
+    release = tempfile.mkdtemp(
+        prefix=time.strftime('%Y%m%d%H%M%S-'), dir=releases)
+    try:
+        (manifest, linked, copied) = copy_release(
+            path, release, previous, manifest=manifest,
+            previous_manifest=previous_manifest, pool=pool)
+        if prepare is not None:
+            prepare(release, manifest, previous, previous_manifest)
+        write_manifest(manifest_path(release), manifest)
+        if fence is not None:
+            fence()
+        link = os.path.join(releases, '.%s.link' % os.path.basename(release))
+        os.symlink(os.path.relpath(release, os.path.dirname(target)), link)
+        if os.path.isdir(target) and not os.path.islink(target):
+            # A directory can't be replaced atomically, move it aside as a
+            # release once, later releases are swapped in atomically
+            previous = release + '-legacy'
+            os.rename(target, previous)
+        os.rename(link, target)
+    except Exception:
+        shutil.rmtree(release, ignore_errors=True)
+        if os.path.exists(manifest_path(release)):
+            os.remove(manifest_path(release))
+        raise
+    log.info("Published %s to %s: %s files linked, %s copied" %
+             (path, target, linked, copied))
+
+    if previous is not None:
+        # Mark when the previous release was superseded
+        try:
+            os.utime(previous, None)
+        except OSError:
+            pass
+    collect_releases(target, grace)
+    return release
@@ -0,0 +1,135 @@
+"""
+Run commands on several servers at once
+"""
+
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+SYNC_CONCURRENCY = getattr(settings, 'SYNC_CONCURRENCY', 4)
+SYNC_TIMEOUT = getattr(settings, 'SYNC_TIMEOUT', 10 * 60)
+SYNC_RETRIES = getattr(settings, 'SYNC_RETRIES', 2)
+
+# Summary line printed by rsync -v
+RSYNC_SUMMARY_RE = re.compile(
+    r'sent ([\d,]+) bytes\s+received ([\d,]+) bytes')
+
+
+class ServerResult(namedtuple('ServerResult', [
+        'server', 'exit_code', 'bytes_transferred', 'duration', 'attempts',
+        'output'])):
+    """
+    Outcome of running the commands for a server
+
+    :param server: Server the commands ran for
+    :param exit_code: Exit code of the first failing command, or ``0``.
+        Commands that timed out have an exit code of ``-1``
+    :param bytes_transferred: Bytes sent and received by rsync, if any ran
+    :param duration: Seconds spent on the server, over all attempts
+    :param attempts: Number of times the commands were run
+    :param output: Output of the last command that ran
+    """
+
+    @property
+    def successful(self):
+        return self.exit_code == 0
+
+
+def run_command(command, timeout=SYNC_TIMEOUT):
+    """
+    Run a shell command, killing it after ``timeout`` seconds
+
+    The command runs in a process group of its own, which is killed as a
+    whole, so processes the shell started, like ``ssh`` or ``rsync``, don't
+    outlive it and keep its output open.
+
+    :returns: tuple of exit code and output
+    """
+    proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.daemon = True
+    timer.start()
+    try:
+        (output, _) = proc.communicate()
+    finally:
+        timer.cancel()
+    if timed_out:
+        return (-1, output)
+    return (proc.returncode, output)
+
+
+def run_on_servers(servers, commands, concurrency=SYNC_CONCURRENCY,
+                   timeout=SYNC_TIMEOUT, retries=SYNC_RETRIES):
+    """
+    Run the commands for each server, on all servers at once
+
+    The commands for a server run one after the other, and stop at the first
+    failing command. The commands of a server that failed are run again, up to
+    ``retries`` more times. At most ``concurrency`` servers are worked on at
+    once, and each command is killed after ``timeout`` seconds.
+
+    :param servers: Servers to run commands for
+    :param commands: Function returning the list of shell commands to run for
+        a server
+    :returns: list of :py:class:`ServerResult`, in the order of ``servers``
+    """
+    servers = list(servers)
+    if not servers:
+        return []
+
+    def run_for_server(server):
+        start = time.time()
+        attempts = 0
+        while True:
+            attempts += 1
+            exit_code = 0
+            output = ''
+            transferred = 0
+            for command in commands(server):
+                (exit_code, output) = run_command(command, timeout=timeout)
+                match = RSYNC_SUMMARY_RE.search(output or '')
+                if match:
+                    transferred += sum(int(re.sub(r'\D', '', count))
+                                       for count in match.groups())
+                if exit_code != 0:
+                    log.warning("Command failed on %s with exit code %s: %s",
+                                server, exit_code, command)
+                    break
+            if exit_code == 0 or attempts > retries:
+                break
+        return ServerResult(server=server, exit_code=exit_code,
+                            bytes_transferred=transferred,
+                            duration=time.time() - start, attempts=attempts,
+                            output=output)
+
+    pool = ThreadPool(processes=max(1, min(concurrency, len(servers))))
+    try:
+        results = pool.map(run_for_server, servers)
+    finally:
+        pool.close()
+        pool.join()
+    for result in results:
+        if not result.successful:
+            log.error("Failed on %s after %s attempts: %s",
+                      result.server, result.attempts, result.output)
+    return results
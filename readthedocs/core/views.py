@@ -97,8 +97,13 @@ def wipe_version(request, project_slug, version_slug):
         raise Http404("You must own this project to wipe it.")
 
     if request.method == 'POST':
-        del_dirs = [version.project.checkout_path(
-            version.slug), version.project.venv_path(version.slug)]
+        # The mirror and submodule cache are shared by all versions, checkouts
+        # of other versions borrowing their objects are cloned again
+        del_dirs = [version.project.checkout_path(version.slug),
+                    version.project.venv_path(version.slug),
+                    version.project.doctrees_path(version.slug),
+                    version.project.mirror_path(),
+                    version.project.submodule_cache_path()]
         for del_dir in del_dirs:
             # Support hacky "broadcast" with MULTIPLE_BUILD_SERVERS setting,
             # otherwise put in normal celery queue
@@ -114,20 +119,34 @@ def wipe_version(request, project_slug, version_slug):
                                   context_instance=RequestContext(request))
 
 
-def _build_version(project, slug, already_built=()):
+def _pushed_commits(branch, commit):
+    """
+    Map ``branch`` to the ``commit`` pushed to it
+
+    Deleting a branch pushes the null commit, which isn't recorded.
+    """
+    if not commit or not commit.strip('0'):
+        return {}
+    return {branch: commit}
+
+
+def _build_version(project, slug, already_built=(), force=True,
+                   commit=None):
     default = project.default_branch or (project.vcs_repo().fallback_branch)
     if slug == default and slug not in already_built:
         # short circuit versions that are default
         # these will build at "latest", and thus won't be
         # active
         latest_version = project.versions.get(slug=LATEST)
-        trigger_build(project=project, version=latest_version, force=True)
+        trigger_build(project=project, version=latest_version, force=force,
+                      commit=commit)
         pc_log.info(("(Version build) Building %s:%s"
                      % (project.slug, latest_version.slug)))
         if project.versions.exclude(active=False).filter(slug=slug).exists():
             # Handle the case where we want to build the custom branch too
             slug_version = project.versions.get(slug=slug)
-            trigger_build(project=project, version=slug_version, force=True)
+            trigger_build(project=project, version=slug_version, force=force,
+                          commit=commit)
             pc_log.info(("(Version build) Building %s:%s"
                          % (project.slug, slug_version.slug)))
         return LATEST
@@ -136,7 +155,8 @@ def _build_version(project, slug, already_built=()):
         return None
     elif slug not in already_built:
         version = project.versions.get(slug=slug)
-        trigger_build(project=project, version=version, force=True)
+        trigger_build(project=project, version=version, force=force,
+                      commit=commit)
         pc_log.info(("(Version build) Building %s:%s"
                      % (project.slug, version.slug)))
         return slug
@@ -145,7 +165,14 @@ def _build_version(project, slug, already_built=()):
         return None
 
 
-def _build_branches(project, branch_list):
+def _build_branches(project, branch_list, force=True, commits=None):
+    """
+    Build the versions of each branch in ``branch_list``
+
+    :param commits: dict of branch to the commit pushed to it, recorded on the
+        builds triggered for the branch
+    """
+    commits = commits or {}
     for branch in branch_list:
         versions = project.versions_from_branch_name(branch)
         to_build = set()
@@ -153,7 +180,8 @@ def _build_branches(project, branch_list):
         for version in versions:
             pc_log.info(("(Branch Build) Processing %s:%s"
                          % (project.slug, version.slug)))
-            ret = _build_version(project, version.slug, already_built=to_build)
+            ret = _build_version(project, version.slug, already_built=to_build,
+                                 force=force, commit=commits.get(branch))
             if ret:
                 to_build.add(ret)
             else:
@@ -161,7 +189,7 @@ def _build_branches(project, branch_list):
     return (to_build, not_building)
 
 
-def _build_url(url, branches):
+def _build_url(url, branches, commits=None):
     try:
         projects = (
             Project.objects.filter(repo__endswith=url) |
@@ -169,7 +197,11 @@ def _build_url(url, branches):
         if not projects.count():
             raise NoProjectException()
         for project in projects:
-            (to_build, not_building) = _build_branches(project, branches)
+            # Pushes don't force a rebuild, so versions whose commit and
+            # configuration didn't change aren't built again
+            (to_build, not_building) = _build_branches(project, branches,
+                                                       force=False,
+                                                       commits=commits)
             if not to_build:
                 update_imported_docs.delay(project.versions.get(slug=LATEST).pk)
                 msg = '(URL Build) Syncing versions for %s' % project.slug
@@ -207,9 +239,12 @@ def github_build(request):
         url = obj['repository']['url']
         ghetto_url = url.replace('http://', '').replace('https://', '')
         branch = obj['ref'].replace('refs/heads/', '')
+        head_commit = obj.get('head_commit') or {}
+        commits = _pushed_commits(branch,
+                                  obj.get('after') or head_commit.get('id'))
         pc_log.info("(Incoming Github Build) %s [%s]" % (ghetto_url, branch))
         try:
-            return _build_url(ghetto_url, [branch])
+            return _build_url(ghetto_url, [branch], commits=commits)
         except NoProjectException:
             pc_log.error(
                 "(Incoming GitHub Build) Repo not found:  %s" % ghetto_url)
@@ -233,9 +268,11 @@ def gitlab_build(request):
         url = obj['repository']['homepage']
         ghetto_url = url.replace('http://', '').replace('https://', '')
         branch = obj['ref'].replace('refs/heads/', '')
+        commits = _pushed_commits(
+            branch, obj.get('checkout_sha') or obj.get('after'))
         pc_log.info("(Incoming GitLab Build) %s [%s]" % (ghetto_url, branch))
         try:
-            return _build_url(ghetto_url, [branch])
+            return _build_url(ghetto_url, [branch], commits=commits)
         except NoProjectException:
             pc_log.error(
                 "(Incoming GitLab Build) Repo not found:  %s" % ghetto_url)
@@ -253,14 +290,21 @@ def bitbucket_build(request):
             return HttpResponseNotFound('Invalid Request')
         obj = json.loads(payload)
         rep = obj['repository']
-        branches = [rec.get('branch', '') for rec in obj['commits']]
+        # Commits are listed oldest first, the last one of a branch is its head
+        branches = []
+        commits = {}
+        for rec in obj['commits']:
+            branch = rec.get('branch', '')
+            if branch not in branches:
+                branches.append(branch)
+            commits.update(_pushed_commits(branch, rec.get('raw_node')))
         ghetto_url = "%s%s" % (
             "bitbucket.org",  rep['absolute_url'].rstrip('/'))
         pc_log.info("(Incoming Bitbucket Build) %s [%s]" % (
             ghetto_url, ' '.join(branches)))
         pc_log.info("(Incoming Bitbucket Build) JSON: \n\n%s\n\n" % obj)
         try:
-            return _build_url(ghetto_url, branches)
+            return _build_url(ghetto_url, branches, commits=commits)
         except NoProjectException:
             pc_log.error(
                 "(Incoming Bitbucket Build) Repo not found:  %s" % ghetto_url)
@@ -150,6 +150,7 @@ class MkdocsHTML(BaseMkdocs):
     type = 'mkdocs'
     builder = 'build'
     build_dir = '_build/html'
+    compress = True
 
 
 class MkdocsJSON(BaseMkdocs):
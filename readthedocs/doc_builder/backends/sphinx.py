@@ -2,9 +2,12 @@ import re
 import os
 import sys
 import codecs
+import hashlib
+import json
+import shutil
+from contextlib import contextmanager
 from glob import glob
 import logging
-import zipfile
 
 from django.template import Context, loader as template_loader
 from django.template.loader import render_to_string
@@ -15,13 +18,16 @@ from readthedocs.projects.utils import safe_write
 from readthedocs.projects.exceptions import ProjectImportError
 from readthedocs.restapi.client import api
 
-from ..base import BaseBuilder, restoring_chdir
+from ..base import BaseBuilder
+from ..compress import write_zip
 from ..exceptions import BuildEnvironmentError
 
 
 log = logging.getLogger(__name__)
 
 TEMPLATE_DIR = '%s/readthedocs/templates/sphinx' % settings.SITE_ROOT
+MULTIBUILD_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                 'scripts', 'sphinx_multibuild.py')
 STATIC_DIR = '%s/_static' % TEMPLATE_DIR
 PDF_RE = re.compile('Output written on (.*?)')
 
@@ -32,6 +38,8 @@ class BaseSphinx(BaseBuilder):
     The parent for most sphinx builders.
     """
 
+    doctrees_dir = '_build/doctrees'
+
     def __init__(self, *args, **kwargs):
         super(BaseSphinx, self).__init__(*args, **kwargs)
         try:
@@ -41,6 +49,12 @@ class BaseSphinx(BaseBuilder):
         except ProjectImportError:
             docs_dir = self.docs_dir()
             self.old_artifact_path = os.path.join(docs_dir, self.sphinx_build_dir)
+        # Incremental builds keep the doctrees outside of the checkout, where
+        # they survive cleaning the checkout between builds.
+        self.incremental = getattr(settings, 'SPHINX_INCREMENTAL_BUILDS', False)
+        if self.incremental:
+            self.doctrees_dir = self.project.doctrees_path(self.version.slug)
+        self.config_fingerprint = None
 
     def _write_config(self):
         """
@@ -67,6 +81,13 @@ class BaseSphinx(BaseBuilder):
             self.create_index(extension='rst')
 
         project = self.project
+        user_conf = None
+        if self.incremental:
+            try:
+                with open(project.conf_file(self.version.slug), 'rb') as conf_file:
+                    user_conf = conf_file.read()
+            except IOError:
+                pass
         # Open file for appending.
         try:
             outfile = codecs.open(project.conf_file(self.version.slug), encoding='utf-8', mode='a')
@@ -119,9 +140,80 @@ class BaseSphinx(BaseBuilder):
             rtd_ctx['downloads'] = (api.version(self.version.pk)
                                     .get()['downloads'])
 
-        rtd_string = template_loader.get_template('doc_builder/conf.py.tmpl').render(rtd_ctx)
+        rtd_template = template_loader.get_template('doc_builder/conf.py.tmpl')
+        rtd_string = rtd_template.render(rtd_ctx)
         outfile.write(rtd_string)
 
+        if user_conf is not None:
+            # These only end up in ``html_context``. Sphinx already rewrites
+            # every page when they change, without reading the source again.
+            rtd_ctx.push(commit='', versions=[], downloads={})
+            self.config_fingerprint = hashlib.sha1('\0'.join(
+                [user_conf, rtd_template.render(rtd_ctx).encode('utf-8')] +
+                self.installed_packages()
+            )).hexdigest()
+            rtd_ctx.pop()
+
+    def installed_packages(self):
+        '''List the top level entries of the virtualenv's site-packages
+
+        Distribution metadata directories carry the distribution's version in
+        their name, so this changes whenever an extension is added, removed or
+        upgraded.
+        '''
+        venv_path = self.project.venv_path(version=self.version.slug)
+        return sorted(
+            os.path.basename(path) for path in
+            glob(os.path.join(venv_path, 'lib', 'python*', 'site-packages', '*'))
+        )
+
+    @property
+    def fingerprint_path(self):
+        conf_dir = self.project.conf_dir(self.version.slug)
+        return os.path.join(conf_dir, self.doctrees_dir, 'readthedocs.fingerprint')
+
+    def config_changed(self):
+        '''Has the configuration changed since the last incremental build
+
+        Sphinx only notices some configuration changes on its own, and not
+        changes to the set of installed extensions, so incremental builds fall
+        back to a full build whenever ``conf.py``, our appended configuration
+        or the virtualenv's packages change.
+        '''
+        if self.config_fingerprint is None:
+            return False
+        try:
+            with open(self.fingerprint_path) as fingerprint_file:
+                return fingerprint_file.read() != self.config_fingerprint
+        except IOError:
+            return True
+
+    @contextmanager
+    def private_doctrees(self):
+        """Build against a private copy of the shared doctrees
+
+        Sphinx pickles its environment back into the doctrees directory at the
+        end of every build, so builders running at the same time can't share
+        ``_build/doctrees``. The copy starts from whatever environment the HTML
+        build left behind, so the source doesn't have to be read again, and is
+        removed once the build finishes.
+        """
+        conf_dir = self.project.conf_dir(self.version.slug)
+        shared_dir = self.doctrees_dir
+        shared_path = os.path.join(conf_dir, shared_dir)
+        private_dir = '_build/doctrees-{0}'.format(self.type)
+        private_path = os.path.join(conf_dir, private_dir)
+        if os.path.exists(private_path):
+            shutil.rmtree(private_path)
+        if os.path.exists(shared_path):
+            shutil.copytree(shared_path, private_path)
+        self.doctrees_dir = private_dir
+        try:
+            yield
+        finally:
+            self.doctrees_dir = shared_dir
+            shutil.rmtree(private_path, ignore_errors=True)
+
     def build(self, **kwargs):
         self.clean()
         project = self.project
@@ -132,9 +224,12 @@ class BaseSphinx(BaseBuilder):
         ]
         if self._force:
             build_command.append('-E')
+        elif self.config_changed():
+            log.info("Configuration changed, not building incrementally")
+            build_command.append('-E')
         build_command.extend([
             '-b', self.sphinx_builder,
-            '-d', '_build/doctrees',
+            '-d', self.doctrees_dir,
             '-D', 'language={lang}'.format(lang=project.language),
             '.',
             self.sphinx_build_dir
@@ -144,12 +239,30 @@ class BaseSphinx(BaseBuilder):
             cwd=project.conf_dir(self.version.slug),
             bin_path=project.venv_bin(version=self.version.slug)
         )
+        if cmd_ret.successful:
+            self.save_config_fingerprint()
         return cmd_ret.successful
 
+    def save_config_fingerprint(self):
+        '''Record the configuration of a successful incremental build'''
+        if self.config_fingerprint is not None:
+            with open(self.fingerprint_path, 'w') as fingerprint_file:
+                fingerprint_file.write(self.config_fingerprint)
+
+    def post_build(self):
+        '''
+        An optional step to turn Sphinx's output into the final artifact.
+
+        Run after the Sphinx output was written by
+        :py:class:`MultiFormatBuilder`. Returns whether this was successful.
+        '''
+        return True
+
 
 class HtmlBuilder(BaseSphinx):
     type = 'sphinx'
     sphinx_build_dir = '_build/html'
+    compress = True
 
     def __init__(self, *args, **kwargs):
         super(HtmlBuilder, self).__init__(*args, **kwargs)
@@ -186,28 +299,19 @@ class LocalMediaBuilder(BaseSphinx):
     sphinx_builder = 'readthedocssinglehtmllocalmedia'
     sphinx_build_dir = '_build/localmedia'
 
-    @restoring_chdir
-    def move(self, **kwargs):
+    def move(self, fence=None, **kwargs):
         log.info("Creating zip file from %s" % self.old_artifact_path)
         target_file = os.path.join(self.target, '%s.zip' % self.project.slug)
         if not os.path.exists(self.target):
             os.makedirs(self.target)
-        if os.path.exists(target_file):
-            os.remove(target_file)
-
-        # Create a <slug>.zip file
-        os.chdir(self.old_artifact_path)
-        archive = zipfile.ZipFile(target_file, 'w')
-        for root, subfolders, files in os.walk('.'):
-            for file in files:
-                to_write = os.path.join(root, file)
-                archive.write(
-                    filename=to_write,
-                    arcname=os.path.join("%s-%s" % (self.project.slug,
-                                                    self.version.slug),
-                                         to_write)
-                )
-        archive.close()
+        if fence is not None:
+            fence()
+
+        # Create a <slug>.zip file. Paths are kept relative without changing
+        # the working directory, as other builders may be running in threads.
+        # Entries unchanged since the last zip file are reused from it.
+        write_zip(self.old_artifact_path, target_file,
+                  prefix="%s-%s" % (self.project.slug, self.version.slug))
 
 
 class EpubBuilder(BaseSphinx):
@@ -215,11 +319,13 @@ class EpubBuilder(BaseSphinx):
     sphinx_builder = 'epub'
     sphinx_build_dir = '_build/epub'
 
-    def move(self, **kwargs):
+    def move(self, fence=None, **kwargs):
         from_globs = glob(os.path.join(self.old_artifact_path, "*.epub"))
         if not os.path.exists(self.target):
             os.makedirs(self.target)
         if from_globs:
+            if fence is not None:
+                fence()
             from_file = from_globs[0]
             to_file = os.path.join(self.target, "%s.epub" % self.project.slug)
             self.run('mv', '-f', from_file, to_file)
@@ -227,6 +333,7 @@ class EpubBuilder(BaseSphinx):
 
 class PdfBuilder(BaseSphinx):
     type = 'sphinx_pdf'
+    sphinx_builder = 'latex'
     sphinx_build_dir = '_build/latex'
     pdf_file_name = None
 
@@ -238,14 +345,19 @@ class PdfBuilder(BaseSphinx):
         self.run(
             'python',
             self.project.venv_bin(version=self.version.slug, bin='sphinx-build'),
-            '-b', 'latex',
+            '-b', self.sphinx_builder,
             '-D', 'language={lang}'.format(lang=self.project.language),
-            '-d', '_build/doctrees',
+            '-d', self.doctrees_dir,
             '.',
-            '_build/latex',
+            self.sphinx_build_dir,
             cwd=cwd,
             bin_path=self.project.venv_bin(version=self.version.slug)
         )
+        return self.post_build()
+
+    def post_build(self):
+        '''Run LaTeX -> PDF conversions on Sphinx's LaTeX output'''
+        cwd = self.project.conf_dir(self.version.slug)
         latex_cwd = os.path.join(cwd, '_build', 'latex')
         tex_files = glob(os.path.join(latex_cwd, '*.tex'))
 
@@ -286,7 +398,7 @@ class PdfBuilder(BaseSphinx):
             pdf_commands.append(cmd_ret)
         return all(cmd.successful for cmd in pdf_commands)
 
-    def move(self, **kwargs):
+    def move(self, fence=None, **kwargs):
         if not os.path.exists(self.target):
             os.makedirs(self.target)
 
@@ -308,5 +420,87 @@ class PdfBuilder(BaseSphinx):
             else:
                 from_file = None
         if from_file:
+            if fence is not None:
+                fence()
             to_file = os.path.join(self.target, "%s.pdf" % self.project.slug)
             self.run('mv', '-f', from_file, to_file)
+
+
+class MultiFormatBuilder(object):
+
+    """
+    Build several Sphinx output formats in a single process.
+
+    ``sphinx-build`` writes one output format per run, and every run starts a
+    new process. This runs a small script in the project's virtualenv instead,
+    which writes each format in turn from the same process. Each format still
+    gets its own Sphinx application, which loads the configuration, the
+    extensions and the pickled environment again, so this only saves process
+    startup. Each builder's :py:meth:`BaseSphinx.post_build` is run afterwards,
+    and artifacts are still moved with each builder's ``move()``.
+
+    :param build_env: Build environment to run the build in
+    :param builders: List of Sphinx builders, the first of which decides the
+                     doctrees path and whether to start from a fresh
+                     environment
+    """
+
+    def __init__(self, build_env, builders):
+        self.build_env = build_env
+        self.project = build_env.project
+        self.version = build_env.version
+        self.builders = builders
+
+    def build(self):
+        """
+        Write all formats, then post process each
+
+        :returns: Success of each builder, keyed by builder type
+        :rtype: dict
+        """
+        conf_dir = self.project.conf_dir(self.version.slug)
+        build_dir = os.path.join(conf_dir, '_build')
+        if not os.path.exists(build_dir):
+            os.makedirs(build_dir)
+        script_path = os.path.join(build_dir, 'readthedocs_multibuild.py')
+        results_path = os.path.join(build_dir, 'readthedocs_multibuild.json')
+        shutil.copy(MULTIBUILD_SCRIPT, script_path)
+        if os.path.exists(results_path):
+            os.remove(results_path)
+
+        main_builder = self.builders[0]
+        freshenv = main_builder._force
+        if not freshenv and main_builder.config_changed():
+            log.info("Configuration changed, not building incrementally")
+            freshenv = True
+        formats = []
+        for builder in self.builders:
+            builder.clean()
+            formats.append([builder.type, builder.sphinx_builder,
+                            builder.sphinx_build_dir])
+
+        self.build_env.run(
+            'python',
+            script_path,
+            main_builder.doctrees_dir,
+            self.project.language,
+            '1' if freshenv else '0',
+            results_path,
+            json.dumps(formats),
+            cwd=conf_dir,
+            bin_path=self.project.venv_bin(version=self.version.slug),
+            warn_only=True
+        )
+        try:
+            with open(results_path) as results_file:
+                results = json.load(results_file)
+        except (IOError, ValueError):
+            results = {}
+
+        if results.get(main_builder.type):
+            main_builder.save_config_fingerprint()
+        outcomes = {}
+        for builder in self.builders:
+            outcomes[builder.type] = (results.get(builder.type, False) and
+                                      builder.post_build())
+        return outcomes
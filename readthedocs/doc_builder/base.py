@@ -1,8 +1,14 @@
+from contextlib import contextmanager
 from functools import wraps
 import os
 import logging
 import shutil
 
+from readthedocs.core.utils.publish import publish
+
+from .compress import compress_release
+from .constants import COMPRESS_ARTIFACTS
+
 log = logging.getLogger(__name__)
 
 
@@ -27,6 +33,8 @@ class BaseBuilder(object):
     """
 
     _force = False
+    # Whether to write compressed sidecars of the artifacts
+    compress = False
     # old_artifact_path = ..
 
     def __init__(self, build_env, force=False):
@@ -52,15 +60,30 @@ class BaseBuilder(object):
         """
         raise NotImplementedError
 
-    def move(self, **kwargs):
+    @contextmanager
+    def private_doctrees(self):
+        """
+        Give the builder its own copy of any state shared with other builders.
+
+        Used when builders run concurrently. Builders that don't share state
+        have nothing to copy.
+        """
+        yield
+
+    def move(self, fence=None, **kwargs):
         """
         Move the documentation from it's generated place to its artifact directory.
+
+        :param fence: function called before the artifacts are replaced, which
+            raises if the build lost the lock on the version
         """
         if os.path.exists(self.old_artifact_path):
-            if os.path.exists(self.target):
-                shutil.rmtree(self.target)
             log.info("Copying %s on the local filesystem" % self.type)
-            shutil.copytree(self.old_artifact_path, self.target)
+            prepare = None
+            if self.compress and COMPRESS_ARTIFACTS:
+                prepare = compress_release
+            publish(self.old_artifact_path, self.target, prepare=prepare,
+                    fence=fence)
         else:
             log.warning("Not moving docs, because the build dir is unknown.")
 
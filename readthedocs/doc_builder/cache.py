@@ -0,0 +1,211 @@
+'''
+Content addressed cache of prebuilt virtualenvs
+'''
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import uuid
+
+from .constants import VENV_CACHE_ROOT, VENV_CACHE_SIZE
+
+log = logging.getLogger(__name__)
+
+
+class VirtualenvCache(object):
+    '''
+    Cache of installed virtualenvs, keyed on a hash of what went into them
+
+    Each entry is a directory under ``root`` named after its key, holding the
+    virtualenv in ``venv/`` and a ``cache.json`` file with the path the
+    virtualenv was originally built at. Virtualenvs aren't relocatable, so
+    scripts and links that refer to that path are rewritten when an entry is
+    cloned to a new path. Entries are evicted least recently used first once
+    the cache grows past ``max_size`` bytes.
+
+    :param root: Path to store cache entries under
+    :param max_size: Disk quota for the cache, in bytes
+    '''
+
+    meta_file = 'cache.json'
+
+    def __init__(self, root=VENV_CACHE_ROOT, max_size=VENV_CACHE_SIZE):
+        self.root = root
+        self.max_size = max_size
+
+    @staticmethod
+    def make_key(*parts):
+        '''Hash ``parts``, which must be JSON serializable, into a cache key'''
+        return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def get_meta(self, key):
+        '''Return entry metadata for ``key``, or ``None`` on a cache miss'''
+        try:
+            with open(os.path.join(self.entry_path(key), self.meta_file)) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def restore(self, key, path):
+        '''Materialise the virtualenv cached under ``key`` at ``path``
+
+        The entry is cloned with copy-on-write where the filesystem supports
+        it, and copied otherwise. Any existing virtualenv at ``path`` is
+        replaced.
+
+        :returns: whether the virtualenv was restored from the cache
+        '''
+        meta = self.get_meta(key)
+        if meta is None:
+            return False
+        entry = self.entry_path(key)
+        if os.path.lexists(path):
+            shutil.rmtree(path)
+        try:
+            clone_tree(os.path.join(entry, 'venv'), path)
+            relocate_tree(path, meta['prefix'])
+            # Entry mtime is used as the access time for eviction
+            os.utime(entry, None)
+        except (IOError, OSError):
+            # Most likely evicted out from under us by another build
+            log.warning('Unable to restore virtualenv %s from cache', key,
+                        exc_info=True)
+            shutil.rmtree(path, ignore_errors=True)
+            return False
+        log.info('Restored virtualenv %s from cache', key)
+        return True
+
+    def store(self, key, path):
+        '''Add the virtualenv at ``path`` to the cache under ``key``
+
+        The entry is written to a temporary path and renamed into place, so
+        concurrent builds never see a partial entry.
+        '''
+        entry = self.entry_path(key)
+        if os.path.exists(entry):
+            return
+        tmp_entry = os.path.join(self.root,
+                                 '.tmp-{0}'.format(uuid.uuid4().hex))
+        try:
+            shutil.copytree(path, os.path.join(tmp_entry, 'venv'),
+                            symlinks=True)
+            meta = {'prefix': path, 'size': tree_size(tmp_entry)}
+            with open(os.path.join(tmp_entry, self.meta_file), 'w') as fh:
+                json.dump(meta, fh)
+            os.rename(tmp_entry, entry)
+        except (IOError, OSError):
+            log.warning('Unable to store virtualenv %s in cache', key,
+                        exc_info=True)
+            return
+        finally:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        log.info('Stored virtualenv %s in cache', key)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        '''Remove least recently used entries until under the disk quota
+
+        :param keep: key of an entry that should never be evicted
+        '''
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.root):
+            if key.startswith('.'):
+                continue
+            meta = self.get_meta(key)
+            if meta is None:
+                continue
+            try:
+                atime = os.stat(self.entry_path(key)).st_mtime
+            except OSError:
+                continue
+            entries.append((atime, key, meta['size']))
+            total_size += meta['size']
+        for (atime, key, size) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            log.info('Evicting virtualenv %s from cache', key)
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total_size -= size
+
+
+def clone_tree(src, dst):
+    '''Clone directory ``src`` to ``dst``
+
+    Uses a copy-on-write copy where the filesystem supports it, so file data
+    isn't copied. Otherwise each file is copied: builds install into and may
+    modify files of the virtualenv in place, which would change the cache
+    entry through a hardlink.
+    '''
+    parent = os.path.dirname(dst)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    with open(os.devnull, 'w') as devnull:
+        ret = subprocess.call(['cp', '-a', '--reflink=always', src, dst],
+                              stdout=devnull, stderr=devnull)
+    if ret == 0:
+        return
+    shutil.rmtree(dst, ignore_errors=True)
+    for root, dirnames, filenames in os.walk(src):
+        target_root = os.path.normpath(
+            os.path.join(dst, os.path.relpath(root, src)))
+        os.makedirs(target_root)
+        shutil.copystat(root, target_root)
+        for name in dirnames + filenames:
+            src_path = os.path.join(root, name)
+            dst_path = os.path.join(target_root, name)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+            elif os.path.isfile(src_path):
+                shutil.copy2(src_path, dst_path)
+
+
+def relocate_tree(path, prefix):
+    '''Rewrite references to ``prefix`` in the virtualenv at ``path``
+
+    Script shebangs and activation scripts in ``bin/``, ``.pth`` files, and
+    absolute symlinks refer to the path a virtualenv was created at. Files
+    are rewritten by replacing them, never in place, so cache entries
+    sharing data with the virtualenv are left untouched. These files are also always replaced, even
+    without a reference to ``prefix``, as they may be modified in place by
+    later installs.
+    '''
+    if prefix == path:
+        prefix = None
+    bin_path = os.path.join(path, 'bin')
+    for root, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            file_path = os.path.join(root, name)
+            if os.path.islink(file_path):
+                target = os.readlink(file_path)
+                if prefix is not None and target.startswith(prefix):
+                    os.remove(file_path)
+                    os.symlink(path + target[len(prefix):], file_path)
+            elif (os.path.isfile(file_path) and
+                  (root == bin_path or name.endswith('.pth'))):
+                with open(file_path, 'rb') as fh:
+                    content = fh.read()
+                if prefix is not None:
+                    content = content.replace(prefix, path)
+                tmp_path = file_path + '.relocate'
+                with open(tmp_path, 'wb') as fh:
+                    fh.write(content)
+                shutil.copymode(file_path, tmp_path)
+                os.rename(tmp_path, file_path)
+
+
+def tree_size(path):
+    '''Total size, in bytes, of the files under ``path``'''
+    size = 0
+    for root, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            size += os.lstat(os.path.join(root, name)).st_size
+    return size
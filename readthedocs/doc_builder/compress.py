@@ -0,0 +1,337 @@
+'''
+Compression of built documentation
+
+Compressible files get a ``.gz`` sidecar, and a ``.br`` sidecar when brotli
+is enabled, written next to them in a release before it is published. Web
+servers can serve the sidecars as is, for instance with nginx's
+``gzip_static``, instead of compressing the same files on every request.
+
+Zip archives of built documentation are written with :py:func:`write_zip`,
+which compresses files in parallel and reuses entries of the previous
+archive.
+'''
+
+import gzip
+import hashlib
+import logging
+import os
+import struct
+import sys
+import time
+import zipfile
+import zlib
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+from readthedocs.core.utils.publish import (hash_file, read_manifest,
+                                            write_manifest)
+
+from .constants import (COMPRESS_BROTLI, COMPRESS_EXTENSIONS, COMPRESS_JOBS,
+                        COMPRESS_MIN_SIZE)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+SIDECAR_EXTENSIONS = ('.gz', '.br')
+
+
+def is_sidecar(name):
+    '''Whether ``name`` is a compressed sidecar of another file'''
+    return name.endswith(SIDECAR_EXTENSIONS)
+
+
+def compress_gzip(data):
+    '''Compress ``data`` reproducibly, without a file name or time'''
+    buf = BytesIO()
+    archive = gzip.GzipFile(filename='', mode='wb', fileobj=buf,
+                            compresslevel=9, mtime=0)
+    archive.write(data)
+    archive.close()
+    return buf.getvalue()
+
+
+def compress_brotli(data):
+    return brotli.compress(data)
+
+
+def sidecar_formats(use_brotli=COMPRESS_BROTLI):
+    '''Map of sidecar extension to compression function'''
+    formats = {'.gz': compress_gzip}
+    if use_brotli:
+        if brotli is None:
+            log.warning('COMPRESS_BROTLI is set, but brotli is not installed')
+        else:
+            formats['.br'] = compress_brotli
+    return formats
+
+
+def write_sidecars(path, formats):
+    '''
+    Write the compressed sidecars of the file at ``path``
+
+    Sidecars that aren't smaller than the file are not written, the file is
+    served as is then.
+
+    :returns: list of the extensions of the sidecars written
+    '''
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    stat = os.stat(path)
+    written = []
+    for (ext, compress) in sorted(formats.items()):
+        compressed = compress(data)
+        if len(compressed) >= len(data):
+            continue
+        with open(path + ext, 'wb') as fh:
+            fh.write(compressed)
+        # Serve the sidecar with the same Last-Modified as the file
+        os.utime(path + ext, (stat.st_atime, stat.st_mtime))
+        written.append(ext)
+    return written
+
+
+def compress_release(release, manifest, previous=None, previous_manifest=None,
+                     extensions=COMPRESS_EXTENSIONS, min_size=COMPRESS_MIN_SIZE,
+                     jobs=COMPRESS_JOBS, use_brotli=COMPRESS_BROTLI):
+    '''
+    Write sidecars for the compressible files of a release
+
+    Sidecars of files that didn't change since the ``previous`` release are
+    hardlinked from it, other files are compressed ``jobs`` at a time. The
+    sidecars written are added to ``manifest``.
+
+    :param release: Path of the release, before it is published
+    :param manifest: Manifest of the release
+    :returns: number of files compressed
+    '''
+    formats = sidecar_formats(use_brotli)
+    pending = []
+    for (name, entry) in sorted(manifest.items()):
+        if (is_sidecar(name) or entry[0] < min_size or
+                not name.lower().endswith(tuple(extensions))):
+            continue
+        if any(name + ext in manifest for ext in formats):
+            # Sidecars copied over with the tree
+            continue
+        if (previous_manifest is not None and
+                previous_manifest.get(name) == entry and
+                all(name + ext in previous_manifest for ext in formats)):
+            linked = []
+            try:
+                for ext in formats:
+                    os.link(os.path.join(previous, name + ext),
+                            os.path.join(release, name + ext))
+                    linked.append(ext)
+            except OSError:
+                for ext in linked:
+                    os.remove(os.path.join(release, name + ext))
+            else:
+                for ext in linked:
+                    manifest[name + ext] = previous_manifest[name + ext]
+                continue
+        pending.append(name)
+    if not pending:
+        return 0
+
+    def compress(name):
+        return (name, write_sidecars(os.path.join(release, name), formats))
+
+    pool = ThreadPool(processes=max(1, min(jobs, len(pending))))
+    try:
+        results = pool.map(compress, pending)
+    finally:
+        pool.close()
+        pool.join()
+
+    for (name, written) in results:
+        for ext in written:
+            sidecar = os.path.join(release, name + ext)
+            manifest[name + ext] = [os.path.getsize(sidecar),
+                                    hash_file(sidecar)]
+    log.info('Compressed %s files in %s' % (len(pending), release))
+    return len(pending)
+
+
+# Formats that are compressed already, and are stored in zip files as is
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.ico', '.woff',
+                     '.woff2', '.zip', '.gz', '.br', '.pdf', '.epub')
+
+# Writing compressed entries, and copying them between archives, relies on
+# internals of :py:mod:`zipfile`, which are only known to work on Python 2.7.
+# Elsewhere, files are compressed by :py:mod:`zipfile` itself.
+RAW_ZIP_ENTRIES = (
+    sys.version_info[:2] == (2, 7) and
+    hasattr(zipfile, '_FH_FILENAME_LENGTH') and
+    hasattr(zipfile, '_FH_EXTRA_FIELD_LENGTH') and
+    hasattr(zipfile.ZipFile, '_writecheck'))
+
+
+def zip_manifest_path(target_file):
+    '''
+    The manifest of the zip file ``target_file``
+
+    The manifest lists the size and md5 of the file of each entry, so entries
+    of files that didn't change can be reused. It is kept hidden next to the
+    zip file.
+    '''
+    (parent, name) = os.path.split(target_file)
+    return os.path.join(parent, '.%s.manifest' % name)
+
+
+def compress_zip_entry(path, arcname, reusable=None):
+    '''
+    Compress the file at ``path`` for a zip entry
+
+    :param reusable: zip manifest of the entries of the previous archive.
+        Entries of files with the same size and md5 aren't compressed again.
+    :returns: tuple of the :py:class:`zipfile.ZipInfo` of the entry, its
+        compressed data, which is ``None`` to reuse the previous entry, and
+        the manifest entry of the file
+    '''
+    stat = os.stat(path)
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    entry = [len(data), hashlib.md5(data).hexdigest()]
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(stat.st_mtime)[:6])
+    zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16
+    zinfo.file_size = len(data)
+    if reusable is not None and reusable.get(arcname) == entry:
+        return (zinfo, None, entry)
+    zinfo.CRC = zlib.crc32(data) & 0xffffffff
+    compressed = None
+    if not arcname.lower().endswith(STORED_EXTENSIONS):
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    if compressed is not None and len(compressed) < len(data):
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        data = compressed
+    else:
+        zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.compress_size = len(data)
+    return (zinfo, data, entry)
+
+
+def read_raw_entry(archive, zinfo):
+    '''Read the compressed data of an entry of ``archive`` as is'''
+    archive.fp.seek(zinfo.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           archive.fp.read(zipfile.sizeFileHeader))
+    archive.fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                    header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    return archive.fp.read(zinfo.compress_size)
+
+
+def write_raw_entry(archive, zinfo, data):
+    '''Write an entry with compressed ``data`` to ``archive``'''
+    zinfo.header_offset = archive.fp.tell()
+    archive._writecheck(zinfo)
+    archive._didModify = True
+    archive.fp.write(zinfo.FileHeader())
+    archive.fp.write(data)
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+    if hasattr(archive, 'start_dir'):
+        archive.start_dir = archive.fp.tell()
+
+
+def write_zip(path, target_file, prefix, jobs=COMPRESS_JOBS, batch_size=64):
+    '''
+    Write the tree at ``path`` to the zip file ``target_file``
+
+    Files are compressed ``jobs`` at a time and written to the archive in
+    batches of ``batch_size``, so only a batch is held in memory. Files that
+    are compressed already are stored as is. Entries of files that didn't
+    change since the archive at ``target_file`` was written, according to its
+    manifest, are copied from it without compressing them again. The new
+    archive replaces the previous one atomically.
+
+    Without :py:data:`RAW_ZIP_ENTRIES`, files are compressed one at a time by
+    :py:mod:`zipfile`, and no entries are reused.
+
+    :param prefix: Directory in the archive to put the files in
+    :returns: tuple of the number of entries compressed and reused
+    '''
+    manifest_file = zip_manifest_path(target_file)
+    previous = None
+    reusable = {}
+    if RAW_ZIP_ENTRIES and os.path.exists(target_file):
+        reusable = read_manifest(manifest_file) or {}
+    if reusable:
+        try:
+            previous = zipfile.ZipFile(target_file, 'r')
+            # Only trust the manifest for entries the archive has
+            sizes = dict((zinfo.filename, zinfo.file_size)
+                         for zinfo in previous.infolist())
+            reusable = dict((name, entry) for (name, entry) in reusable.items()
+                            if sizes.get(name) == entry[0])
+        except (zipfile.BadZipfile, IOError):
+            log.warning('Not reusing broken zip file %s' % target_file)
+            previous = None
+            reusable = {}
+
+    files = []
+    for (root, dirs, filenames) in os.walk(path):
+        dirs.sort()
+        for filename in sorted(filenames):
+            full_path = os.path.join(root, filename)
+            files.append((full_path, os.path.join(
+                prefix, os.path.relpath(full_path, path))))
+
+    def compress(args):
+        return compress_zip_entry(*args, reusable=reusable)
+
+    tmp_file = '%s.%s.tmp' % (target_file, os.getpid())
+    manifest = {}
+    compressed = 0
+    reused = 0
+    pool = ThreadPool(processes=max(1, jobs))
+    try:
+        archive = zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            if RAW_ZIP_ENTRIES:
+                for start in range(0, len(files), batch_size):
+                    entries = pool.map(compress,
+                                       files[start:start + batch_size])
+                    for (zinfo, data, entry) in entries:
+                        if data is None:
+                            old = previous.getinfo(zinfo.filename)
+                            data = read_raw_entry(previous, old)
+                            zinfo.CRC = old.CRC
+                            zinfo.compress_type = old.compress_type
+                            zinfo.compress_size = old.compress_size
+                            reused += 1
+                        else:
+                            compressed += 1
+                        write_raw_entry(archive, zinfo, data)
+                        manifest[zinfo.filename] = entry
+            else:
+                for (full_path, arcname) in files:
+                    if arcname.lower().endswith(STORED_EXTENSIONS):
+                        archive.write(full_path, arcname, zipfile.ZIP_STORED)
+                    else:
+                        archive.write(full_path, arcname)
+                    manifest[arcname] = [os.path.getsize(full_path),
+                                         hash_file(full_path)]
+                    compressed += 1
+        finally:
+            archive.close()
+        # The manifest of the previous archive doesn't describe the new one
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        os.rename(tmp_file, target_file)
+        write_manifest(manifest_file, manifest)
+    finally:
+        pool.close()
+        pool.join()
+        if previous is not None:
+            previous.close()
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    log.info('Wrote %s: %s entries compressed, %s reused' %
+             (target_file, compressed, reused))
+    return (compressed, reused)
@@ -1,5 +1,7 @@
 '''Doc build constants'''
 
+import os
+
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
@@ -12,3 +14,26 @@ DOCKER_LIMITS.update(getattr(settings, 'DOCKER_LIMITS', {}))
 
 DOCKER_TIMEOUT_EXIT_CODE = 42
 DOCKER_OOM_EXIT_CODE = 137
+
+VENV_CACHE_ENABLE = getattr(settings, 'VENV_CACHE_ENABLE', False)
+VENV_CACHE_ROOT = getattr(settings, 'VENV_CACHE_ROOT',
+                          os.path.join(settings.SITE_ROOT, 'venv_cache'))
+VENV_CACHE_SIZE = getattr(settings, 'VENV_CACHE_SIZE', 10 * 1024 ** 3)
+
+BUILD_LOG_CHUNK_SIZE = getattr(settings, 'BUILD_LOG_CHUNK_SIZE', 64 * 1024)
+
+DOCKER_POOL_SIZE = getattr(settings, 'DOCKER_POOL_SIZE', 0)
+DOCKER_POOL_MAX_USES = getattr(settings, 'DOCKER_POOL_MAX_USES', 10)
+DOCKER_POOL_MAX_IDLE = getattr(settings, 'DOCKER_POOL_MAX_IDLE', 60 * 60)
+DOCKER_POOL_LOCK = getattr(settings, 'DOCKER_POOL_LOCK',
+                           os.path.join(settings.SITE_ROOT, 'docker_pool.lock'))
+
+BUILD_LOG_FLUSH_INTERVAL = getattr(settings, 'BUILD_LOG_FLUSH_INTERVAL', 5)
+BUILD_OUTPUT_LIMIT = getattr(settings, 'BUILD_OUTPUT_LIMIT', 1024 * 1024)
+
+COMPRESS_ARTIFACTS = getattr(settings, 'COMPRESS_ARTIFACTS', False)
+COMPRESS_BROTLI = getattr(settings, 'COMPRESS_BROTLI', False)
+COMPRESS_MIN_SIZE = getattr(settings, 'COMPRESS_MIN_SIZE', 1024)
+COMPRESS_JOBS = getattr(settings, 'COMPRESS_JOBS', 4)
+COMPRESS_EXTENSIONS = getattr(settings, 'COMPRESS_EXTENSIONS', (
+    '.html', '.css', '.js', '.json', '.svg', '.txt', '.xml'))
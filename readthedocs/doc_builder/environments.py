@@ -5,12 +5,18 @@ Documentation Builder Environments
 import os
 import re
 import sys
+import time
 import logging
+import threading
 import subprocess
 import traceback
 import datetime
 import socket
+import codecs
+from collections import deque
+from contextlib import contextmanager
 
+from django.utils.encoding import force_text
 from django.utils.text import slugify
 from django.utils.translation import ugettext_lazy as _
 from docker import Client
@@ -20,16 +26,122 @@ from docker.errors import APIError as DockerAPIError, DockerException
 from readthedocs.builds.constants import BUILD_STATE_FINISHED
 from readthedocs.projects.constants import LOG_TEMPLATE
 from readthedocs.api.client import api as api_v1
+from readthedocs.restapi.client import api as api_v2
 
 from .exceptions import (BuildEnvironmentException, BuildEnvironmentError,
                          BuildEnvironmentWarning)
 from .constants import (DOCKER_SOCKET, DOCKER_VERSION, DOCKER_IMAGE,
                         DOCKER_LIMITS, DOCKER_TIMEOUT_EXIT_CODE,
-                        DOCKER_OOM_EXIT_CODE)
+                        DOCKER_OOM_EXIT_CODE, DOCKER_POOL_SIZE,
+                        BUILD_LOG_CHUNK_SIZE, BUILD_LOG_FLUSH_INTERVAL,
+                        BUILD_OUTPUT_LIMIT)
+from .pool import DockerContainerPool
 
 log = logging.getLogger(__name__)
 
 
+def cpu_time(children=False):
+    '''CPU time used by this process, or by its finished child processes'''
+    times = os.times()
+    if children:
+        return times[2] + times[3]
+    return sum(times[:4])
+
+
+class ChildCPUTimer(object):
+    '''CPU time used by a single child process
+
+    The operating system only reports the CPU time of finished child
+    processes as a total, so the CPU time of one child can only be told apart
+    from the total while no other child runs alongside it. When commands
+    overlap, :py:meth:`stop` returns ``None`` instead of a wrong figure.
+    '''
+
+    lock = threading.Lock()
+    running = 0
+    started = 0
+
+    def start(self):
+        with self.lock:
+            self.overlapped = ChildCPUTimer.running > 0
+            ChildCPUTimer.running += 1
+            ChildCPUTimer.started += 1
+            self.started = ChildCPUTimer.started
+            self.start_time = cpu_time(children=True)
+
+    def stop(self):
+        with self.lock:
+            ChildCPUTimer.running -= 1
+            if self.overlapped or ChildCPUTimer.started != self.started:
+                return None
+            return cpu_time(children=True) - self.start_time
+
+
+class CommandOutput(object):
+    '''Output of a command, decoded incrementally as it is read
+
+    Only the first and the last ``limit / 2`` characters of output are
+    retained, output in between is dropped and replaced with a note of how
+    much was dropped. Each decoded piece of output is passed to ``callback``
+    as it arrives, before any of it is dropped.
+
+    :param limit: number of characters to retain, or ``None`` to keep all
+    :param callback: called with each decoded piece of output
+    '''
+
+    def __init__(self, limit=BUILD_OUTPUT_LIMIT, callback=None):
+        self.limit = limit
+        self.callback = callback
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.head = []
+        self.head_size = 0
+        self.tail = deque()
+        self.tail_size = 0
+        self.dropped = 0
+
+    def write(self, data, final=False):
+        '''Add a chunk of raw output'''
+        text = self.decoder.decode(data, final)
+        if not text:
+            return
+        if self.callback is not None:
+            self.callback(text)
+        if not self.limit:
+            self.head.append(text)
+            return
+        head_room = self.limit // 2 - self.head_size
+        if head_room > 0:
+            self.head.append(text[:head_room])
+            self.head_size += len(text[:head_room])
+            text = text[head_room:]
+        if not text:
+            return
+        self.tail.append(text)
+        self.tail_size += len(text)
+        tail_limit = self.limit - self.limit // 2
+        while self.tail_size > tail_limit:
+            excess = self.tail_size - tail_limit
+            first = self.tail[0]
+            if len(first) <= excess:
+                self.tail.popleft()
+                excess = len(first)
+            else:
+                self.tail[0] = first[excess:]
+            self.tail_size -= excess
+            self.dropped += excess
+
+    def close(self):
+        '''Decode any output left over from an incomplete character'''
+        self.write(b'', final=True)
+
+    def getvalue(self):
+        output = u''.join(self.head)
+        if self.dropped:
+            output += (u'\n\n[{0} characters of output omitted]\n\n'
+                       .format(self.dropped))
+        return output + u''.join(self.tail)
+
+
 class BuildCommand(object):
     '''Wrap command execution for execution in build environments
 
@@ -42,6 +154,8 @@ class BuildCommand(object):
     :param environment: environment variables to add to environment
     '''
 
+    read_size = 8192
+
     # TODO add short name here for reporting
     def __init__(self, command, cwd=None, shell=False, environment=None,
                  combine_output=True, input_data=None, build_env=None,
@@ -61,6 +175,8 @@ class BuildCommand(object):
         self.input_data = input_data
         self.output = None
         self.error = None
+        self.wall_time = None
+        self.cpu_time = None
 
     def __str__(self):
         # TODO do we want to expose the full command here?
@@ -72,6 +188,9 @@ class BuildCommand(object):
     def run(self):
         '''Set up subprocess and execute command
 
+        Output is read as the command runs and sent to the build log, only the
+        start and the end of the output is kept, see :py:class:`CommandOutput`.
+
         :param cmd_input: input to pass to command in STDIN
         :type cmd_input: str
         :param combine_output: combine STDERR into STDOUT
@@ -98,6 +217,9 @@ class BuildCommand(object):
             env_paths.insert(0, self.bin_path)
             environment['PATH'] = ':'.join(env_paths)
 
+        start_time = time.time()
+        cpu_timer = ChildCPUTimer()
+        cpu_timer.start()
         try:
             proc = subprocess.Popen(
                 self.command,
@@ -108,25 +230,58 @@ class BuildCommand(object):
                 stderr=stderr,
                 env=environment,
             )
-            cmd_input = None
             if self.input_data is not None:
-                cmd_input = self.input_data
-
-            cmd_output = proc.communicate(input=cmd_input)
-            (cmd_stdout, cmd_stderr) = cmd_output
-            try:
-                self.output = cmd_stdout.decode('utf-8', 'replace')
-            except (TypeError, AttributeError):
-                self.output = None
-            try:
-                self.error = cmd_stderr.decode('utf-8', 'replace')
-            except (TypeError, AttributeError):
-                self.error = None
+                writer = threading.Thread(target=self.write_input,
+                                          args=(proc.stdin,))
+                writer.daemon = True
+                writer.start()
+
+            error = None
+            if not self.combine_output:
+                error = CommandOutput()
+                reader = threading.Thread(target=self.read_output,
+                                          args=(proc.stderr, error))
+                reader.daemon = True
+                reader.start()
+            output = CommandOutput(callback=self.log_output)
+            self.read_output(proc.stdout, output)
+            if error is not None:
+                reader.join()
+                self.error = error.getvalue()
+            self.output = output.getvalue()
+            proc.wait()
             self.status = proc.returncode
         except OSError:
             self.error = traceback.format_exc()
             self.output = self.error
+            self.log_output(self.output)
             self.status = -1
+        self.wall_time = time.time() - start_time
+        self.cpu_time = cpu_timer.stop()
+
+    def write_input(self, stream):
+        try:
+            stream.write(self.input_data)
+        except IOError:
+            pass
+        finally:
+            stream.close()
+
+    def read_output(self, stream, output):
+        '''Read ``stream`` into ``output`` as lines arrive
+
+        Lines are read at most :py:attr:`read_size` bytes at a time, so an
+        overly long line doesn't have to be held in memory whole.
+        '''
+        for data in iter(lambda: stream.readline(self.read_size), b''):
+            output.write(data)
+        output.close()
+        stream.close()
+
+    def log_output(self, output):
+        '''Add output to the build log while the command runs'''
+        if self.build_env is not None:
+            self.build_env.append_log(output)
 
     def get_command(self):
         '''Flatten command'''
@@ -157,6 +312,8 @@ class DockerBuildCommand(BuildCommand):
     def run(self):
         '''Execute command in existing Docker container
 
+        Output is streamed from the container as the command runs.
+
         :param cmd_input: input to pass to command in STDIN
         :type cmd_input: str
         :param combine_output: combine STDERR into STDOUT
@@ -165,6 +322,7 @@ class DockerBuildCommand(BuildCommand):
                  self.build_env.container_id, self.get_command(), self.cwd)
 
         client = self.build_env.get_client()
+        start_time = time.time()
         try:
             exec_cmd = client.exec_create(
                 container=self.build_env.container_id,
@@ -173,11 +331,14 @@ class DockerBuildCommand(BuildCommand):
                 stderr=True
             )
 
-            output = client.exec_start(exec_id=exec_cmd['Id'], stream=False)
+            output = CommandOutput(callback=self.log_output)
             try:
-                self.output = output.decode('utf-8', 'replace')
-            except (TypeError, AttributeError):
-                self.output = ''
+                for data in client.exec_start(exec_id=exec_cmd['Id'],
+                                              stream=True):
+                    output.write(data)
+            finally:
+                output.close()
+                self.output = output.getvalue()
             cmd_ret = client.exec_inspect(exec_id=exec_cmd['Id'])
             self.status = cmd_ret['ExitCode']
 
@@ -187,10 +348,14 @@ class DockerBuildCommand(BuildCommand):
                     self.output == 'Killed\n'):
                 self.output = _('Command killed due to excessive memory '
                                 'consumption\n')
+                self.log_output(self.output)
         except DockerAPIError:
             self.status = -1
             if self.output is None or not self.output:
                 self.output = _('Command exited abnormally')
+                self.log_output(self.output)
+        # CPU time is spent inside the container, where we can't measure it
+        self.wall_time = time.time() - start_time
 
     def get_wrapped_command(self):
         """Escape special bash characters in command to wrap in shell
@@ -230,6 +395,15 @@ class BuildEnvironment(object):
         self.commands = []
         self.failure = None
         self.start_time = datetime.datetime.utcnow()
+        self.log_buffer = []
+        self.log_buffer_size = 0
+        self.log_offset = 0
+        self.log_flushed = time.time()
+        self.log_lock = threading.Lock()
+        self.clock_start = time.time()
+        self.phases = []
+        self.phases_sent = 0
+        self.phase_stack = threading.local()
 
     def __enter__(self):
         return self
@@ -277,7 +451,21 @@ class BuildEnvironment(object):
         kwargs['build_env'] = self
         cmd = self.command_class(cmd, **kwargs)
         self.commands.append(cmd)
+        self.append_log(u'{0}\n'.format(
+            force_text(cmd.get_command(), errors='replace')))
+        start = time.time() - self.clock_start
         cmd.run()
+        self.phases.append({
+            'type': 'command',
+            'name': force_text(cmd.get_command(), errors='replace')[:255],
+            'phase': self.current_phase or '',
+            'start': start,
+            'wall_time': cmd.wall_time,
+            'cpu_time': cmd.cpu_time,
+        })
+        # Output was added to the log by the command as it ran
+        if cmd.output:
+            self.append_log(u'\n')
         if cmd.failed:
             msg = u'Command {cmd} failed'.format(cmd=cmd.get_command())
 
@@ -293,6 +481,52 @@ class BuildEnvironment(object):
                 raise BuildEnvironmentError(msg)
         return cmd
 
+    @property
+    def current_phase(self):
+        '''Name of the innermost phase running in this thread'''
+        stack = getattr(self.phase_stack, 'names', None)
+        if stack:
+            return stack[-1]
+
+    @contextmanager
+    def phase(self, name):
+        '''Record the wall clock and CPU time spent in a phase of the build
+
+        Phases can be nested, and are tracked per thread. CPU time includes
+        the commands run in the phase, but it is counted for the whole
+        process, so phases running at the same time in other threads are
+        counted too.
+        '''
+        parent = self.current_phase
+        if getattr(self.phase_stack, 'names', None) is None:
+            self.phase_stack.names = []
+        self.phase_stack.names.append(name)
+        start_time = time.time()
+        start_cpu_time = cpu_time()
+        try:
+            yield
+        finally:
+            self.phase_stack.names.pop()
+            self.phases.append({
+                'type': 'phase',
+                'name': name,
+                'phase': parent or '',
+                'start': start_time - self.clock_start,
+                'wall_time': time.time() - start_time,
+                'cpu_time': cpu_time() - start_cpu_time,
+            })
+
+    def flush_phases(self):
+        '''Send the phases recorded since the last update to the API'''
+        phases = self.phases[self.phases_sent:]
+        if not phases:
+            return
+        self.phases_sent += len(phases)
+        try:
+            api_v2.build(self.build['id']).add_phases.post(phases)
+        except Exception:
+            log.error("Unable to record build phases", exc_info=True)
+
     @property
     def successful(self):
         '''Is build completed, without top level failures or failing commands'''
@@ -313,15 +547,84 @@ class BuildEnvironment(object):
         return (self.build is not None and
                 self.build['state'] == BUILD_STATE_FINISHED)
 
+    def append_log(self, output):
+        '''Add ``output`` to the build log
+
+        Output is buffered and sent to the API in chunks of
+        :py:data:`BUILD_LOG_CHUNK_SIZE` characters, so each piece of output is
+        only sent once. Output short of a full chunk is sent too, if none was
+        sent for :py:data:`BUILD_LOG_FLUSH_INTERVAL` seconds, so the log keeps
+        up with commands that run for a long time.
+        '''
+        if not self.record or not output:
+            return
+        output = force_text(output, errors='replace')
+        with self.log_lock:
+            self.log_buffer.append(output)
+            self.log_buffer_size += len(output)
+            if time.time() - self.log_flushed >= BUILD_LOG_FLUSH_INTERVAL:
+                chunks = self.take_log_chunks()
+            elif self.log_buffer_size >= BUILD_LOG_CHUNK_SIZE:
+                chunks = self.take_log_chunks(partial=False)
+            else:
+                return
+        self.post_log_chunks(chunks)
+
+    def flush_log(self, partial=True):
+        '''Send buffered build output to the API
+
+        :param partial: also send output short of a full chunk
+        '''
+        with self.log_lock:
+            chunks = self.take_log_chunks(partial=partial)
+        self.post_log_chunks(chunks)
+
+    def take_log_chunks(self, partial=True):
+        '''Remove output to send from the buffer, with the lock held
+
+        Each chunk is assigned its offset in the log here, so output appended
+        by several threads at once is never sent twice or at the same offset.
+
+        :returns: list of tuples of the offset and output of each chunk
+        '''
+        self.log_flushed = time.time()
+        output = u''.join(self.log_buffer)
+        end = len(output)
+        if not partial:
+            end -= end % BUILD_LOG_CHUNK_SIZE
+        self.log_buffer = [output[end:]]
+        self.log_buffer_size = len(output) - end
+        chunks = []
+        for start in range(0, end, BUILD_LOG_CHUNK_SIZE):
+            chunk = output[start:min(start + BUILD_LOG_CHUNK_SIZE, end)]
+            chunks.append((self.log_offset, chunk))
+            self.log_offset += len(chunk)
+        return chunks
+
+    def post_log_chunks(self, chunks):
+        '''Send chunks of output taken from the buffer to the API'''
+        for (offset, chunk) in chunks:
+            try:
+                api_v2.build(self.build['id']).append_log.post({
+                    'offset': offset,
+                    'output': chunk,
+                })
+            except Exception:
+                log.error("Unable to append to the build log", exc_info=True)
+
     def update_build(self, state=None):
         """
         Record a build by hitting the API.
 
+        Output is not sent here, see :py:meth:`append_log`.
+
         Returns nothing
         """
         if not self.record:
             return None
 
+        self.flush_log()
+        self.flush_phases()
         self.build['builder'] = socket.gethostname()
         self.build['state'] = state
         if self.done:
@@ -337,22 +640,24 @@ class BuildEnvironment(object):
                                                for cmd in self.commands])
 
         self.build['setup'] = self.build['setup_error'] = ""
-        self.build['output'] = self.build['error'] = ""
+        # Leave output and errors untouched, output is stored as log chunks
+        # and errors are only reported once the build is done.
+        self.build.pop('output', None)
+        self.build.pop('error', None)
+        # Triggers are merged into the build on the web servers
+        self.build.pop('merged_triggers', None)
 
         if self.start_time:
             build_length = (datetime.datetime.utcnow() - self.start_time)
             self.build['length'] = build_length.total_seconds()
 
-        # TODO Replace this with per-command output tracking in the db
-        self.build['output'] = '\n'.join([str(cmd)
-                                          for cmd in self.commands
-                                          if cmd is not None])
-        errors = []
-        if self.failure is not None:
-            errors.append(str(self.failure))
-        errors.extend([str(cmd) for cmd in self.commands
-                       if cmd is not None and cmd.failed])
-        self.build['error'] = '\n'.join(errors)
+        if self.done:
+            errors = []
+            if self.failure is not None:
+                errors.append(str(self.failure))
+            errors.extend([str(cmd) for cmd in self.commands
+                           if cmd is not None and cmd.failed])
+            self.build['error'] = '\n'.join(errors)
 
         # Attempt to stop unicode errors on build reporting
         for key, val in self.build.items():
@@ -382,6 +687,11 @@ class DockerEnvironment(BuildEnvironment):
     machine, walling off project builds from reading/writing other projects'
     data.
 
+    With :py:data:`settings.DOCKER_POOL_SIZE` set, started containers are
+    leased from a :py:class:`DockerContainerPool` instead, and returned to it
+    once the build is finished. The time limit is then enforced by a timer
+    here, rather than by the container itself.
+
     :param docker_socket: Override to Docker socket URI
     '''
     command_class = DockerBuildCommand
@@ -395,6 +705,8 @@ class DockerEnvironment(BuildEnvironment):
         self.client = None
         self.container = None
         self.container_name = None
+        self.container_timer = None
+        self.pool = None
         if self.version:
             self.container_name = slugify(unicode(self.version))
 
@@ -438,24 +750,34 @@ class DockerEnvironment(BuildEnvironment):
         '''End of environment context'''
         ret = self.handle_exception(exc_type, exc_value, tb)
 
+        if self.container_timer is not None:
+            self.container_timer.cancel()
+
         # Update buildenv state given any container error states first
         self.update_build_from_container_state()
 
         client = self.get_client()
-        try:
-            client.kill(self.container_id)
-        except DockerAPIError:
-            pass
-        try:
-            log.info('Removing container %s', self.container_id)
-            client.remove_container(self.container_id)
-        except DockerAPIError:
-            log.error(LOG_TEMPLATE
-                      .format(
-                          project=self.project.slug,
-                          version=self.version.slug,
-                          msg="Couldn't remove container"),
-                      exc_info=True)
+        if self.pool is not None and self.container is not None:
+            # The build isn't finished yet, so check for failures directly
+            recycle = (self.failure is None and
+                       all(cmd.successful for cmd in self.commands))
+            self.pool.release(self.container, self.container_id,
+                              recycle=recycle)
+        else:
+            try:
+                client.kill(self.container_id)
+            except DockerAPIError:
+                pass
+            try:
+                log.info('Removing container %s', self.container_id)
+                client.remove_container(self.container_id)
+            except DockerAPIError:
+                log.error(LOG_TEMPLATE
+                          .format(
+                              project=self.project.slug,
+                              version=self.version.slug,
+                              msg="Couldn't remove container"),
+                          exc_info=True)
 
         self.container = None
         self.update_build(state=BUILD_STATE_FINISHED)
@@ -524,6 +846,8 @@ class DockerEnvironment(BuildEnvironment):
     def create_container(self):
         '''Create docker container'''
         client = self.get_client()
+        if DOCKER_POOL_SIZE:
+            return self.lease_container()
         try:
             self.container = client.create_container(
                 image=self.container_image,
@@ -550,3 +874,26 @@ class DockerEnvironment(BuildEnvironment):
                           msg=e.explanation),
                       exc_info=True)
             raise BuildEnvironmentError('Build environment creation failed')
+
+    def lease_container(self):
+        '''Lease a started container from the pool'''
+        self.pool = DockerContainerPool(client=self.get_client(),
+                                        image=self.container_image,
+                                        mem_limit=self.container_mem_limit,
+                                        size=DOCKER_POOL_SIZE)
+        try:
+            self.container = self.pool.lease(self.container_id,
+                                             self.project.doc_path)
+        except DockerAPIError as e:
+            log.error(LOG_TEMPLATE
+                      .format(
+                          project=self.project.slug,
+                          version=self.version.slug,
+                          msg=e.explanation),
+                      exc_info=True)
+            raise BuildEnvironmentError('Build environment creation failed')
+        self.container_timer = threading.Timer(
+            self.container_time_limit, self.pool.expire,
+            args=[self.container_id])
+        self.container_timer.daemon = True
+        self.container_timer.start()
@@ -0,0 +1,246 @@
+'''
+Pool of reusable Docker build containers
+'''
+
+import fcntl
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+from docker.utils import create_host_config
+from docker.errors import APIError as DockerAPIError
+
+from .constants import (DOCKER_TIMEOUT_EXIT_CODE, DOCKER_POOL_SIZE,
+                        DOCKER_POOL_MAX_USES, DOCKER_POOL_MAX_IDLE,
+                        DOCKER_POOL_LOCK)
+
+log = logging.getLogger(__name__)
+
+LABEL_POOL = 'org.readthedocs.pool'
+LABEL_MEM_LIMIT = 'org.readthedocs.pool.mem_limit'
+LABEL_PATH = 'org.readthedocs.pool.path'
+
+IDLE_PREFIX = 'rtd-pool-'
+
+
+class DockerContainerPool(object):
+    '''
+    Started build containers, kept around to be reused by later builds
+
+    Binds can't be added to a running container, so pooled containers are
+    created with the path of a project bind mounted, and are only reused by
+    builds of that project. Mounting a parent of all projects instead would
+    let a build read and write the files of other projects. The pool only
+    saves container start up for projects built again within ``max_idle``
+    seconds, so up to ``size`` idle containers are kept per project, rather
+    than per image, and a build of one project doesn't evict the containers of
+    another. Idle containers of all projects are only bounded by ``max_idle``.
+
+    Leased containers are renamed to the name of the build's container, and
+    renamed back to an idle name on release. Idle containers are recycled
+    until they have been used ``max_uses`` times. Containers sharing a Docker
+    daemon share the pool, leasing is serialized with a lock file.
+
+    Pooled containers don't exit on their own after the time limit. Instead,
+    their main process exits with :py:data:`DOCKER_TIMEOUT_EXIT_CODE` when the
+    container is sent ``SIGTERM``, see :py:meth:`expire`.
+
+    :param client: Docker client
+    :param image: Image to create containers from
+    :param mem_limit: Memory limit of containers
+    '''
+
+    command = ('/bin/sh -c "trap \'exit {exit}\' TERM; '
+               'while true; do sleep 1; done"'
+               .format(exit=DOCKER_TIMEOUT_EXIT_CODE))
+
+    def __init__(self, client, image, mem_limit, size=DOCKER_POOL_SIZE,
+                 max_uses=DOCKER_POOL_MAX_USES, max_idle=DOCKER_POOL_MAX_IDLE,
+                 lock_path=DOCKER_POOL_LOCK):
+        self.client = client
+        self.image = image
+        self.mem_limit = mem_limit
+        self.size = size
+        self.max_uses = max_uses
+        self.max_idle = max_idle
+        self.lock_path = lock_path
+
+    @contextmanager
+    def lock(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def idle_name(uses, released=None):
+        if released is None:
+            released = time.time()
+        return '{prefix}{uses}-{released}-{id}'.format(
+            prefix=IDLE_PREFIX, uses=uses, released=int(released),
+            id=uuid.uuid4().hex[:8])
+
+    @staticmethod
+    def parse_idle_name(name):
+        '''Return the uses and release time from an idle container name'''
+        (uses, released, _) = name[len(IDLE_PREFIX):].split('-')
+        return (int(uses), int(released))
+
+    def labels(self, path=None):
+        labels = {LABEL_POOL: self.image, LABEL_MEM_LIMIT: str(self.mem_limit)}
+        if path is not None:
+            labels[LABEL_PATH] = path
+        return labels
+
+    def idle(self, path=None):
+        '''Idle containers, most recently released first
+
+        :param path: Only list containers with this path mounted
+        :returns: list of ``(name, uses, released, path)`` tuples
+        '''
+        filters = {'label': ['{0}={1}'.format(key, value)
+                             for (key, value) in self.labels(path).items()]}
+        idle = []
+        for container in self.client.containers(all=True, filters=filters):
+            labels = container.get('Labels') or {}
+            for name in container.get('Names') or []:
+                name = name.lstrip('/')
+                if name.startswith(IDLE_PREFIX):
+                    (uses, released) = self.parse_idle_name(name)
+                    idle.append((name, uses, released,
+                                 labels.get(LABEL_PATH, path)))
+        return sorted(idle, key=lambda container: container[2], reverse=True)
+
+    def is_running(self, name):
+        try:
+            info = self.client.inspect_container(name)
+            return info.get('State', {}).get('Running') is True
+        except DockerAPIError:
+            return False
+
+    def lease(self, name, path):
+        '''Lease a started container with ``path`` bind mounted
+
+        An idle container is reused if there is one, otherwise a new container
+        is started.
+
+        :param name: Name to give the leased container
+        :param path: Path to bind mount
+        :returns: container info, with the number of times it was used before
+        '''
+        with self.lock():
+            self.trim()
+            for (idle_name, uses, _, _) in self.idle(path):
+                if not self.is_running(idle_name):
+                    log.info('Removing stale container %s', idle_name)
+                    self.destroy(idle_name)
+                    continue
+                try:
+                    self.client.rename(idle_name, name)
+                except DockerAPIError:
+                    log.warning('Unable to lease container %s', idle_name,
+                                exc_info=True)
+                    continue
+                log.info('Leased container %s as %s', idle_name, name)
+                container = self.client.inspect_container(name)
+                return {'Id': container.get('Id'), 'Uses': uses}
+            container = self.create(name, path)
+            return {'Id': container.get('Id'), 'Uses': 0}
+
+    def release(self, container, name, recycle=True):
+        '''Return a leased container to the pool, or destroy it
+
+        Containers are only recycled if ``recycle`` is true, the container is
+        still running, and it hasn't reached the limit on uses. Processes left
+        behind by the build are killed before the container goes idle. A
+        container destroyed after reaching its limit on uses is replaced with a
+        fresh one, so the project keeps a warm container.
+
+        :param container: container info returned by :py:meth:`lease`
+        :param name: Name of the leased container
+        :param recycle: Whether the container may be reused
+        :returns: whether the container was recycled
+        '''
+        uses = container.get('Uses', 0) + 1
+        with self.lock():
+            if recycle and self.is_running(name):
+                path = self.client.inspect_container(name).get(
+                    'Config', {}).get('Labels', {}).get(LABEL_PATH)
+                if uses < self.max_uses:
+                    try:
+                        exec_cmd = self.client.exec_create(
+                            container=name, cmd="/bin/sh -c 'kill -9 -1'")
+                        self.client.exec_start(exec_id=exec_cmd['Id'])
+                        self.client.rename(name, self.idle_name(uses))
+                        log.info('Recycled container %s', name)
+                        self.trim()
+                        return True
+                    except DockerAPIError:
+                        log.warning('Unable to recycle container %s', name,
+                                    exc_info=True)
+                    self.destroy(name)
+                else:
+                    self.destroy(name)
+                    if (path is not None and
+                            len(self.idle(path)) < self.size):
+                        try:
+                            self.create(self.idle_name(0), path)
+                        except DockerAPIError:
+                            log.warning('Unable to replace container %s',
+                                        name, exc_info=True)
+                return False
+            self.destroy(name)
+            return False
+
+    def create(self, name, path):
+        '''Create and start a pooled container'''
+        container = self.client.create_container(
+            image=self.image,
+            command=self.command,
+            name=name,
+            hostname=name,
+            host_config=create_host_config(binds={
+                path: {
+                    'bind': path,
+                    'mode': 'rw'
+                }
+            }),
+            detach=True,
+            mem_limit=self.mem_limit,
+            labels=self.labels(path),
+        )
+        self.client.start(container=name)
+        return container
+
+    def destroy(self, name):
+        try:
+            self.client.kill(name)
+        except DockerAPIError:
+            pass
+        try:
+            log.info('Removing container %s', name)
+            self.client.remove_container(name)
+        except DockerAPIError:
+            log.error("Couldn't remove container %s", name, exc_info=True)
+
+    def expire(self, name):
+        '''Stop a leased container for running past the time limit'''
+        try:
+            self.client.kill(name, signal='SIGTERM')
+        except DockerAPIError:
+            log.warning("Couldn't expire container %s", name, exc_info=True)
+
+    def trim(self):
+        '''Remove idle containers past the idle time, or past the pool size
+
+        The pool size is applied to the containers of each project.
+        '''
+        now = time.time()
+        counts = {}
+        for (name, _, released, path) in self.idle():
+            counts[path] = counts.get(path, 0) + 1
+            if counts[path] > self.size or now - released > self.max_idle:
+                self.destroy(name)
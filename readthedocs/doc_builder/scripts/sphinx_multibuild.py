@@ -0,0 +1,56 @@
+'''
+Write several Sphinx output formats from a single process
+
+This script is copied into the project's build directory and run with the
+project's virtualenv, so it can only depend on Sphinx and the standard library.
+Each format gets a Sphinx application of its own, which loads ``conf.py``, the
+extensions and the pickled environment again, just like a separate
+``sphinx-build`` run would. The only saving over running ``sphinx-build`` once
+per format is starting the interpreter and importing Sphinx once. Only the
+public ``Sphinx`` API is used, so this works with any Sphinx version
+``sphinx-build`` does.
+
+Usage::
+
+    python sphinx_multibuild.py <doctrees> <language> <fresh env> <results> \
+        <formats>
+
+Where ``formats`` is a JSON list of ``[name, builder, output dir]`` lists.
+The success of each format is written to ``results`` as a JSON object keyed on
+format name.
+'''
+
+import json
+import os
+import sys
+import traceback
+
+from sphinx.application import Sphinx
+
+
+def main(doctrees, language, freshenv, results_path, formats):
+    results = {}
+    for (name, builder, outdir) in json.loads(formats):
+        try:
+            app = Sphinx(
+                srcdir=os.path.abspath('.'),
+                confdir=os.path.abspath('.'),
+                outdir=os.path.abspath(outdir),
+                doctreedir=os.path.abspath(doctrees),
+                buildername=builder,
+                confoverrides={'language': language},
+                # Only the first builder starts from a fresh environment
+                freshenv=(freshenv == '1' and not results),
+            )
+            app.build()
+            results[name] = (app.statuscode == 0)
+        except Exception:
+            traceback.print_exc()
+            results[name] = False
+    with open(results_path, 'w') as results_file:
+        json.dump(results, results_file)
+    return 0 if all(results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:]))
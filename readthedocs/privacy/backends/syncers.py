@@ -2,6 +2,7 @@ import getpass
 import logging
 import os
 import shutil
+import tempfile
 
 from django.conf import settings
 
@@ -14,6 +15,9 @@ class LocalSyncer(object):
     def copy(cls, path, target, file=False, **kwargs):
         """
         A copy command that works with files or directories.
+
+        Directories are published as a new release, see
+        :py:func:`readthedocs.core.utils.publish.publish`.
         """
         log.info("Local Copy %s to %s" % (path, target))
         if file:
@@ -24,9 +28,8 @@ class LocalSyncer(object):
                 os.remove(target)
             shutil.copy2(path, target)
         else:
-            if os.path.exists(target):
-                shutil.rmtree(target)
-            shutil.copytree(path, target)
+            from readthedocs.core.utils.publish import publish
+            publish(path, target)
 
 
 class RemoteSyncer(object):
@@ -36,22 +39,84 @@ class RemoteSyncer(object):
         """
         A better copy command that works with files or directories.
 
-        Respects the ``MULTIPLE_APP_SERVERS`` setting when copying.
+        Respects the ``MULTIPLE_APP_SERVERS`` setting when copying, copying to
+        all app servers at once.
+
+        Directories published as a release are copied as a delta: only the
+        files that changed since the manifest last copied to a server are sent,
+        and the files removed since are deleted. A marker kept next to the copy
+        on the server names the manifest copied last, the delta is only sent
+        when it names the manifest the delta is against. Servers without a
+        known manifest, with another marker, or where copying the delta failed,
+        get the whole tree.
+
+        :returns: list of :py:class:`ServerResult`, one for each app server
         """
+        from readthedocs.core.utils.publish import (
+            current_manifest, diff_manifests, manifest_digest, read_manifest,
+            sync_marker_path, synced_manifest_path, write_manifest)
+        from readthedocs.core.utils.servers import run_on_servers
+
         sync_user = getattr(settings, 'SYNC_USER', getpass.getuser())
         app_servers = getattr(settings, 'MULTIPLE_APP_SERVERS', [])
-        if app_servers:
-            log.info("Remote Copy %s to %s" % (path, target))
+        if not app_servers:
+            return []
+        log.info("Remote Copy %s to %s" % (path, target))
+        if file:
+            slash = ""
+            manifest = None
+        else:
+            slash = "/"
+            manifest = current_manifest(path)
+        marker = sync_marker_path(target)
+
+        synced_digests = {}
+        if manifest is not None:
             for server in app_servers:
-                mkdir_cmd = ("ssh %s@%s mkdir -p %s" % (sync_user, server, target))
-                ret = os.system(mkdir_cmd)
-                if ret != 0:
-                    log.info("COPY ERROR to app servers:")
-                    log.info(mkdir_cmd)
-                if file:
-                    slash = ""
-                else:
-                    slash = "/"
+                synced = read_manifest(
+                    synced_manifest_path(path, server, target))
+                if synced is not None:
+                    synced_digests[server] = (synced, manifest_digest(synced))
+
+        def check_commands(server):
+            # Remove the marker as well, the copy is in doubt until the delta
+            # was copied
+            return [
+                "ssh {user}@{server} 'test \"$(cat {marker} 2>/dev/null)\" = "
+                "{digest} && rm -f {marker}'".format(
+                    user=sync_user, server=server, marker=marker,
+                    digest=synced_digests[server][1])]
+
+        file_lists = {}
+        if synced_digests:
+            for result in run_on_servers(synced_digests, check_commands,
+                                         retries=0):
+                if not result.successful:
+                    log.info("Copy on %s changed, copying all files",
+                             result.server)
+                    continue
+                (changed, deleted) = diff_manifests(
+                    synced_digests[result.server][0], manifest)
+                (fd, file_list) = tempfile.mkstemp(prefix='rtd-sync-')
+                with os.fdopen(fd, 'w') as fh:
+                    fh.write(''.join('%s\n' % name
+                                     for name in changed + deleted))
+                file_lists[result.server] = file_list
+
+        def commands(server):
+            mkdir_cmd = ("ssh %s@%s mkdir -p %s" % (sync_user, server, target))
+            if server in file_lists:
+                # Files listed but missing from the tree are deleted
+                sync_cmd = (
+                    "rsync -e 'ssh -T' -av --files-from={file_list} "
+                    "--delete-missing-args {path}/ {user}@{server}:{target}"
+                    .format(
+                        file_list=file_lists[server],
+                        path=path,
+                        user=sync_user,
+                        server=server,
+                        target=target))
+            else:
                 # Add a slash when copying directories
                 sync_cmd = (
                     "rsync -e 'ssh -T' -av --delete {path}{slash} {user}@{server}:{target}"
@@ -61,10 +126,48 @@ class RemoteSyncer(object):
                         user=sync_user,
                         server=server,
                         target=target))
-                ret = os.system(sync_cmd)
-                if ret != 0:
-                    log.info("COPY ERROR to app servers.")
-                    log.info(sync_cmd)
+            if manifest is None:
+                return [mkdir_cmd, sync_cmd]
+            if server not in file_lists:
+                mkdir_cmd = "ssh %s@%s 'mkdir -p %s && rm -f %s'" % (
+                    sync_user, server, target, marker)
+            marker_cmd = (
+                "ssh {user}@{server} 'mkdir -p {marker_dir} && "
+                "echo {digest} > {marker}'".format(
+                    user=sync_user,
+                    server=server,
+                    marker_dir=os.path.dirname(marker),
+                    marker=marker,
+                    digest=manifest_digest(manifest)))
+            return [mkdir_cmd, sync_cmd, marker_cmd]
+
+        try:
+            results = run_on_servers(app_servers, commands)
+            failed = [result.server for result in results
+                      if not result.successful and result.server in file_lists]
+            if failed:
+                log.warning("Copying changes failed, copying all files to %s"
+                            % ', '.join(failed))
+                for server in failed:
+                    os.remove(file_lists.pop(server))
+                retried = dict((result.server, result) for result in
+                               run_on_servers(failed, commands))
+                results = [retried.get(result.server, result)
+                           for result in results]
+        finally:
+            for file_list in file_lists.values():
+                os.remove(file_list)
+
+        if manifest is not None:
+            for result in results:
+                synced_path = synced_manifest_path(path, result.server, target)
+                if result.successful:
+                    if not os.path.isdir(os.path.dirname(synced_path)):
+                        os.makedirs(os.path.dirname(synced_path))
+                    write_manifest(synced_path, manifest)
+                elif os.path.exists(synced_path):
+                    os.remove(synced_path)
+        return results
 
 
 class DoubleRemotePuller(object):
@@ -74,24 +177,25 @@ class DoubleRemotePuller(object):
         """
         A better copy command that works from the webs.
 
-        Respects the ``MULTIPLE_APP_SERVERS`` setting when copying.
+        Respects the ``MULTIPLE_APP_SERVERS`` setting when copying, pulling to
+        all app servers at once.
+
+        :returns: list of :py:class:`ServerResult`, one for each app server
         """
         sync_user = getattr(settings, 'SYNC_USER', getpass.getuser())
         app_servers = getattr(settings, 'MULTIPLE_APP_SERVERS', [])
         if not file:
             path += "/"
         log.info("Remote Copy %s to %s" % (path, target))
-        for server in app_servers:
+
+        def commands(server):
+            cmds = []
             if not file:
-                mkdir_cmd = "ssh {user}@{server} mkdir -p {target}".format(
+                cmds.append("ssh {user}@{server} mkdir -p {target}".format(
                     user=sync_user, server=server, target=target
-                )
-                ret = os.system(mkdir_cmd)
-                if ret != 0:
-                    log.info("MKDIR ERROR to app servers:")
-                    log.info(mkdir_cmd)
+                ))
             # Add a slash when copying directories
-            sync_cmd = (
+            cmds.append(
                 "ssh {user}@{server} 'rsync -av --delete {user}@{host}:{path} {target}'"
                 .format(
                     host=host,
@@ -99,10 +203,10 @@ class DoubleRemotePuller(object):
                     user=sync_user,
                     server=server,
                     target=target))
-            ret = os.system(sync_cmd)
-            if ret != 0:
-                log.info("COPY ERROR to app servers.")
-                log.info(sync_cmd)
+            return cmds
+
+        from readthedocs.core.utils.servers import run_on_servers
+        return run_on_servers(app_servers, commands)
 
 
 class RemotePuller(object):
@@ -446,9 +446,27 @@ class Project(models.Model):
     def checkout_path(self, version=LATEST):
         return os.path.join(self.doc_path, 'checkouts', version)
 
+    def mirror_path(self):
+        """
+        The path to the bare mirror of the repository, shared by checkouts
+        """
+        return os.path.join(self.doc_path, 'mirror')
+
+    def submodule_cache_path(self):
+        """
+        The path to the bare repository caching submodules for checkouts
+        """
+        return os.path.join(self.doc_path, 'submodules')
+
     def venv_path(self, version=LATEST):
         return os.path.join(self.doc_path, 'envs', version)
 
+    def doctrees_path(self, version=LATEST):
+        """
+        The path to the Sphinx doctrees kept between incremental builds.
+        """
+        return os.path.join(self.doc_path, 'doctrees', version)
+
     #
     # Paths for symlinks in project doc_path.
     #
@@ -644,21 +662,32 @@ class Project(models.Model):
     def sponsored(self):
         return False
 
-    def vcs_repo(self, version=LATEST):
+    def vcs_repo(self, version=LATEST, **kwargs):
+        """
+        The VCS backend of a version's checkout
+
+        With ``settings.REPO_MIRROR_ENABLE``, checkouts share a mirror of the
+        repository and a cache of its submodules. Keyword arguments are passed
+        on to the backend.
+        """
         backend = backend_cls.get(self.repo_type)
         if not backend:
             repo = None
         else:
             proj = VCSProject(
                 self.name, self.default_branch, self.checkout_path(version), self.clean_repo)
-            repo = backend(proj, version)
+            if getattr(settings, 'REPO_MIRROR_ENABLE', False):
+                kwargs.setdefault('mirror_path', self.mirror_path())
+                kwargs.setdefault('submodule_cache_path',
+                                  self.submodule_cache_path())
+            repo = backend(proj, version, **kwargs)
         return repo
 
     def repo_nonblockinglock(self, version, max_lock_age=5):
         return NonBlockingLock(project=self, version=version, max_lock_age=max_lock_age)
 
-    def repo_lock(self, version, timeout=5, polling_interval=5):
-        return Lock(self, version, timeout, polling_interval)
+    def repo_lock(self, version, timeout=5, polling_interval=1, lease=None):
+        return Lock(self, version, timeout, polling_interval, lease)
 
     def find(self, file, version):
         """
@@ -1,17 +1,202 @@
+import getpass
 import os
 import logging
+import pipes
+from functools import wraps
 
 from django.conf import settings
 import redis
 
-from readthedocs.core.utils import run_on_app_servers
+from readthedocs.core.utils.servers import run_on_servers
 from readthedocs.projects.constants import LOG_TEMPLATE
 from readthedocs.restapi.client import api
 
 log = logging.getLogger(__name__)
 
+# Prefix of the lines listing the symlinks a server has
+APPLIED_PREFIX = 'rtd-symlink:'
 
-def symlink_cnames(version):
+
+class SymlinkPlan(object):
+    """
+    The symlinks of a project, applied to all app servers at once
+
+    Symlinks are added to the plan with :py:meth:`link` and :py:meth:`remove`.
+    :py:meth:`apply` compares the plan with the symlinks each server has, and
+    makes the missing changes with a single command per server. Servers that
+    have all symlinks of the plan are skipped.
+
+    The symlinks on this host are read from the filesystem. The symlinks on
+    ``MULTIPLE_APP_SERVERS`` are read with a single command per server, before
+    changing any of them.
+    """
+
+    def __init__(self, project):
+        self.project = project
+        # Map of symlink to target, an empty target removes the symlink
+        self.links = {}
+
+    def link(self, symlink, target):
+        self.links[symlink] = target
+
+    def remove(self, symlink):
+        self.links[symlink] = ''
+
+    def read_command(self):
+        """
+        Shell command listing the symlinks of the plan a server has
+
+        A line is printed for each symlink, with its target, and for each
+        missing symlink, without a target.
+        """
+        return (
+            'for link in %s; do '
+            'if [ -L "$link" ]; then '
+            'printf \'%s%%s\\t%%s\\n\' "$link" "$(readlink "$link")"; '
+            'elif [ ! -e "$link" ]; then '
+            'printf \'%s%%s\\t\\n\' "$link"; '
+            'fi; done' % (' '.join(sorted(self.links)), APPLIED_PREFIX,
+                          APPLIED_PREFIX))
+
+    @staticmethod
+    def parse_applied(output):
+        """Symlinks listed by :py:meth:`read_command`"""
+        applied = {}
+        for line in (output or '').splitlines():
+            if line.startswith(APPLIED_PREFIX) and '\t' in line:
+                (symlink, target) = line[len(APPLIED_PREFIX):].split('\t', 1)
+                applied[symlink] = target
+        return applied
+
+    def applied(self, servers):
+        """
+        The symlinks of the plan each of ``servers`` has
+
+        :returns: dict of server to a dict of symlink to target, servers that
+            couldn't be read are left out
+        """
+        applied = {}
+        remote = [server for server in servers if server is not None]
+        if None in servers:
+            applied[None] = {}
+            for symlink in self.links:
+                if os.path.islink(symlink):
+                    applied[None][symlink] = os.readlink(symlink)
+                elif not os.path.lexists(symlink):
+                    applied[None][symlink] = ''
+        if remote:
+            sync_user = getattr(settings, 'SYNC_USER', getpass.getuser())
+            script = self.read_command()
+
+            def commands(server):
+                return ['ssh %s@%s %s' % (sync_user, server,
+                                          pipes.quote(script))]
+
+            for result in run_on_servers(remote, commands, retries=0):
+                if result.successful:
+                    applied[result.server] = self.parse_applied(result.output)
+        return applied
+
+    def changes(self, applied=None):
+        """
+        The symlinks missing from ``applied``
+
+        :returns: sorted list of symlink and target pairs
+        """
+        if applied is None:
+            applied = {}
+        return sorted((symlink, target)
+                      for (symlink, target) in self.links.items()
+                      if applied.get(symlink) != target)
+
+    @staticmethod
+    def commands(changes):
+        """Shell commands making ``changes``"""
+        dirs = sorted(set(os.path.dirname(symlink)
+                          for (symlink, target) in changes if target))
+        commands = []
+        if dirs:
+            commands.append('mkdir -p %s' % ' '.join(dirs))
+        for (symlink, target) in changes:
+            if target:
+                commands.append('ln -nsf %s %s' % (target, symlink))
+            else:
+                commands.append('rm -f %s' % symlink)
+        return commands
+
+    def apply(self):
+        """
+        Make the changes each server is missing
+
+        Servers whose symlinks couldn't be read get all symlinks of the plan.
+
+        :returns: list of :py:class:`ServerResult`, for the servers that were
+            changed
+        """
+        servers = getattr(settings, 'MULTIPLE_APP_SERVERS', None) or [None]
+        sync_user = getattr(settings, 'SYNC_USER', getpass.getuser())
+        if not self.links:
+            return []
+        applied = self.applied(servers)
+        changes = {}
+        for server in servers:
+            server_changes = self.changes(applied.get(server))
+            if server_changes:
+                changes[server] = server_changes
+        if not changes:
+            log.debug(LOG_TEMPLATE.format(
+                project=self.project.slug, version='',
+                msg='Symlinks are up to date'))
+            return []
+
+        def commands(server):
+            script = ' && '.join(self.commands(changes[server]))
+            if server is None:
+                return [script]
+            return ['ssh %s@%s %s' % (sync_user, server, pipes.quote(script))]
+
+        return run_on_servers(
+            [server for server in servers if server in changes], commands)
+
+
+def planned(fn):
+    """
+    Add the symlinks of ``fn`` to a plan
+
+    Without a plan, a plan is created for ``fn`` alone, and applied.
+    """
+
+    @wraps(fn)
+    def wrapper(version, plan=None):
+        if plan is not None:
+            return fn(version, plan)
+        plan = SymlinkPlan(version.project)
+        fn(version, plan)
+        return plan.apply()
+    return wrapper
+
+
+def symlink_project(version, single_version=None):
+    """
+    Maintain all symlinks of the version's project, with a single plan
+
+    :param single_version: whether to link or remove the single_version
+        symlink, by default left alone
+    """
+    plan = SymlinkPlan(version.project)
+    symlink_cnames(version, plan)
+    symlink_translations(version, plan)
+    symlink_subprojects(version, plan)
+    if single_version is not None:
+        if single_version:
+            symlink_single_version(version, plan)
+        else:
+            remove_symlink_single_version(version, plan)
+    return plan.apply()
+
+
+@planned
+def symlink_cnames(version, plan):
     """
     OLD
     Link from HOME/user_builds/cnames/<cname> ->
@@ -33,16 +218,15 @@ def symlink_cnames(version):
         docs_dir = '/'.join(docs_dir.split('/')[:-1])
         # Old symlink location -- Keep this here til we change nginx over
         symlink = version.project.cnames_symlink_path(cname)
-        run_on_app_servers('mkdir -p %s' % '/'.join(symlink.split('/')[:-1]))
-        run_on_app_servers('ln -nsf %s %s' % (docs_dir, symlink))
+        plan.link(symlink, docs_dir)
         # New symlink location
         new_docs_dir = version.project.doc_path
         new_cname_symlink = os.path.join(getattr(settings, 'SITE_ROOT'), 'cnametoproject', cname)
-        run_on_app_servers('mkdir -p %s' % '/'.join(new_cname_symlink.split('/')[:-1]))
-        run_on_app_servers('ln -nsf %s %s' % (new_docs_dir, new_cname_symlink))
+        plan.link(new_cname_symlink, new_docs_dir)
 
 
-def symlink_subprojects(version):
+@planned
+def symlink_subprojects(version, plan):
     """
     Link from HOME/user_builds/project/subprojects/<project> ->
               HOME/user_builds/<project>/rtd-builds/
@@ -62,14 +246,14 @@ def symlink_subprojects(version):
 
             # The directory for this specific subproject
             symlink = version.project.subprojects_symlink_path(subproject_slug)
-            run_on_app_servers('mkdir -p %s' % '/'.join(symlink.split('/')[:-1]))
 
             # Where the actual docs live
             docs_dir = os.path.join(settings.DOCROOT, subproject_slug, 'rtd-builds')
-            run_on_app_servers('ln -nsf %s %s' % (docs_dir, symlink))
+            plan.link(symlink, docs_dir)
 
 
-def symlink_translations(version):
+@planned
+def symlink_translations(version, plan):
     """
     Link from HOME/user_builds/project/translations/<lang> ->
               HOME/user_builds/<project>/rtd-builds/
@@ -91,10 +275,6 @@ def symlink_translations(version):
     if not translations.has_key('en'):
         translations['en'] = version_slug
 
-    run_on_app_servers(
-        'mkdir -p {0}'
-        .format(os.path.join(version.project.doc_path, 'translations')))
-
     for (language, slug) in translations.items():
         log.debug(LOG_TEMPLATE.format(
             project=version.project.slug,
@@ -105,10 +285,11 @@ def symlink_translations(version):
         # The directory for this specific translation
         symlink = version.project.translations_symlink_path(language)
         translation_path = os.path.join(settings.DOCROOT, slug, 'rtd-builds')
-        run_on_app_servers('ln -nsf {0} {1}'.format(translation_path, symlink))
+        plan.link(symlink, translation_path)
 
 
-def symlink_single_version(version):
+@planned
+def symlink_single_version(version, plan):
     """
     Link from HOME/user_builds/<project>/single_version ->
               HOME/user_builds/<project>/rtd-builds/<default_version>/
@@ -118,14 +299,14 @@ def symlink_single_version(version):
 
     # The single_version directory
     symlink = version.project.single_version_symlink_path()
-    run_on_app_servers('mkdir -p %s' % '/'.join(symlink.split('/')[:-1]))
 
     # Where the actual docs live
     docs_dir = os.path.join(settings.DOCROOT, version.project.slug, 'rtd-builds', default_version)
-    run_on_app_servers('ln -nsf %s %s' % (docs_dir, symlink))
+    plan.link(symlink, docs_dir)
 
 
-def remove_symlink_single_version(version):
+@planned
+def remove_symlink_single_version(version, plan):
     """Remove single_version symlink"""
     log.debug(LOG_TEMPLATE.format(
         project=version.project.slug,
@@ -133,4 +314,4 @@ def remove_symlink_single_version(version):
         msg="Removing symlink for single_version")
     )
     symlink = version.project.single_version_symlink_path()
-    run_on_app_servers('rm -f %s' % symlink)
+    plan.remove(symlink)
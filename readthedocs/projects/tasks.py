@@ -12,11 +12,14 @@ import requests
 import datetime
 import hashlib
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from celery import task, Task
 from djcelery import celery as celery_app
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import Case, CharField, Value, When
 from django.utils.translation import ugettext_lazy as _
 from slumber.exceptions import HttpClientError
 from docker import errors as docker_errors
@@ -27,10 +30,18 @@ from readthedocs.builds.constants import (LATEST, BUILD_STATE_TRIGGERED,
                                           BUILD_STATE_BUILDING,
                                           BUILD_STATE_FINISHED)
 from readthedocs.builds.models import Build, Version
+from readthedocs.builds.scheduler import BuildScheduler, BUILD_SCHEDULER_ENABLE
 from readthedocs.core.utils import send_email, run_on_app_servers
+from readthedocs.core.utils.publish import (current_manifest, forget_synced,
+                                            hash_file, releases_path,
+                                            sync_marker_path)
 from readthedocs.cdn.purge import purge
 from readthedocs.doc_builder.loader import get_builder_class
+from readthedocs.doc_builder.backends.sphinx import MultiFormatBuilder
 from readthedocs.doc_builder.base import restoring_chdir
+from readthedocs.doc_builder.cache import VirtualenvCache
+from readthedocs.doc_builder.compress import is_sidecar
+from readthedocs.doc_builder.constants import VENV_CACHE_ENABLE
 from readthedocs.doc_builder.environments import (LocalEnvironment,
                                                   DockerEnvironment)
 from readthedocs.doc_builder.exceptions import (BuildEnvironmentError,
@@ -44,7 +55,7 @@ from readthedocs.projects import symlinks
 from readthedocs.privacy.loader import Syncer
 from readthedocs.search.parse_json import process_all_json_files
 from readthedocs.search.utils import process_mkdocs_json
-from readthedocs.restapi.utils import index_search_request
+from readthedocs.restapi.utils import BATCH_SIZE, batches, index_search_request
 from readthedocs.vcs_support import utils as vcs_support_utils
 from readthedocs.api.client import api as api_v1
 from readthedocs.restapi.client import api as api_v2
@@ -54,6 +65,23 @@ from readthedocs.projects.signals import before_vcs, after_vcs, before_build, af
 log = logging.getLogger(__name__)
 
 HTML_ONLY = getattr(settings, 'HTML_ONLY_PROJECTS', ())
+FILEIFY_HASH_JOBS = getattr(settings, 'FILEIFY_HASH_JOBS', 4)
+
+# Base requirements installed into every project's virtualenv
+VIRTUALENV_REQUIREMENTS = [
+    'sphinx==1.3.1',
+    'Pygments==2.0.2',
+    'virtualenv==13.1.0',
+    'setuptools==18.0.1',
+    'docutils==0.11',
+    'mkdocs==0.14.0',
+    'mock==1.0.1',
+    'pillow==2.6.1',
+    'readthedocs-sphinx-ext==0.5.4',
+    'sphinx-rtd-theme==0.1.8',
+    'alabaster>=0.7,<0.8,!=0.7.5',
+    'recommonmark==0.1.1',
+]
 
 
 class UpdateDocsTask(Task):
@@ -82,6 +110,8 @@ class UpdateDocsTask(Task):
         self.build_force = force
         self.build_search = search
         self.build_localmedia = localmedia
+        # Checks the lock on the version is held, while building
+        self.fence = None
         self.build = {}
         if build is not None:
             self.build = build
@@ -107,12 +137,22 @@ class UpdateDocsTask(Task):
         self.build_force = force
         self.build_env = env_cls(project=self.project, version=self.version,
                                  build=self.build, record=record)
+        try:
+            self.run_build()
+        finally:
+            # This build's slot is free for the next build now
+            if record and BUILD_SCHEDULER_ENABLE:
+                schedule_builds.delay()
+
+    def run_build(self):
+        '''Build the version in the build environment'''
         with self.build_env:
             if self.project.skip:
                 raise BuildEnvironmentError(
                     _('Builds for this project are temporarily disabled'))
             try:
-                self.setup_vcs()
+                with self.build_env.phase('setup_vcs'):
+                    self.setup_vcs()
             except vcs_support_utils.LockTimeout, e:
                 self.retry(exc=e, throw=False)
                 raise BuildEnvironmentError(
@@ -122,6 +162,19 @@ class UpdateDocsTask(Task):
 
             if self.project.documentation_type == 'auto':
                 self.update_documentation_type()
+
+            fingerprint = self.get_build_fingerprint()
+            self.build['fingerprint'] = fingerprint
+            if (not self.build_force and fingerprint is not None and
+                    self.version.built and
+                    fingerprint == self.get_last_fingerprint()):
+                log.info(LOG_TEMPLATE
+                         .format(project=self.project.slug,
+                                 version=self.version.slug,
+                                 msg='Commit and configuration unchanged '
+                                     'since the last build, skipping build'))
+                self.build['up_to_date'] = True
+                return
             self.setup_environment()
 
             # TODO the build object should have an idea of these states, extend
@@ -206,7 +259,9 @@ class UpdateDocsTask(Task):
                          version=self.version.slug,
                          msg='Updating docs from VCS'))
         try:
-            update_output = update_imported_docs(self.version.pk)
+            # The commit pushed, if the build was triggered by a push
+            update_output = update_imported_docs(
+                self.version.pk, commit=self.build.get('commit'))
             commit = self.project.vcs_repo(self.version.slug).commit
             if commit:
                 self.build['commit'] = commit
@@ -218,7 +273,9 @@ class UpdateDocsTask(Task):
         """
         Build the virtualenv and install the project into it.
 
-        Always build projects with a virtualenv.
+        Always build projects with a virtualenv. When the virtualenv cache is
+        enabled, a virtualenv with the same base and project requirements is
+        cloned from the cache instead of being installed again.
 
         :param build_env: Build environment to pass commands and execution through.
         """
@@ -234,6 +291,65 @@ class UpdateDocsTask(Task):
                              version=self.version.slug,
                              msg='Removing existing build directory'))
             shutil.rmtree(build_dir)
+
+        requirements_file_path = self.get_requirements_file()
+        venv_path = self.project.venv_path(version=self.version.slug)
+        venv_cache = VirtualenvCache()
+        cache_key = None
+        if VENV_CACHE_ENABLE:
+            cache_key = self.get_venv_cache_key(requirements_file_path)
+
+        restored = False
+        if cache_key is not None:
+            with self.build_env.phase('restore_virtualenv'):
+                restored = venv_cache.restore(cache_key, venv_path)
+        if restored:
+            log.info(LOG_TEMPLATE
+                     .format(project=self.project.slug,
+                             version=self.version.slug,
+                             msg='Using cached virtualenv'))
+        else:
+            with self.build_env.phase('install_virtualenv'):
+                self.install_virtualenv()
+            if requirements_file_path:
+                with self.build_env.phase('install_requirements'):
+                    self.install_requirements_file(requirements_file_path)
+            if cache_key is not None:
+                with self.build_env.phase('store_virtualenv'):
+                    venv_cache.store(cache_key, venv_path)
+
+        # Handle setup.py
+        checkout_path = self.project.checkout_path(self.version.slug)
+        setup_path = os.path.join(checkout_path, 'setup.py')
+        if os.path.isfile(setup_path):
+            with self.build_env.phase('install_project'):
+                self.install_project()
+
+    def install_project(self):
+        """Install the project into the virtualenv with its ``setup.py``"""
+        checkout_path = self.project.checkout_path(self.version.slug)
+        if getattr(settings, 'USE_PIP_INSTALL', False):
+            self.build_env.run(
+                'python',
+                self.project.venv_bin(version=self.version.slug, bin='pip'),
+                'install',
+                '--ignore-installed',
+                '.',
+                cwd=checkout_path,
+                bin_path=self.project.venv_bin(version=self.version.slug)
+            )
+        else:
+            self.build_env.run(
+                'python',
+                'setup.py',
+                'install',
+                '--force',
+                cwd=checkout_path,
+                bin_path=self.project.venv_bin(version=self.version.slug)
+            )
+
+    def install_virtualenv(self):
+        """Create the virtualenv and install our base requirements into it"""
         site_packages = '--no-site-packages'
         if self.project.use_system_packages:
             site_packages = '--system-site-packages'
@@ -246,21 +362,6 @@ class UpdateDocsTask(Task):
 
         # Install requirements
         wheeldir = os.path.join(settings.SITE_ROOT, 'deploy', 'wheels')
-        requirements = [
-            'sphinx==1.3.1',
-            'Pygments==2.0.2',
-            'virtualenv==13.1.0',
-            'setuptools==18.0.1',
-            'docutils==0.11',
-            'mkdocs==0.14.0',
-            'mock==1.0.1',
-            'pillow==2.6.1',
-            'readthedocs-sphinx-ext==0.5.4',
-            'sphinx-rtd-theme==0.1.8',
-            'alabaster>=0.7,<0.8,!=0.7.5',
-            'recommonmark==0.1.1',
-        ]
-
         cmd = [
             'python',
             self.project.venv_bin(version=self.version.slug, bin='pip'),
@@ -275,13 +376,14 @@ class UpdateDocsTask(Task):
             # even if it is already installed system-wide (and
             # --system-site-packages is used)
             cmd.append('-I')
-        cmd.extend(requirements)
+        cmd.extend(VIRTUALENV_REQUIREMENTS)
         self.build_env.run(
             *cmd,
             bin_path=self.project.venv_bin(version=self.version.slug)
         )
 
-        # Handle requirements
+    def get_requirements_file(self):
+        """Return the path to the project's requirements file, if any"""
         requirements_file_path = self.project.requirements_file
         checkout_path = self.project.checkout_path(self.version.slug)
         if not requirements_file_path:
@@ -294,41 +396,116 @@ class UpdateDocsTask(Task):
                     if os.path.exists(test_path):
                         requirements_file_path = test_path
                         break
+        return requirements_file_path
 
+    def install_requirements_file(self, requirements_file_path):
+        """Install the project's requirements file into the virtualenv"""
+        checkout_path = self.project.checkout_path(self.version.slug)
+        self.build_env.run(
+            'python',
+            self.project.venv_bin(version=self.version.slug, bin='pip'),
+            'install',
+            '--exists-action=w',
+            '-r{0}'.format(requirements_file_path),
+            cwd=checkout_path,
+            bin_path=self.project.venv_bin(version=self.version.slug)
+        )
+
+    def get_venv_cache_key(self, requirements_file_path):
+        """Cache key for the virtualenv this build would install
+
+        The key covers the interpreter and build environment the virtualenv is
+        created with, our base requirements, and the contents of the project's
+        requirements file. Requirements files that refer to other files, or
+        to paths in the checkout, can't be keyed on their contents alone, so
+        virtualenvs installed from them aren't cached.
+
+        :returns: cache key, or ``None`` if the virtualenv can't be cached
+        """
+        requirements = ''
         if requirements_file_path:
-            self.build_env.run(
-                'python',
-                self.project.venv_bin(version=self.version.slug, bin='pip'),
-                'install',
-                '--exists-action=w',
-                '-r{0}'.format(requirements_file_path),
-                cwd=checkout_path,
-                bin_path=self.project.venv_bin(version=self.version.slug)
-            )
+            checkout_path = self.project.checkout_path(self.version.slug)
+            try:
+                with open(os.path.join(checkout_path,
+                                       requirements_file_path), 'rb') as fh:
+                    requirements = fh.read()
+            except IOError:
+                return None
+            for line in requirements.splitlines():
+                line = line.strip()
+                if line.startswith(('-e', '--editable', '-r', '--requirement',
+                                    '-c', '--constraint', '.', '/', 'file:')):
+                    return None
+        return VirtualenvCache.make_key(
+            self.build_env.__class__.__name__,
+            getattr(self.build_env, 'container_image', None),
+            self.project.python_interpreter,
+            self.project.use_system_packages,
+            VIRTUALENV_REQUIREMENTS,
+            hashlib.sha1(requirements).hexdigest(),
+        )
 
-        # Handle setup.py
-        checkout_path = self.project.checkout_path(self.version.slug)
-        setup_path = os.path.join(checkout_path, 'setup.py')
-        if os.path.isfile(setup_path):
-            if getattr(settings, 'USE_PIP_INSTALL', False):
-                self.build_env.run(
-                    'python',
-                    self.project.venv_bin(version=self.version.slug, bin='pip'),
-                    'install',
-                    '--ignore-installed',
-                    '.',
-                    cwd=checkout_path,
-                    bin_path=self.project.venv_bin(version=self.version.slug)
-                )
-            else:
-                self.build_env.run(
-                    'python',
-                    'setup.py',
-                    'install',
-                    '--force',
-                    cwd=checkout_path,
-                    bin_path=self.project.venv_bin(version=self.version.slug)
-                )
+    def get_build_fingerprint(self):
+        """Hash of everything that goes into building this version
+
+        This covers the commit, the project's build settings, the contents of
+        its requirements file, and how we build it.
+
+        :returns: fingerprint, or ``None`` if the commit is unknown
+        """
+        commit = self.build.get('commit')
+        if not commit:
+            return None
+        requirements = ''
+        requirements_file_path = self.get_requirements_file()
+        if requirements_file_path:
+            checkout_path = self.project.checkout_path(self.version.slug)
+            try:
+                with open(os.path.join(checkout_path,
+                                       requirements_file_path), 'rb') as fh:
+                    requirements = fh.read()
+            except IOError:
+                pass
+        settings_fields = [
+            'documentation_type', 'requirements_file', 'conf_py_file',
+            'python_interpreter', 'use_system_packages', 'use_virtualenv',
+            'enable_pdf_build', 'enable_epub_build', 'allow_comments',
+            'language', 'name', 'theme', 'copyright', 'canonical_url',
+            'analytics_code', 'single_version',
+        ]
+        fingerprint = [
+            commit,
+            dict((field, getattr(self.project, field, None))
+                 for field in settings_fields),
+            hashlib.sha1(requirements).hexdigest(),
+            self.build_search,
+            self.build_localmedia,
+            self.build_env.__class__.__name__,
+            getattr(self.build_env, 'container_image', None),
+            VIRTUALENV_REQUIREMENTS,
+        ]
+        return hashlib.sha1(json.dumps(fingerprint, sort_keys=True)).hexdigest()
+
+    def get_last_fingerprint(self):
+        """Fingerprint of the last successful build of this version"""
+        try:
+            builds = api_v1.build.get(project=self.project.pk,
+                                      version=self.version.pk,
+                                      type='html',
+                                      state=BUILD_STATE_FINISHED,
+                                      success=True,
+                                      limit=1)
+        except Exception:
+            log.error(LOG_TEMPLATE
+                      .format(project=self.project.slug,
+                              version=self.version.slug,
+                              msg='Unable to get the last build'),
+                      exc_info=True)
+            return None
+        for build in builds['objects']:
+            if build['id'] != self.build.get('id'):
+                return build.get('fingerprint')
+        return None
 
     def build_docs(self):
         """Wrapper to all build functions
@@ -344,30 +521,124 @@ class UpdateDocsTask(Task):
         before_build.send(sender=self.version)
 
         outcomes = defaultdict(lambda: False)
-        with self.project.repo_nonblockinglock(
+        with self.project.repo_lock(
                 version=self.version,
-                max_lock_age=getattr(settings, 'REPO_LOCK_SECONDS', 30)):
-            outcomes['html'] = self.build_docs_html()
-            outcomes['search'] = self.build_docs_search()
-            outcomes['localmedia'] = self.build_docs_localmedia()
-            outcomes['pdf'] = self.build_docs_pdf()
-            outcomes['epub'] = self.build_docs_epub()
+                timeout=getattr(settings, 'REPO_LOCK_WAIT', 60),
+                lease=getattr(settings, 'REPO_LOCK_SECONDS', 30)) as lock:
+            # Artifacts are only replaced while the lock is still held
+            self.fence = lock.fence
+            if (self.project.is_type_sphinx and
+                    getattr(settings, 'SPHINX_COMBINED_BUILD', False)):
+                outcomes.update(self.build_docs_combined())
+            else:
+                outcomes['html'] = self.build_docs_html()
+                builds = [
+                    ('search', self.build_docs_search),
+                    ('localmedia', self.build_docs_localmedia),
+                    ('pdf', self.build_docs_pdf),
+                    ('epub', self.build_docs_epub),
+                ]
+                concurrency = getattr(settings, 'BUILD_CONCURRENCY', 1)
+                if concurrency > 1:
+                    outcomes.update(self.build_docs_concurrently(builds,
+                                                                 concurrency))
+                else:
+                    for (outcome, build_func) in builds:
+                        outcomes[outcome] = build_func()
 
         after_build.send(sender=self.version)
         return outcomes
 
-    def build_docs_html(self):
+    def build_docs_concurrently(self, builds, concurrency):
+        """Run the secondary builds alongside each other
+
+        The secondary builds only depend on the HTML build having finished, so
+        they are run in a pool of at most ``concurrency`` threads, each against
+        a private copy of the doctrees. All builds are allowed to finish before
+        the first exception raised by any of them is raised again here, which
+        matches the serial builds halting on a hard error.
+
+        :param builds: list of ``(outcome, build function)`` pairs
+        :param concurrency: maximum number of builds to run at once
+        :returns: Build outcomes for each of ``builds``
+        :rtype: dict
+        """
+        pool = ThreadPool(processes=min(concurrency, len(builds)))
+        try:
+            results = [(outcome, pool.apply_async(build_func,
+                                                  kwds={'isolate': True}))
+                       for (outcome, build_func) in builds]
+        finally:
+            pool.close()
+            pool.join()
+        return dict((outcome, result.get()) for (outcome, result) in results)
+
+    def get_html_builder(self):
+        """Set up the HTML builder for the project's documentation type
+
+        Skipping the build fingerprint check doesn't decide whether the source
+        is read again: unless incremental builds are enabled, the HTML build
+        always starts from a fresh environment, so doctrees left behind in the
+        checkout by an earlier build are never reused.
+        """
         html_builder = get_builder_class(self.project.documentation_type)(
             self.build_env
         )
-        if self.build_force:
+        if (self.build_force or
+                not getattr(settings, 'SPHINX_INCREMENTAL_BUILDS', False)):
             html_builder.force()
         html_builder.append_conf()
-        success = html_builder.build()
+        return html_builder
+
+    def build_docs_combined(self):
+        """Build HTML and all secondary Sphinx formats in one process
+
+        Each format is written by a Sphinx application of its own, from the
+        environment the HTML build pickled, in a single process instead of a
+        ``sphinx-build`` run for each format.
+
+        :returns: Build outcomes with keys for html, search, localmedia, pdf,
+                  and epub
+        :rtype: dict
+        """
+        html_builder = self.get_html_builder()
+        builders = [('html', html_builder)]
+        for (outcome, builder_class, enabled) in [
+                ('search', 'sphinx_search', self.build_search),
+                ('localmedia', 'sphinx_singlehtmllocalmedia',
+                 self.build_localmedia),
+                ('pdf', 'sphinx_pdf', self.is_pdf_enabled()),
+                ('epub', 'sphinx_epub', self.is_epub_enabled())]:
+            if enabled:
+                builders.append(
+                    (outcome, get_builder_class(builder_class)(self.build_env)))
+
+        with self.build_env.phase('build combined'):
+            results = MultiFormatBuilder(
+                self.build_env,
+                [builder for (outcome, builder) in builders]
+            ).build()
+        outcomes = {}
+        for (outcome, builder) in builders:
+            outcomes[outcome] = results[builder.type]
+            if outcome != 'html' or outcomes[outcome]:
+                with self.build_env.phase('move ' + builder.type):
+                    builder.move(fence=self.fence)
+        self.move_html_files()
+        return outcomes
+
+    def build_docs_html(self):
+        html_builder = self.get_html_builder()
+        with self.build_env.phase('build ' + html_builder.type):
+            success = html_builder.build()
         if success:
-            html_builder.move()
+            with self.build_env.phase('move ' + html_builder.type):
+                html_builder.move(fence=self.fence)
+        self.move_html_files()
+        return success
 
-        # Gracefully attempt to move files via task on web workers.
+    def move_html_files(self):
+        '''Gracefully attempt to move files via task on web workers'''
         try:
             move_files.delay(
                 version_pk=self.version.pk,
@@ -378,50 +649,64 @@ class UpdateDocsTask(Task):
             # TODO do something here
             pass
 
-        return success
-
-    def build_docs_search(self):
+    def build_docs_search(self, isolate=False):
         '''Build search data with separate build'''
         if self.build_search:
             if self.project.is_type_mkdocs:
-                return self.build_docs_class('mkdocs_json')
+                return self.build_docs_class('mkdocs_json', isolate=isolate)
             if self.project.is_type_sphinx:
-                return self.build_docs_class('sphinx_search')
+                return self.build_docs_class('sphinx_search', isolate=isolate)
         return False
 
-    def build_docs_localmedia(self):
+    def build_docs_localmedia(self, isolate=False):
         '''Get local media files with separate build'''
         if self.build_localmedia:
             if self.project.is_type_sphinx:
-                return self.build_docs_class('sphinx_singlehtmllocalmedia')
+                return self.build_docs_class('sphinx_singlehtmllocalmedia',
+                                             isolate=isolate)
         return False
 
-    def build_docs_pdf(self):
+    def is_pdf_enabled(self):
+        return (self.project.slug not in HTML_ONLY and
+                self.project.is_type_sphinx and
+                self.project.enable_pdf_build)
+
+    def is_epub_enabled(self):
+        return (self.project.slug not in HTML_ONLY and
+                self.project.is_type_sphinx and
+                self.project.enable_epub_build)
+
+    def build_docs_pdf(self, isolate=False):
         '''Build PDF docs'''
-        if (self.project.slug in HTML_ONLY or
-                not self.project.is_type_sphinx or
-                not self.project.enable_pdf_build):
+        if not self.is_pdf_enabled():
             return False
-        return self.build_docs_class('sphinx_pdf')
+        return self.build_docs_class('sphinx_pdf', isolate=isolate)
 
-    def build_docs_epub(self):
+    def build_docs_epub(self, isolate=False):
         '''Build ePub docs'''
-        if (self.project.slug in HTML_ONLY or
-                not self.project.is_type_sphinx or
-                not self.project.enable_epub_build):
+        if not self.is_epub_enabled():
             return False
-        return self.build_docs_class('sphinx_epub')
+        return self.build_docs_class('sphinx_epub', isolate=isolate)
 
-    def build_docs_class(self, builder_class):
+    def build_docs_class(self, builder_class, isolate=False):
         """Build docs with additional doc backends
 
         These steps are not necessarily required for the build to halt, so we
         only raise a warning exception here. A hard error will halt the build
         process.
+
+        :param isolate: build against a private copy of any state shared
+                        between builders, for builds running concurrently
         """
         builder = get_builder_class(builder_class)(self.build_env)
-        success = builder.build()
-        builder.move()
+        with self.build_env.phase('build ' + builder.type):
+            if isolate:
+                with builder.private_doctrees():
+                    success = builder.build()
+            else:
+                success = builder.build()
+        with self.build_env.phase('move ' + builder.type):
+            builder.move(fence=self.fence)
         return success
 
 
@@ -429,9 +714,12 @@ update_docs = celery_app.tasks[UpdateDocsTask.name]
 
 
 @task()
-def update_imported_docs(version_pk):
+def update_imported_docs(version_pk, commit=None):
     """
     Check out or update the given project's repository.
+
+    :param commit: Commit the checkout is expected to have, recent fetches of
+        the repository without it aren't reused
     """
     version_data = api_v1.version(version_pk).get()
     version = make_api_version(version_data)
@@ -445,10 +733,13 @@ def update_imported_docs(version_pk):
     if not project.vcs_repo():
         raise ProjectImportError(("Repo type '{0}' unknown".format(project.repo_type)))
 
-    with project.repo_nonblockinglock(
+    with project.repo_lock(
             version=version,
-            max_lock_age=getattr(settings, 'REPO_LOCK_SECONDS', 30)):
+            timeout=getattr(settings, 'REPO_LOCK_WAIT', 60),
+            lease=getattr(settings, 'REPO_LOCK_SECONDS', 30)) as lock:
         before_vcs.send(sender=version)
+        # The checkout is only changed while the lock is still held
+        lock.fence()
         # Get the actual code on disk
         if version:
             log.info(
@@ -462,7 +753,8 @@ def update_imported_docs(version_pk):
                 )
             )
             version_slug = version.slug
-            version_repo = project.vcs_repo(version_slug)
+            version_repo = project.vcs_repo(version_slug,
+                                            required_commit=commit)
             ret_dict['checkout'] = version_repo.checkout(
                 version.identifier,
             )
@@ -502,6 +794,12 @@ def update_imported_docs(version_pk):
 
 
 # Web tasks
+@task(queue='web')
+def schedule_builds():
+    '''Dispatch waiting builds to builders, see :py:class:`BuildScheduler`'''
+    BuildScheduler().schedule()
+
+
 @task(queue='web')
 def finish_build(version_pk, build_pk, hostname=None, html=False,
                  localmedia=False, search=False, pdf=False, epub=False):
@@ -531,13 +829,8 @@ def finish_build(version_pk, build_pk, hostname=None, html=False,
         epub=epub,
     )
 
-    symlinks.symlink_cnames(version)
-    symlinks.symlink_translations(version)
-    symlinks.symlink_subprojects(version)
-    if version.project.single_version:
-        symlinks.symlink_single_version(version)
-    else:
-        symlinks.remove_symlink_single_version(version)
+    symlinks.symlink_project(version,
+                             single_version=version.project.single_version)
 
     # Delayed tasks
     update_static_metadata.delay(version.project.pk)
@@ -633,39 +926,99 @@ def fileify(version_pk, commit):
     if path:
         log.info(LOG_TEMPLATE.format(
             project=version.project.slug, version=version.slug, msg='Creating ImportedFiles'))
-        _manage_imported_files(version, path, commit)
+        changed_files = _manage_imported_files(version, path, commit)
+        # Purge Cache
+        purge(changed_files)
     else:
         log.info(LOG_TEMPLATE.format(project=project.slug, version=version.slug, msg='No ImportedFile files'))
 
 
 def _manage_imported_files(version, path, commit):
-    changed_files = set()
+    """
+    Reconcile the ImportedFiles of a version with the files at ``path``
+
+    The version's ImportedFiles are loaded in one query and compared with the
+    files in memory. New files are inserted with ``bulk_create``, files with
+    a new md5 or commit are updated in batches, and ImportedFiles of files
+    that are gone are deleted in batches. Files are hashed in parallel,
+    unless the manifest of the published tree has their md5 already.
+
+    :returns: set of the paths of new and changed files
+    """
+    # Reuse the hashes of published trees instead of reading every file
+    manifest = current_manifest(path) or {}
+    files = {}
+    unhashed = []
     for root, dirnames, filenames in os.walk(path):
         for filename in filenames:
+            if is_sidecar(filename):
+                continue
             dirpath = os.path.join(root.replace(path, '').lstrip('/'),
                                    filename.lstrip('/'))
-            full_path = os.path.join(root, filename)
-            md5 = hashlib.md5(open(full_path, 'rb').read()).hexdigest()
-            try:
-                obj, created = ImportedFile.objects.get_or_create(
-                    project=version.project,
-                    version=version,
-                    path=dirpath,
-                    name=filename,
-                )
-            except ImportedFile.MultipleObjectsReturned:
-                log.exception('Error creating ImportedFile')
+            if dirpath in manifest:
+                files[(dirpath, filename)] = manifest[dirpath][1]
+            else:
+                unhashed.append((dirpath, filename))
+    if unhashed:
+        pool = ThreadPool(processes=FILEIFY_HASH_JOBS)
+        try:
+            hashes = pool.map(
+                lambda key: hash_file(os.path.join(path, key[0])), unhashed)
+        finally:
+            pool.close()
+            pool.join()
+        files.update(zip(unhashed, hashes))
+
+    changed_files = set()
+    with transaction.atomic():
+        existing = {}
+        stale = []
+        for (pk, dirpath, filename, md5, file_commit) in (
+                ImportedFile.objects
+                .filter(project=version.project, version=version)
+                .values_list('pk', 'path', 'name', 'md5', 'commit')):
+            if (dirpath, filename) in existing:
+                log.warning('Removing duplicate ImportedFile: %s' % dirpath)
+                stale.append(pk)
+                continue
+            existing[(dirpath, filename)] = (pk, md5, file_commit)
+
+        created = []
+        rehashed = {}
+        recommitted = []
+        for ((dirpath, filename), md5) in files.items():
+            if (dirpath, filename) not in existing:
+                created.append(ImportedFile(
+                    project=version.project, version=version, path=dirpath,
+                    name=filename, md5=md5, commit=commit))
+                changed_files.add(dirpath)
                 continue
-            if obj.md5 != md5:
-                obj.md5 = md5
+            (pk, old_md5, file_commit) = existing.pop((dirpath, filename))
+            if old_md5 != md5:
+                rehashed[pk] = md5
                 changed_files.add(dirpath)
-            if obj.commit != commit:
-                obj.commit = commit
-            obj.save()
-    # Delete ImportedFiles from previous versions
-    ImportedFile.objects.filter(project=version.project, version=version).exclude(commit=commit).delete()
-    # Purge Cache
-    purge(changed_files)
+            elif file_commit != commit:
+                recommitted.append(pk)
+        # ImportedFiles of files that are gone
+        stale.extend(pk for (pk, _, _) in existing.values())
+
+        ImportedFile.objects.bulk_create(created)
+        # Each file takes three parameters in the CASE expression
+        for batch in batches(list(rehashed.items()), BATCH_SIZE // 4):
+            ImportedFile.objects.filter(pk__in=[pk for (pk, _) in batch]).update(
+                md5=Case(*[When(pk=pk, then=Value(md5))
+                           for (pk, md5) in batch],
+                         output_field=CharField()),
+                commit=commit)
+        for batch in batches(recommitted):
+            ImportedFile.objects.filter(pk__in=batch).update(commit=commit)
+        for batch in batches(stale):
+            ImportedFile.objects.filter(pk__in=batch).delete()
+    log.info(LOG_TEMPLATE.format(
+        project=version.project.slug, version=version.slug,
+        msg='ImportedFiles: %s added, %s changed, %s updated, %s removed' % (
+            len(created), len(rehashed), len(recommitted), len(stale))))
+    return changed_files
 
 
 @task(queue='web')
@@ -807,16 +1160,37 @@ def clear_artifacts(version_pk):
 
 
 def clear_pdf_artifacts(version):
-    run_on_app_servers('rm -rf %s' % version.project.get_production_media_path(type='pdf', version_slug=version.slug))
+    clear_media_artifacts(version, 'pdf', 'sphinx_pdf')
 
 
 def clear_epub_artifacts(version):
-    run_on_app_servers('rm -rf %s' % version.project.get_production_media_path(type='epub', version_slug=version.slug))
+    clear_media_artifacts(version, 'epub', 'sphinx_epub')
 
 
 def clear_htmlzip_artifacts(version):
-    run_on_app_servers('rm -rf %s' % version.project.get_production_media_path(type='htmlzip', version_slug=version.slug))
+    clear_media_artifacts(version, 'htmlzip', 'sphinx_localmedia')
+
+
+def clear_media_artifacts(version, media_type, artifact_type):
+    """
+    Remove the media file of ``version`` from the web servers
+
+    The marker of the copied media directory is removed too, and the copies
+    are forgotten, so the next copy sends the whole directory again.
+    """
+    project = version.project
+    path = project.get_production_media_path(type=media_type,
+                                             version_slug=version.slug)
+    media_dir = project.get_production_media_path(
+        type=media_type, version_slug=version.slug, include_file=False)
+    run_on_app_servers('rm -rf %s %s' % (path, sync_marker_path(media_dir)))
+    forget_synced(project.artifact_path(version=version.slug,
+                                        type=artifact_type))
 
 
 def clear_html_artifacts(version):
-    run_on_app_servers('rm -rf %s' % version.project.rtd_build_path(version=version.slug))
+    project = version.project
+    path = project.rtd_build_path(version=version.slug)
+    run_on_app_servers('rm -rf %s %s' % (path, releases_path(path)))
+    forget_synced(project.artifact_path(version=version.slug,
+                                        type=project.documentation_type))
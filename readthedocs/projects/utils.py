@@ -31,9 +31,7 @@ def symlink(project, version=LATEST):
     from readthedocs.projects import symlinks
     v = version_from_slug(project, version)
     log.info("Symlinking %s" % v)
-    symlinks.symlink_subprojects(v)
-    symlinks.symlink_cnames(v)
-    symlinks.symlink_translations(v)
+    symlinks.symlink_project(v)
 
 def update_static_metadata(project_pk):
     """
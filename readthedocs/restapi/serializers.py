@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from readthedocs.builds.models import Build, Version
+from readthedocs.builds.models import Build, BuildPhase, Version
 from readthedocs.projects.models import Project
 
 
@@ -40,8 +40,19 @@ class VersionSerializer(serializers.ModelSerializer):
         )
 
 
+class BuildPhaseSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = BuildPhase
+        fields = (
+            'type', 'name', 'phase',
+            'start', 'wall_time', 'cpu_time',
+        )
+
+
 class BuildSerializer(serializers.ModelSerializer):
     project = ProjectSerializer()
+    phases = BuildPhaseSerializer(many=True, read_only=True)
 
     class Meta:
         model = Build
@@ -52,7 +63,8 @@ class BuildSerializer(serializers.ModelSerializer):
             'type',
             'date',
             'success',
-
+            'length',
+            'phases',
         )
 
 
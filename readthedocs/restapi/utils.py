@@ -1,7 +1,13 @@
 import hashlib
 import logging
+from collections import OrderedDict, defaultdict
 
 import requests
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Case, CharField, Value, When
+from guardian.models import UserObjectPermission
 
 from readthedocs.builds.constants import NON_REPOSITORY_VERSIONS
 from readthedocs.builds.models import Version
@@ -9,78 +15,123 @@ from readthedocs.search.indexes import PageIndex, ProjectIndex, SectionIndex
 
 log = logging.getLogger(__name__)
 
+# Rows changed per query, well below the limit of 999 query parameters of
+# SQLite
+BATCH_SIZE = 300
 
-def sync_versions(project, versions, type):
+
+def sync_versions(project, version_data):
     """
     Update the database with the current versions from the repository.
+
+    Versions of the project are compared with the tags and branches in
+    ``version_data`` in memory. New versions are added, versions with a new
+    identifier or type are updated, and versions no longer in the repository
+    are deleted, unless they are active, uploaded, or not from the
+    repository. Changes are made with bulk queries, in a single transaction.
+
+    :param version_data: dict with lists of ``tags`` and ``branches``, each
+        with an ``identifier`` and a ``verbose_name``
+    :returns: tuple of the slugs of added versions and of deleted versions
     """
-    # Bookkeeping for keeping tag/branch identifies correct
-    verbose_names = [v['verbose_name'] for v in versions]
-    project.versions.filter(verbose_name__in=verbose_names).update(type=type)
-
-    old_versions = {}
-    old_version_values = project.versions.values('identifier', 'verbose_name')
-    for version in old_version_values:
-        old_versions[version['verbose_name']] = version['identifier']
-
-    added = set()
-    # Add new versions
-    for version in versions:
-        version_id = version['identifier']
-        version_name = version['verbose_name']
-        if version_name in old_versions.keys():
-            if version_id == old_versions[version_name]:
-                # Version is correct
-                continue
-            else:
-                # Update slug with new identifier
-                Version.objects.filter(
-                    project=project, verbose_name=version_name
-                ).update(
-                    identifier=version_id,
-                    type=type,
-                    machine=False,
-                )
-                log.info("(Sync Versions) Updated Version: [%s=%s] " % (
-                    version['verbose_name'], version['identifier']))
-        else:
-            # New Version
-            created_version = Version.objects.create(
-                project=project,
-                type=type,
-                identifier=version['identifier'],
-                verbose_name=version['verbose_name'],
+    # Branches take precedence over tags of the same name
+    incoming = OrderedDict()
+    for (key, type) in [('tags', 'tag'), ('branches', 'branch')]:
+        for version in version_data.get(key, []):
+            incoming[version['verbose_name']] = (version['identifier'], type)
+    identifiers = set(identifier for (identifier, _) in incoming.values())
+
+    with transaction.atomic():
+        existing = list(project.versions.values_list(
+            'pk', 'verbose_name', 'identifier', 'type', 'slug', 'active',
+            'uploaded'))
+        slugs = set(version[4] for version in existing)
+        existing_names = set(version[1] for version in existing)
+
+        retyped = defaultdict(list)
+        reidentified = {}
+        deleted = {}
+        for (pk, name, identifier, type, slug, active, uploaded) in existing:
+            if name in incoming:
+                (new_identifier, new_type) = incoming[name]
+                if new_identifier != identifier:
+                    reidentified[pk] = (new_identifier, new_type)
+                    log.info("(Sync Versions) Updated Version: [%s=%s] " % (
+                        name, new_identifier))
+                elif new_type != type:
+                    retyped[new_type].append(pk)
+                identifier = new_identifier
+            if (identifier not in identifiers and not active and
+                    not uploaded and slug not in NON_REPOSITORY_VERSIONS):
+                deleted[pk] = slug
+
+        for (type, pks) in retyped.items():
+            for batch in batches(pks):
+                Version.objects.filter(pk__in=batch).update(type=type)
+        # Each version takes four parameters in the CASE expressions
+        for batch in batches(list(reidentified.items()), BATCH_SIZE // 4):
+            Version.objects.filter(pk__in=[pk for (pk, _) in batch]).update(
+                identifier=Case(*[When(pk=pk, then=Value(identifier))
+                                  for (pk, (identifier, _)) in batch],
+                                output_field=CharField()),
+                type=Case(*[When(pk=pk, then=Value(type))
+                            for (pk, (_, type)) in batch],
+                          output_field=CharField()),
+                machine=False,
             )
-            added.add(created_version.slug)
-    if added:
-        log.info("(Sync Versions) Added Versions: [%s] " % ' '.join(added))
-    return added
 
+        slug_field = Version._meta.get_field('slug')
+        new_versions = [
+            Version(project=project, type=type, identifier=identifier,
+                    verbose_name=name,
+                    slug=slug_field.create_unique_slug(name, slugs))
+            for (name, (identifier, type)) in incoming.items()
+            if name not in existing_names]
+        added = set(version.slug for version in new_versions)
+        if new_versions:
+            Version.objects.bulk_create(new_versions)
+            assign_version_permissions(project, added)
+            log.info("(Sync Versions) Added Versions: [%s] " % ' '.join(added))
+
+        for batch in batches(list(deleted)):
+            Version.objects.filter(pk__in=batch).delete()
+        if deleted:
+            log.info("(Sync Versions) Deleted Versions: [%s]" %
+                     ' '.join(deleted.values()))
 
-def delete_versions(project, version_data):
+        if new_versions or deleted:
+            project.sync_supported_versions()
+
+    return (added, set(deleted.values()))
+
+
+def assign_version_permissions(project, slugs):
     """
-    Delete all versions not in the current repo.
+    Give owners of the project permission to view the versions with ``slugs``
+
+    This is what :py:meth:`Version.save` does for each version, for versions
+    created in bulk.
     """
-    current_versions = []
-    if 'tags' in version_data:
-        for version in version_data['tags']:
-            current_versions.append(version['identifier'])
-    if 'branches' in version_data:
-        for version in version_data['branches']:
-            current_versions.append(version['identifier'])
-    to_delete_qs = project.versions.all()
-    to_delete_qs = to_delete_qs.exclude(identifier__in=current_versions)
-    to_delete_qs = to_delete_qs.exclude(uploaded=True)
-    to_delete_qs = to_delete_qs.exclude(active=True)
-    to_delete_qs = to_delete_qs.exclude(slug__in=NON_REPOSITORY_VERSIONS)
-
-    if to_delete_qs.count():
-        ret_val = {obj.slug for obj in to_delete_qs}
-        log.info("(Sync Versions) Deleted Versions: [%s]" % ' '.join(ret_val))
-        to_delete_qs.delete()
-        return ret_val
-    else:
-        return set()
+    owners = list(project.users.all())
+    if not owners:
+        return
+    content_type = ContentType.objects.get_for_model(Version)
+    permission = Permission.objects.get(content_type=content_type,
+                                        codename='view_version')
+    pks = []
+    for batch in batches(list(slugs)):
+        pks.extend(project.versions.filter(slug__in=batch)
+                   .values_list('pk', flat=True))
+    UserObjectPermission.objects.bulk_create(
+        [UserObjectPermission(user=owner, permission=permission,
+                              content_type=content_type, object_pk=str(pk))
+         for pk in pks for owner in owners])
+
+
+def batches(items, size=BATCH_SIZE):
+    """Split ``items`` into lists of at most ``size`` items"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
 
 
 def index_search_request(version, page_list, commit, project_scale, page_scale,
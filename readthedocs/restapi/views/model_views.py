@@ -8,7 +8,8 @@ from rest_framework.renderers import JSONPRenderer, JSONRenderer, BrowsableAPIRe
 from rest_framework.response import Response
 
 from readthedocs.builds.filters import VersionFilter
-from readthedocs.builds.models import Build, Version
+from readthedocs.builds.models import Build, BuildLogChunk, Version
+from readthedocs.builds.scheduler import BuildScheduler
 from readthedocs.core.utils import trigger_build
 from readthedocs.oauth import utils as oauth_utils
 from readthedocs.builds.constants import STABLE
@@ -17,7 +18,10 @@ from readthedocs.projects.models import Project, EmailHook
 from readthedocs.projects.version_handling import determine_stable_version
 from readthedocs.restapi.permissions import APIPermission
 from readthedocs.restapi.permissions import RelatedProjectIsOwner
-from readthedocs.restapi.serializers import BuildSerializer, ProjectSerializer, VersionSerializer
+from readthedocs.restapi.serializers import (BuildSerializer,
+                                             BuildPhaseSerializer,
+                                             ProjectSerializer,
+                                             VersionSerializer)
 import readthedocs.restapi.utils as api_utils
 log = logging.getLogger(__name__)
 
@@ -102,16 +106,8 @@ class ProjectViewSet(viewsets.ModelViewSet):
         try:
             # Update All Versions
             data = request.DATA
-            added_versions = set()
-            if 'tags' in data:
-                ret_set = api_utils.sync_versions(
-                    project=project, versions=data['tags'], type='tag')
-                added_versions.update(ret_set)
-            if 'branches' in data:
-                ret_set = api_utils.sync_versions(
-                    project=project, versions=data['branches'], type='branch')
-                added_versions.update(ret_set)
-            deleted_versions = api_utils.delete_versions(project, data)
+            (added_versions, deleted_versions) = api_utils.sync_versions(
+                project=project, version_data=data)
         except Exception, e:
             log.exception("Sync Versions Error: %s" % e.message)
             return Response({'error': e.message}, status=status.HTTP_400_BAD_REQUEST)
@@ -170,8 +166,78 @@ class BuildViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = BuildSerializer
     model = Build
 
+    # Maximum number of log chunks to return from one request
+    log_page_size = 100
+
     def get_queryset(self):
-        return self.model.objects.api(self.request.user)
+        return (self.model.objects.api(self.request.user)
+                .prefetch_related('phases'))
+
+    @decorators.list_route(permission_classes=[permissions.IsAdminUser])
+    def queue(self, request, **kwargs):
+        """
+        Depth of the build queue and wait times of builds, in seconds.
+        """
+        return Response(BuildScheduler().stats())
+
+    @decorators.detail_route()
+    def log(self, request, **kwargs):
+        """
+        Build output, from the character offset passed as ``offset`` on.
+
+        Returns the offset to pass to get the following output, so that a
+        running build's log can be followed without reading it all again.
+        """
+        build = get_object_or_404(
+            Build.objects.api(self.request.user), pk=kwargs['pk'])
+        try:
+            offset = int(request.QUERY_PARAMS.get('offset', 0))
+        except ValueError:
+            return Response({'error': 'Invalid offset'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        (output, next_offset) = build.get_log(offset=offset,
+                                              limit=self.log_page_size)
+        return Response({
+            'output': output,
+            'offset': next_offset,
+            'finished': build.finished,
+        })
+
+    @decorators.detail_route(permission_classes=[permissions.IsAdminUser], methods=['post'])
+    def add_phases(self, request, **kwargs):
+        """
+        Record the time spent on a list of build phases and commands.
+        """
+        build = get_object_or_404(
+            Build.objects.api(self.request.user), pk=kwargs['pk'])
+        serializer = BuildPhaseSerializer(data=request.DATA, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors,
+                            status=status.HTTP_400_BAD_REQUEST)
+        serializer.save(build=build)
+        return Response(status=status.HTTP_201_CREATED)
+
+    @decorators.detail_route(permission_classes=[permissions.IsAdminUser], methods=['post'])
+    def append_log(self, request, **kwargs):
+        """
+        Append a chunk of output to the build log at ``offset``.
+
+        A chunk is only stored once, so a builder can safely retry a request.
+        """
+        build = get_object_or_404(
+            Build.objects.api(self.request.user), pk=kwargs['pk'])
+        data = request.DATA
+        try:
+            offset = int(data['offset'])
+            output = data['output']
+        except (KeyError, TypeError, ValueError):
+            return Response({'error': 'An offset and output are required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        (chunk, created) = BuildLogChunk.objects.get_or_create(
+            build=build, offset=offset, defaults={'output': output})
+        return Response(
+            {'offset': chunk.offset + len(chunk.output)},
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
 
 class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
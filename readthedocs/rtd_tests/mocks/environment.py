@@ -1,3 +1,5 @@
+from io import BytesIO
+
 import mock
 
 from readthedocs.doc_builder.environments import BuildEnvironment
@@ -14,8 +16,8 @@ class EnvironmentMockGroup(object):
 
             'api_versions': mock.patch(
                 'readthedocs.projects.models.Project.api_versions'),
-            'non_blocking_lock': mock.patch(
-                'readthedocs.vcs_support.utils.NonBlockingLock.__enter__'),
+            'lock': mock.patch(
+                'readthedocs.vcs_support.utils.Lock.__enter__'),
 
             'append_conf': mock.patch(
                 'readthedocs.doc_builder.backends.sphinx.BaseSphinx.append_conf'),
@@ -46,7 +48,8 @@ class EnvironmentMockGroup(object):
         '''Create a patch object for class patches'''
         for patch in self.patches:
             self.mocks[patch] = self.patches[patch].start()
-        self.mocks['process'].communicate.return_value = ('', '')
+        self.mocks['process'].stdout = BytesIO()
+        self.mocks['process'].stderr = BytesIO()
         self.mocks['process'].returncode = 0
         self.mocks['popen'].return_value = self.mocks['process']
         self.mocks['docker'].return_value = self.mocks['docker_client']
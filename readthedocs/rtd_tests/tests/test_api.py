@@ -2,6 +2,9 @@ from django.test import TestCase
 import json
 import base64
 
+from readthedocs.builds.models import Build, BuildLogChunk
+from readthedocs.projects.models import Project
+
 
 super_auth = base64.b64encode('super:test')
 eric_auth = base64.b64encode('eric:test')
@@ -33,6 +36,59 @@ class APIBuildTests(TestCase):
         obj = json.loads(resp.content)
         self.assertEqual(obj['output'], 'Test Output')
 
+    def test_build_log(self):
+        '''Build output is appended once per offset and read from an offset'''
+        build = Build.objects.create(project=Project.objects.get(pk=1),
+                                     state='building')
+        url = '/api/v2/build/{0}/'.format(build.pk)
+        for (offset, output) in [(0, 'Running'), (7, ' sphinx'), (0, 'Again')]:
+            resp = self.client.post(
+                url + 'append_log/',
+                data=json.dumps({'offset': offset, 'output': output}),
+                content_type='application/json',
+                HTTP_AUTHORIZATION='Basic %s' % super_auth)
+            self.assertIn(resp.status_code, [200, 201])
+        self.assertEqual(build.log_chunks.count(), 2)
+
+        resp = self.client.get(url + 'log/', data={'offset': 0})
+        self.assertEqual(resp.data['output'], 'Running sphinx')
+        self.assertEqual(resp.data['offset'], 14)
+        self.assertFalse(resp.data['finished'])
+        resp = self.client.get(url + 'log/', data={'offset': 7})
+        self.assertEqual(resp.data['output'], ' sphinx')
+        resp = self.client.get(url + 'log/', data={'offset': 14})
+        self.assertEqual(resp.data['output'], '')
+        self.assertEqual(resp.data['offset'], 14)
+
+        # Offsets within a chunk, and chunks missing from the log
+        resp = self.client.get(url + 'log/', data={'offset': 3})
+        self.assertEqual(resp.data['output'], 'ning sphinx')
+        self.assertEqual(resp.data['offset'], 14)
+        BuildLogChunk.objects.create(build=build, offset=20, output=' done')
+        resp = self.client.get(url + 'log/', data={'offset': 14})
+        self.assertEqual(resp.data['output'], ' done')
+        self.assertEqual(resp.data['offset'], 25)
+        self.assertEqual(build.get_log(offset=10, limit=1), (u'hinx', 14))
+
+    def test_build_phases(self):
+        '''Build phase timing is recorded and returned with the build'''
+        build = Build.objects.create(project=Project.objects.get(pk=1))
+        url = '/api/v2/build/{0}/'.format(build.pk)
+        phases = [
+            {'type': 'command', 'name': 'sphinx-build', 'phase': 'build',
+             'start': 1.0, 'wall_time': 2.0, 'cpu_time': 1.5},
+            {'type': 'phase', 'name': 'build', 'phase': '',
+             'start': 0.5, 'wall_time': 3.0, 'cpu_time': 2.0},
+        ]
+        resp = self.client.post(url + 'add_phases/', data=json.dumps(phases),
+                                content_type='application/json',
+                                HTTP_AUTHORIZATION='Basic %s' % super_auth)
+        self.assertEqual(resp.status_code, 201)
+        resp = self.client.get(url)
+        self.assertEqual([phase['name'] for phase in resp.data['phases']],
+                         ['build', 'sphinx-build'])
+        self.assertEqual(resp.data['phases'][1]['cpu_time'], 1.5)
+
 
 class APITests(TestCase):
     fixtures = ['eric.json', 'test_data.json']
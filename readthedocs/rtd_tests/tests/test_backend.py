@@ -1,13 +1,18 @@
-from os.path import exists
+import os
+from os.path import exists, join
 
 from django.contrib.auth.models import User
+from django.test.utils import override_settings
+from mock import patch
 
 from readthedocs.projects.models import Project
 from readthedocs.rtd_tests.base import RTDTestCase
 
-from readthedocs.rtd_tests.utils import make_test_git, make_test_hg
+from readthedocs.rtd_tests.utils import (add_git_submodule, check_output,
+                                         make_test_git, make_test_hg)
 
 
+@override_settings(REPO_MIRROR_ENABLE=True)
 class TestGitBackend(RTDTestCase):
     def setUp(self):
         git_repo = make_test_git()
@@ -51,6 +56,126 @@ class TestGitBackend(RTDTestCase):
         repo.checkout()
         self.assertTrue(exists(repo.working_dir))
 
+    def test_git_checkout_from_mirror(self):
+        repos = [self.project.vcs_repo(slug) for slug in ['latest', 'stable']]
+        for repo in repos:
+            repo.checkout()
+            alternates = join(repo.working_dir, '.git', 'objects', 'info',
+                              'alternates')
+            with open(alternates) as alternates_file:
+                self.assertEqual(alternates_file.read().strip(),
+                                 join(self.project.mirror_path(), 'objects'))
+            self.assertIn('master', [branch.verbose_name
+                                     for branch in repo.branches])
+
+    @override_settings(REPO_MIRROR_ENABLE=False)
+    def test_git_checkout_without_mirror(self):
+        repo = self.project.vcs_repo()
+        repo.checkout()
+        self.assertTrue(exists(join(repo.working_dir, '.git')))
+        self.assertFalse(exists(join(repo.working_dir, '.git', 'objects',
+                                     'info', 'alternates')))
+        self.assertFalse(exists(self.project.mirror_path()))
+
+    def test_git_fetch_skipped_when_unchanged(self):
+        repo = self.project.vcs_repo()
+        repo.checkout()
+        self.assertEqual(repo.remote_refs(), repo.mirror_refs())
+        with patch.object(repo, 'mirror_fetched', return_value=0):
+            with patch.object(repo, 'run', wraps=repo.run) as run:
+                repo.checkout()
+        commands = [call[0][1:3] for call in run.call_args_list]
+        self.assertIn(('ls-remote', '--heads'), commands)
+        self.assertNotIn(('--git-dir=' + self.project.mirror_path(), 'fetch'),
+                         commands)
+
+    def test_git_recent_fetch_reused(self):
+        repo = self.project.vcs_repo()
+        repo.checkout()
+        git_dir = '--git-dir=' + join(self.project.repo, '.git')
+        check_output(['git', git_dir, 'commit', '--allow-empty', '-m',
+                      'pushed'])
+        pushed = check_output(['git', git_dir, 'rev-parse', 'HEAD']).strip()
+
+        # The fetch of the first checkout is recent enough
+        repo = self.project.vcs_repo()
+        with patch.object(repo, 'run', wraps=repo.run) as run:
+            repo.checkout()
+        commands = [call[0][1:3] for call in run.call_args_list]
+        self.assertNotIn(('ls-remote', '--heads'), commands)
+
+        # But doesn't have the commit that was pushed since
+        repo = self.project.vcs_repo(required_commit=pushed)
+        repo.checkout()
+        self.assertEqual(repo.commit, pushed)
+
+    def test_git_submodules_skipped_when_unchanged(self):
+        repo = self.project.vcs_repo()
+        repo.checkout()
+        open(join(repo.working_dir, '.gitmodules'), 'w').close()
+        repo.update_submodules()
+        with patch.object(repo, 'run', wraps=repo.run) as run:
+            repo.update_submodules()
+        self.assertEqual([call[0][1] for call in run.call_args_list],
+                         ['ls-files'])
+
+    def test_git_submodules_updated_when_changed(self):
+        add_git_submodule(self.project.repo, make_test_git(), 'with space',
+                          'sub module')
+        repo = self.project.vcs_repo()
+        with patch.dict(os.environ, {'GIT_CONFIG_COUNT': '1',
+                                     'GIT_CONFIG_KEY_0': 'protocol.file.allow',
+                                     'GIT_CONFIG_VALUE_0': 'always'}):
+            repo.checkout()
+            readme = join(repo.working_dir, 'sub module', 'README')
+            self.assertTrue(exists(readme))
+            # The submodule borrows objects from the submodule cache
+            self.assertTrue(exists(join(repo.working_dir, '.git', 'modules',
+                                        'with space', 'objects', 'info',
+                                        'alternates')))
+            with patch.object(repo, 'run', wraps=repo.run) as run:
+                repo.update_submodules()
+            self.assertNotIn(('submodule', 'update'),
+                             [call[0][1:3] for call in run.call_args_list])
+
+            # Submodules with changed files are checked out again
+            with open(readme, 'w') as readme_file:
+                readme_file.write('changed')
+            repo.update_submodules()
+            with open(readme) as readme_file:
+                self.assertNotEqual(readme_file.read(), 'changed')
+
+    def test_git_submodule_urls(self):
+        repo = self.project.vcs_repo()
+        output = ('submodule.with space.url\nhttps://example.com/a.git\0'
+                  'submodule.other.url\nhttps://example.com/b.git\0'
+                  'submodule.copy.url\nhttps://example.com/a.git\0')
+        with patch.object(repo, 'run', return_value=(0, output, '')):
+            self.assertEqual(repo.submodule_urls(),
+                             ['https://example.com/a.git',
+                              'https://example.com/b.git'])
+
+    def test_parse_git_refs(self):
+        data = """\
+refs/remotes/origin/HEAD 1d3a2c8d2a5e3bcb0be8bd2e1d40ba3c1e6ae1a5
+refs/remotes/origin/master 1d3a2c8d2a5e3bcb0be8bd2e1d40ba3c1e6ae1a5
+refs/tags/2.0.0 3b32886c8d3cb815df3793b3937b2e91d0fb00f1 c0288a17899b2c6818f74e3a90b77e2a1779f96a
+refs/tags/2.0.1 bd533a768ff661991a689d3758fcfe72f455435d
+"""
+        repo = self.project.vcs_repo()
+        repo._refs = repo.parse_refs(data)
+        self.assertEqual(
+            [(x.identifier, x.verbose_name) for x in repo.tags],
+            [('3b32886c8d3cb815df3793b3937b2e91d0fb00f1', '2.0.0'),
+             ('bd533a768ff661991a689d3758fcfe72f455435d', '2.0.1')])
+        self.assertEqual(
+            [(x.identifier, x.verbose_name) for x in repo.branches],
+            [('origin/master', 'master')])
+        self.assertEqual(repo.find_ref('master'), 'origin/master')
+        self.assertEqual(repo.find_ref('2.0.0'), '2.0.0')
+        self.assertTrue(repo.ref_exists('tags/2.0.1'))
+        self.assertFalse(repo.ref_exists('0.1'))
+
     def test_parse_git_tags(self):
         data = """\
             3b32886c8d3cb815df3793b3937b2e91d0fb00f1 refs/tags/2.0.0
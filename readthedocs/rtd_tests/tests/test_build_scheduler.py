@@ -0,0 +1,93 @@
+import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from django_dynamic_fixture import get
+
+from readthedocs.builds.constants import (BUILD_PRIORITY_BULK,
+                                          BUILD_PRIORITY_INTERACTIVE)
+from readthedocs.builds.models import Build, Version
+from readthedocs.builds.scheduler import BuildScheduler
+from readthedocs.core.utils import trigger_build
+from readthedocs.projects.models import Project
+
+
+@mock.patch('readthedocs.projects.tasks.update_docs')
+class BuildSchedulerTests(TestCase):
+
+    def setUp(self):
+        self.user = get(User)
+        self.projects = [get(Project, skip=False, users=[self.user])
+                         for _ in range(3)]
+
+    def queue(self, project, priority=BUILD_PRIORITY_INTERACTIVE):
+        version = get(Version, project=project)
+        return get(Build, project=project, version=version, state='triggered',
+                   priority=priority, dispatched=None)
+
+    def test_limits(self, update_docs):
+        '''Project and user limits hold back builds'''
+        for _ in range(3):
+            self.queue(self.projects[0])
+        self.queue(self.projects[1])
+        scheduler = BuildScheduler(concurrency=10, project_limit=2,
+                                   user_limit=3, weights={})
+        dispatched = scheduler.schedule()
+        self.assertEqual(len(dispatched), 3)
+        self.assertEqual(update_docs.delay.call_count, 3)
+        self.assertEqual(
+            len([b for b in dispatched if b.project == self.projects[0]]), 2)
+        self.assertEqual(scheduler.schedule(), [])
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['waiting'], 1)
+        self.assertEqual(stats['running'], 3)
+
+        # Finished builds free up their slots
+        Build.objects.filter(dispatched__isnull=False).update(state='finished')
+        self.assertEqual(len(scheduler.schedule()), 1)
+
+    def test_priority_and_fair_share(self, update_docs):
+        '''Builds go by priority class, then to the least served project'''
+        bulk = self.queue(self.projects[0], priority=BUILD_PRIORITY_BULK)
+        self.queue(self.projects[0])
+        self.queue(self.projects[0])
+        fair = self.queue(self.projects[1])
+        scheduler = BuildScheduler(concurrency=2, project_limit=5,
+                                   user_limit=5, weights={})
+        dispatched = scheduler.schedule()
+        self.assertEqual(len(dispatched), 2)
+        self.assertIn(fair, dispatched)
+        self.assertNotIn(bulk, dispatched)
+
+    def test_trigger_build(self, update_docs):
+        '''Triggered builds wait for the scheduler to dispatch them'''
+        version = self.projects[0].versions.get(slug='latest')
+        with mock.patch('readthedocs.core.utils.BUILD_SCHEDULER_ENABLE', True):
+            with mock.patch('readthedocs.projects.tasks.schedule_builds') as schedule:
+                build = trigger_build(project=self.projects[0], version=version)
+        self.assertTrue(schedule.delay.called)
+        self.assertFalse(update_docs.delay.called)
+        self.assertIsNone(build.dispatched)
+        self.assertEqual(build.priority, BUILD_PRIORITY_INTERACTIVE + 1)
+
+    def test_update_repos_records_bulk_builds(self, update_docs):
+        '''Bulk rebuilds wait for the scheduler like other builds'''
+        with mock.patch('readthedocs.core.utils.BUILD_SCHEDULER_ENABLE', True), \
+                mock.patch('readthedocs.core.management.commands.update_repos'
+                           '.BUILD_SCHEDULER_ENABLE', True), \
+                mock.patch('readthedocs.projects.tasks.schedule_builds'):
+            call_command('update_repos', self.projects[0].slug, version='all',
+                         force=True)
+        self.assertFalse(update_docs.delay.called)
+        builds = Build.objects.filter(project=self.projects[0])
+        self.assertTrue(builds.exists())
+        self.assertEqual(
+            builds.count(),
+            self.projects[0].versions.filter(active=True,
+                                             uploaded=False).count())
+        for build in builds:
+            self.assertTrue(build.force)
+            self.assertEqual(build.priority, BUILD_PRIORITY_BULK + 1)
@@ -1,13 +1,20 @@
+import imp
+import json
 import os
+import shutil
 import subprocess
+import tempfile
+from io import BytesIO
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django_dynamic_fixture import get
 from django_dynamic_fixture import fixture
 import mock
 
 from readthedocs.projects.models import Project
 from readthedocs.doc_builder.environments import LocalEnvironment
+from readthedocs.doc_builder.backends.sphinx import MULTIBUILD_SCRIPT
 from readthedocs.doc_builder.loader import get_builder_class
 from readthedocs.projects.tasks import UpdateDocsTask
 
@@ -48,6 +55,8 @@ class BuildEnvironmentTests(TestCase):
         cmd = self.mocks.popen.call_args_list[0][0]
         self.assertRegexpMatches(cmd[0][0], r'python')
         self.assertRegexpMatches(cmd[0][1], r'sphinx-build')
+        # Builds that aren't incremental never reuse doctrees, forced or not
+        self.assertIn('-E', cmd[0])
 
     def test_build_respects_pdf_flag(self):
         '''Build output format control'''
@@ -93,6 +102,172 @@ class BuildEnvironmentTests(TestCase):
         # PDF however was disabled and therefore not built.
         self.assertFalse(self.mocks.pdf_build.called)
 
+    @override_settings(BUILD_CONCURRENCY=4)
+    def test_build_concurrently(self):
+        '''Secondary builders run concurrently and report outcomes'''
+        project = get(Project,
+                      slug='project-1',
+                      documentation_type='sphinx',
+                      conf_py_file='test_conf.py',
+                      enable_pdf_build=True,
+                      enable_epub_build=True,
+                      versions=[fixture()])
+        version = project.versions.all()[0]
+
+        build_env = LocalEnvironment(project=project, version=version, build={})
+        task = UpdateDocsTask(build_env=build_env, project=project,
+                              version=version, search=False, localmedia=False)
+        self.mocks.pdf_build.return_value = True
+        self.mocks.epub_build.return_value = False
+        outcomes = task.build_docs()
+
+        self.mocks.html_build.assert_called_once_with()
+        self.mocks.pdf_build.assert_called_once_with()
+        self.mocks.epub_build.assert_called_once_with()
+        self.assertTrue(outcomes['pdf'])
+        self.assertFalse(outcomes['epub'])
+        self.assertFalse(outcomes['search'])
+        self.assertFalse(outcomes['localmedia'])
+
+    @override_settings(SPHINX_INCREMENTAL_BUILDS=True)
+    def test_build_incremental(self):
+        '''Incremental builds fall back to full builds on config changes'''
+        self.mocks.patches['html_build'].stop()
+        project = get(Project,
+                      slug='project-incremental',
+                      documentation_type='sphinx',
+                      versions=[fixture()])
+        version = project.versions.all()[0]
+        doctrees_path = project.doctrees_path(version.slug)
+        os.makedirs(doctrees_path)
+        self.addCleanup(shutil.rmtree, project.doc_path)
+
+        build_env = LocalEnvironment(project=project, version=version, build={})
+        builder_class = get_builder_class(project.documentation_type)
+        # Output streams are closed once read, each build gets a new process
+        self.mocks.popen.side_effect = lambda *args, **kwargs: mock.Mock(
+            stdout=BytesIO(), returncode=0)
+
+        def build(fingerprint):
+            builder = builder_class(build_env)
+            builder.config_fingerprint = fingerprint
+            self.assertEqual(builder.doctrees_dir, doctrees_path)
+            builder.build()
+            return self.mocks.popen.call_args[0][0]
+
+        # No previous build, then an unchanged and a changed configuration
+        self.assertIn('-E', build('abc'))
+        self.assertNotIn('-E', build('abc'))
+        self.assertIn('-E', build('def'))
+
+    @override_settings(SPHINX_COMBINED_BUILD=True)
+    def test_build_combined(self):
+        '''All Sphinx formats are written by a single process'''
+        conf_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, conf_dir)
+        self.mocks.conf_dir.return_value = conf_dir
+        project = get(Project,
+                      slug='project-combined',
+                      documentation_type='sphinx',
+                      enable_pdf_build=False,
+                      enable_epub_build=True,
+                      versions=[fixture()])
+        version = project.versions.all()[0]
+
+        def run_script(args, **kwargs):
+            # The script writes its results to the path it was passed
+            (results_path, formats) = args[-2:]
+            with open(results_path, 'w') as results_file:
+                json.dump(dict((name, name != 'sphinx_search')
+                               for (name, _, _) in json.loads(formats)),
+                          results_file)
+            return self.mocks.process
+        self.mocks.popen.side_effect = run_script
+
+        build_env = LocalEnvironment(project=project, version=version, build={})
+        task = UpdateDocsTask(build_env=build_env, project=project,
+                              version=version, localmedia=False)
+        outcomes = task.build_docs()
+
+        self.assertEqual(self.mocks.popen.call_count, 1)
+        self.assertFalse(self.mocks.html_build.called)
+        self.assertFalse(self.mocks.epub_build.called)
+        self.assertTrue(outcomes['html'])
+        self.assertTrue(outcomes['epub'])
+        self.assertFalse(outcomes['search'])
+        self.assertFalse(outcomes['pdf'])
+        self.mocks.html_move.assert_called_once_with(fence=task.fence)
+        self.mocks.epub_move.assert_called_once_with(fence=task.fence)
+
+    def test_multibuild_script(self):
+        '''Each format is written from the environment of the first'''
+        sphinx_multibuild = imp.load_source('sphinx_multibuild',
+                                            MULTIBUILD_SCRIPT)
+        src_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src_dir)
+        with open(os.path.join(src_dir, 'conf.py'), 'w') as fh:
+            fh.write("master_doc = 'index'\n")
+        with open(os.path.join(src_dir, 'index.rst'), 'w') as fh:
+            fh.write('Title\n=====\n')
+        results_path = os.path.join(src_dir, 'results.json')
+        cwd = os.getcwd()
+        os.chdir(src_dir)
+        try:
+            sphinx_multibuild.main(
+                '_build/doctrees', 'en', '1', results_path,
+                json.dumps([['html', 'html', '_build/html']]))
+            doctree = os.path.join(src_dir, '_build', 'doctrees',
+                                   'index.doctree')
+            mtime = int(os.path.getmtime(doctree)) - 10
+            os.utime(doctree, (mtime, mtime))
+            self.assertEqual(sphinx_multibuild.main(
+                '_build/doctrees', 'en', '0', results_path,
+                json.dumps([['html', 'html', '_build/html'],
+                            ['singlehtml', 'singlehtml', '_build/single']])),
+                0)
+        finally:
+            os.chdir(cwd)
+        with open(results_path) as fh:
+            self.assertEqual(json.load(fh),
+                             {'html': True, 'singlehtml': True})
+        self.assertTrue(os.path.exists(
+            os.path.join(src_dir, '_build', 'single', 'index.html')))
+        # The source wasn't read again
+        self.assertEqual(os.path.getmtime(doctree), mtime)
+
+    def test_build_skipped_when_up_to_date(self):
+        '''Versions are not built again from the same commit and settings'''
+        project = get(Project,
+                      documentation_type='sphinx',
+                      versions=[fixture()])
+        version = project.versions.all()[0]
+        version.built = True
+        build_env = LocalEnvironment(project=project, version=version, build={})
+        task = UpdateDocsTask(build_env=build_env, project=project,
+                              version=version, search=False, localmedia=False)
+        task.build = {'commit': 'a1b2c3'}
+        task.build_force = False
+        fingerprint = task.get_build_fingerprint()
+        task.build['commit'] = 'd4e5f6'
+        self.assertNotEqual(task.get_build_fingerprint(), fingerprint)
+        task.build['commit'] = 'a1b2c3'
+        project.enable_pdf_build = not project.enable_pdf_build
+        self.assertNotEqual(task.get_build_fingerprint(), fingerprint)
+        project.enable_pdf_build = not project.enable_pdf_build
+
+        with mock.patch.object(task, 'setup_vcs'), \
+                mock.patch.object(task, 'get_last_fingerprint',
+                                  return_value=fingerprint), \
+                mock.patch.object(task, 'setup_environment') as setup_env:
+            task.run_build()
+            self.assertFalse(setup_env.called)
+            self.assertTrue(task.build['up_to_date'])
+
+            # Forced builds are always built
+            task.build_force = True
+            task.run_build()
+            self.assertTrue(setup_env.called)
+
     def test_builder_comments(self):
         '''Normal build with comments'''
         project = get(Project,
@@ -144,12 +319,9 @@ class BuildEnvironmentTests(TestCase):
             (('', ''), 0),  # makeindex
             (('', ''), 0),  # latex
         ]
-        mock_obj = mock.Mock()
-        mock_obj.communicate.side_effect = [output for (output, status)
-                                            in returns]
-        type(mock_obj).returncode = mock.PropertyMock(
-            side_effect=[status for (output, status) in returns])
-        self.mocks.popen.return_value = mock_obj
+        self.mocks.popen.side_effect = [
+            mock.Mock(stdout=BytesIO(output), returncode=status)
+            for ((output, _), status) in returns]
 
         with build_env:
             built_docs = task.build_docs()
@@ -183,12 +355,9 @@ class BuildEnvironmentTests(TestCase):
             (('', ''), 0),  # makeindex
             (('', ''), 0),  # latex
         ]
-        mock_obj = mock.Mock()
-        mock_obj.communicate.side_effect = [output for (output, status)
-                                            in returns]
-        type(mock_obj).returncode = mock.PropertyMock(
-            side_effect=[status for (output, status) in returns])
-        self.mocks.popen.return_value = mock_obj
+        self.mocks.popen.side_effect = [
+            mock.Mock(stdout=BytesIO(output), returncode=status)
+            for ((output, _), status) in returns]
 
         with build_env:
             built_docs = task.build_docs()
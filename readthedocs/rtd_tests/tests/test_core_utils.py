@@ -0,0 +1,93 @@
+import time
+
+import mock
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django_dynamic_fixture import get
+
+from readthedocs.builds.models import Build, Version
+from readthedocs.core.utils import run_on_app_servers, trigger_build
+from readthedocs.core.utils.servers import run_command, run_on_servers
+from readthedocs.projects.models import Project
+
+
+class CoreUtilTests(TestCase):
+
+    def setUp(self):
+        self.project = get(Project, skip=False)
+        self.version = get(Version, project=self.project)
+
+    @mock.patch('readthedocs.projects.tasks.update_docs')
+    def test_trigger_build_coalesces_queued_builds(self, update_docs):
+        '''Triggers for a version with a queued build are merged into it'''
+        build = trigger_build(project=self.project, version=self.version,
+                              commit='a1b2c3')
+        merged = trigger_build(project=self.project, version=self.version,
+                               commit='d4e5f6')
+        self.assertEqual(merged.pk, build.pk)
+        self.assertEqual(merged.merged_triggers, 1)
+        self.assertEqual(Build.objects.get(pk=build.pk).commit, 'd4e5f6')
+        self.assertEqual(update_docs.delay.call_count, 1)
+
+        # Once the build started, a new build is queued
+        Build.objects.filter(pk=build.pk).update(state='cloning')
+        new_build = trigger_build(project=self.project, version=self.version)
+        self.assertNotEqual(new_build.pk, build.pk)
+        self.assertEqual(update_docs.delay.call_count, 2)
+
+
+class RunOnServersTests(TestCase):
+
+    @mock.patch('readthedocs.core.utils.servers.run_command')
+    def test_run_on_servers_retries_failed_servers(self, run_command):
+        '''Failing servers are retried, and each server gets a result'''
+        calls = []
+
+        def run(command, timeout):
+            calls.append(command)
+            if command.startswith('rsync web2') and calls.count(command) == 1:
+                return (23, 'rsync error')
+            return (0, 'sent 1,024 bytes  received 76 bytes  2200.00 bytes/sec')
+
+        run_command.side_effect = run
+        results = run_on_servers(
+            ['web1', 'web2', 'web3'],
+            lambda server: ['mkdir %s' % server, 'rsync %s' % server],
+            concurrency=2, retries=1)
+        self.assertEqual([result.server for result in results],
+                         ['web1', 'web2', 'web3'])
+        self.assertTrue(all(result.successful for result in results))
+        self.assertEqual([result.attempts for result in results], [1, 2, 1])
+        self.assertEqual(results[0].bytes_transferred, 2 * 1100)
+        self.assertEqual(len(calls), 8)
+
+    @mock.patch('readthedocs.core.utils.servers.run_command')
+    def test_run_on_servers_stops_after_retries(self, run_command):
+        run_command.return_value = (-1, '')
+        (result,) = run_on_servers(['web1'], lambda server: ['a', 'b'],
+                                   retries=2)
+        self.assertFalse(result.successful)
+        self.assertEqual(result.exit_code, -1)
+        self.assertEqual(result.attempts, 3)
+        self.assertEqual(run_command.call_count, 3)
+
+    def test_run_command_kills_children_on_timeout(self):
+        '''Processes started by the shell are killed with it'''
+        start = time.time()
+        (exit_code, output) = run_command('echo started; sleep 30; true',
+                                          timeout=0.5)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(exit_code, -1)
+        self.assertEqual(output, 'started\n')
+
+    @mock.patch('readthedocs.core.utils.log')
+    @mock.patch('readthedocs.core.utils.servers.run_command')
+    def test_run_on_app_servers_logs_failures(self, run_command, log):
+        run_command.return_value = (1, 'failed')
+        with override_settings(MULTIPLE_APP_SERVERS=['web1', 'web2']):
+            results = run_on_app_servers('rm -rf /tmp/docs')
+        self.assertFalse(any(result.successful for result in results))
+        log.error.assert_called_once_with(
+            'Running rm -rf /tmp/docs failed on web1 (exit code 1), '
+            'web2 (exit code 1)')
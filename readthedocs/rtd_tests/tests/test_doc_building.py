@@ -4,6 +4,10 @@ import os.path
 import shutil
 import uuid
 import re
+import threading
+import time
+from functools import partial
+from io import BytesIO
 
 from django.test import TestCase
 from django.contrib.auth.models import User
@@ -15,8 +19,11 @@ from readthedocs.builds.models import Version
 from readthedocs.doc_builder.environments import (DockerEnvironment,
                                                   DockerBuildCommand,
                                                   LocalEnvironment,
-                                                  BuildCommand)
+                                                  BuildCommand, CommandOutput,
+                                                  ChildCPUTimer)
 from readthedocs.doc_builder.exceptions import BuildEnvironmentError
+from readthedocs.doc_builder.constants import BUILD_LOG_CHUNK_SIZE
+from readthedocs.doc_builder.pool import DockerContainerPool
 
 from readthedocs.rtd_tests.utils import make_test_git
 from readthedocs.rtd_tests.base import RTDTestCase
@@ -40,23 +47,108 @@ class TestLocalEnvironment(TestCase):
     def test_normal_execution(self):
         '''Normal build in passing state'''
         self.mocks.configure_mock('process', {
-            'communicate.return_value': ('This is okay', '')})
+            'stdout': BytesIO(b'This is okay')})
         type(self.mocks.process).returncode = PropertyMock(return_value=0)
 
         build_env = LocalEnvironment(version=self.version, project=self.project,
                                      build={})
         with build_env:
             build_env.run('echo', 'test')
-        self.assertTrue(self.mocks.process.communicate.called)
+        self.assertTrue(self.mocks.process.wait.called)
         self.assertTrue(build_env.done)
         self.assertTrue(build_env.successful)
         self.assertEqual(len(build_env.commands), 1)
         self.assertEqual(build_env.commands[0].output, u'This is okay')
 
+    @patch('readthedocs.doc_builder.environments.api_v2')
+    def test_streamed_log(self, mock_api):
+        '''Output is appended to the build log in chunks, once'''
+        output = u'x' * (BUILD_LOG_CHUNK_SIZE + 10)
+        self.mocks.configure_mock('process', {
+            'stdout': BytesIO(output.encode('utf-8'))})
+        type(self.mocks.process).returncode = PropertyMock(return_value=0)
+
+        build_env = LocalEnvironment(version=self.version, project=self.project,
+                                     build={'id': 1})
+        with build_env:
+            build_env.run('echo', 'test')
+            build_env.update_build(state='building')
+        posts = [call[0][0] for call in
+                 mock_api.build.return_value.append_log.post.call_args_list]
+        self.assertEqual([post['offset'] for post in posts],
+                         [0, BUILD_LOG_CHUNK_SIZE])
+        self.assertEqual(u''.join(post['output'] for post in posts),
+                         u'echo test\n' + output + u'\n')
+        self.assertNotIn('output', build_env.build)
+
+    @patch('readthedocs.doc_builder.environments.api_v2')
+    def test_streamed_log_from_threads(self, mock_api):
+        '''Output appended by several threads at once is sent once'''
+        build_env = LocalEnvironment(version=self.version, project=self.project,
+                                     build={'id': 1})
+
+        def append(char):
+            for _ in range(BUILD_LOG_CHUNK_SIZE // 10):
+                build_env.append_log(char * 7)
+
+        threads = [threading.Thread(target=append, args=(char,))
+                   for char in u'abcd']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        build_env.flush_log()
+        posts = sorted(
+            (call[0][0] for call in
+             mock_api.build.return_value.append_log.post.call_args_list),
+            key=lambda post: post['offset'])
+        output = u''.join(post['output'] for post in posts)
+        self.assertEqual(
+            [post['offset'] for post in posts],
+            range(0, len(output), BUILD_LOG_CHUNK_SIZE))
+        for char in u'abcd':
+            self.assertEqual(output.count(char),
+                             BUILD_LOG_CHUNK_SIZE // 10 * 7)
+
+    @patch('readthedocs.doc_builder.environments.api_v2')
+    def test_phase_timing(self, mock_api):
+        '''Phases and the commands run in them are timed'''
+        self.mocks.configure_mock('process', {
+            'stdout': BytesIO()})
+        type(self.mocks.process).returncode = PropertyMock(return_value=0)
+
+        build_env = LocalEnvironment(version=self.version, project=self.project,
+                                     build={'id': 1})
+        with build_env:
+            with build_env.phase('setup'):
+                with build_env.phase('install'):
+                    build_env.run('echo', 'test')
+        (command, install, setup) = build_env.phases
+        self.assertEqual((command['type'], command['name'], command['phase']),
+                         ('command', 'echo test', 'install'))
+        self.assertEqual((install['name'], install['phase']),
+                         ('install', 'setup'))
+        self.assertEqual((setup['name'], setup['phase']), ('setup', ''))
+        self.assertGreaterEqual(setup['wall_time'], install['wall_time'])
+        self.assertIsNotNone(command['cpu_time'])
+        mock_api.build.return_value.add_phases.post.assert_called_once_with(
+            build_env.phases)
+
+    def test_overlapping_command_cpu_time(self):
+        '''CPU time isn't attributed to commands that ran alongside others'''
+        first = ChildCPUTimer()
+        second = ChildCPUTimer()
+        first.start()
+        second.start()
+        self.assertIsNone(second.stop())
+        self.assertIsNone(first.stop())
+        first.start()
+        self.assertIsNotNone(first.stop())
+
     def test_failing_execution(self):
         '''Build in failing state'''
         self.mocks.configure_mock('process', {
-            'communicate.return_value': ('This is not okay', '')})
+            'stdout': BytesIO(b'This is not okay')})
         type(self.mocks.process).returncode = PropertyMock(return_value=1)
 
         build_env = LocalEnvironment(version=self.version, project=self.project,
@@ -64,7 +156,7 @@ class TestLocalEnvironment(TestCase):
         with build_env:
             build_env.run('echo', 'test')
             self.fail('This should be unreachable')
-        self.assertTrue(self.mocks.process.communicate.called)
+        self.assertTrue(self.mocks.process.wait.called)
         self.assertTrue(build_env.done)
         self.assertTrue(build_env.failed)
         self.assertEqual(len(build_env.commands), 1)
@@ -78,7 +170,7 @@ class TestLocalEnvironment(TestCase):
         with build_env:
             raise BuildEnvironmentError('Foobar')
 
-        self.assertFalse(self.mocks.process.communicate.called)
+        self.assertFalse(self.mocks.process.wait.called)
         self.assertEqual(len(build_env.commands), 0)
         self.assertTrue(build_env.done)
         self.assertTrue(build_env.failed)
@@ -93,7 +185,7 @@ class TestLocalEnvironment(TestCase):
                 raise Exception()
 
         self.assertRaises(Exception, _inner)
-        self.assertFalse(self.mocks.process.communicate.called)
+        self.assertFalse(self.mocks.process.wait.called)
         self.assertTrue(build_env.done)
         self.assertTrue(build_env.failed)
 
@@ -158,7 +250,7 @@ class TestDockerEnvironment(TestCase):
         '''Command execution through Docker'''
         self.mocks.configure_mock('docker_client', {
             'exec_create.return_value': {'Id': 'container-foobar'},
-            'exec_start.return_value': 'This is the return',
+            'exec_start.return_value': ['This is the return'],
             'exec_inspect.return_value': {'ExitCode': 1},
         })
 
@@ -183,7 +275,7 @@ class TestDockerEnvironment(TestCase):
         response = Mock(status_code=500, reason='Because')
         self.mocks.configure_mock('docker_client', {
             'exec_create.return_value': {'Id': 'container-foobar'},
-            'exec_start.return_value': 'This is the return',
+            'exec_start.return_value': ['This is the return'],
             'exec_inspect.return_value': {'ExitCode': 0},
             'kill.side_effect': DockerAPIError(
                 'Failure killing container',
@@ -206,7 +298,7 @@ class TestDockerEnvironment(TestCase):
         self.mocks.configure_mock('docker_client', {
             'inspect_container.return_value': {'State': {'Running': True}},
             'exec_create.return_value': {'Id': 'container-foobar'},
-            'exec_start.return_value': 'This is the return',
+            'exec_start.return_value': ['This is the return'],
             'exec_inspect.return_value': {'ExitCode': 0},
         })
 
@@ -236,7 +328,7 @@ class TestDockerEnvironment(TestCase):
                 {'State': {'Running': False, 'ExitCode': 42}},
             ],
             'exec_create.return_value': {'Id': 'container-foobar'},
-            'exec_start.return_value': 'This is the return',
+            'exec_start.return_value': ['This is the return'],
             'exec_inspect.return_value': {'ExitCode': 0},
         })
 
@@ -251,6 +343,149 @@ class TestDockerEnvironment(TestCase):
         self.assertEqual(self.mocks.docker_client.exec_create.call_count, 1)
         self.assertTrue(build_env.failed)
 
+    @patch('readthedocs.doc_builder.environments.DOCKER_POOL_SIZE', 2)
+    def test_pooled_container(self):
+        '''Containers are leased from the pool and recycled'''
+        response = Mock(status_code=404, reason='Container not found')
+        idle_name = 'rtd-pool-1-1400000000-abcd1234'
+        labels = {'org.readthedocs.pool.path': self.project.doc_path}
+        running = {idle_name: {'Id': 'pooled', 'State': {'Running': True},
+                               'Config': {'Labels': labels}}}
+
+        def inspect_container(name):
+            if name not in running:
+                raise DockerAPIError('No container found', response,
+                                     'No container found')
+            return running[name]
+
+        def rename(name, new_name):
+            running[new_name] = running.pop(name)
+
+        self.mocks.configure_mock('docker_client', {
+            'containers.return_value': [
+                {'Names': ['/' + idle_name], 'Labels': labels}],
+            'inspect_container.side_effect': inspect_container,
+            'rename.side_effect': rename,
+            'exec_create.return_value': {'Id': 'container-foobar'},
+            'exec_start.return_value': ['This is the return'],
+            'exec_inspect.return_value': {'ExitCode': 0},
+        })
+
+        build_env = DockerEnvironment(version=self.version, project=self.project,
+                                      build={})
+        lock_path = os.path.join('/tmp', uuid.uuid4().hex)
+        self.addCleanup(os.remove, lock_path)
+        with patch('readthedocs.doc_builder.pool.time.time',
+                   return_value=1400000100), \
+                patch('readthedocs.doc_builder.environments.DockerContainerPool',
+                      partial(DockerContainerPool, lock_path=lock_path)):
+            with build_env:
+                build_env.run('echo', 'test', cwd='/tmp')
+
+        client = self.mocks.docker_client
+        self.assertEqual(client.create_container.call_count, 0)
+        self.assertEqual(client.remove_container.call_count, 0)
+        self.assertEqual(client.rename.call_args_list[0][0],
+                         (idle_name, 'version-foobar-of-pip-20'))
+        (name, idle_name) = client.rename.call_args_list[1][0]
+        self.assertEqual(name, 'version-foobar-of-pip-20')
+        self.assertTrue(idle_name.startswith('rtd-pool-2-1400000100-'))
+        self.assertTrue(build_env.successful)
+
+
+class TestDockerContainerPool(TestCase):
+    '''Test leasing and recycling of pooled containers'''
+
+    def setUp(self):
+        self.client = Mock()
+        self.client.exec_create.return_value = {'Id': 'exec'}
+        self.client.create_container.return_value = {'Id': 'new'}
+        self.lock_path = os.path.join('/tmp', uuid.uuid4().hex)
+        self.pool = DockerContainerPool(self.client, image='rtfd-build',
+                                        mem_limit='200m', size=2, max_uses=3,
+                                        max_idle=60, lock_path=self.lock_path)
+
+    def tearDown(self):
+        if os.path.exists(self.lock_path):
+            os.remove(self.lock_path)
+
+    def test_lease_creates_container(self):
+        self.client.containers.return_value = []
+        container = self.pool.lease('foo', '/tmp/pip')
+        self.assertEqual(container, {'Id': 'new', 'Uses': 0})
+        kwargs = self.client.create_container.call_args[1]
+        self.assertEqual(kwargs['name'], 'foo')
+        self.assertEqual(kwargs['mem_limit'], '200m')
+        self.assertEqual(kwargs['labels']['org.readthedocs.pool.path'],
+                         '/tmp/pip')
+        self.client.start.assert_called_with(container='foo')
+
+    def test_lease_removes_stale_container(self):
+        idle_name = self.pool.idle_name(1)
+        self.client.containers.return_value = [{'Names': ['/' + idle_name]}]
+        self.client.inspect_container.return_value = {
+            'State': {'Running': False, 'OOMKilled': True}}
+        container = self.pool.lease('foo', '/tmp/pip')
+        self.assertEqual(container['Id'], 'new')
+        self.client.remove_container.assert_called_with(idle_name)
+        self.assertEqual(self.client.rename.call_count, 0)
+
+    def test_trim_old_and_extra_idle_containers(self):
+        now = int(time.time())
+        names = [self.pool.idle_name(0, now - 1),
+                 self.pool.idle_name(0, now - 2),
+                 self.pool.idle_name(0, now - 3),
+                 self.pool.idle_name(0, now - 120)]
+        self.client.containers.return_value = [
+            {'Names': ['/' + name],
+             'Labels': {'org.readthedocs.pool.path': '/tmp/pip'}}
+            for name in reversed(names)]
+        self.pool.trim()
+        self.assertEqual(
+            [call[0][0] for call in self.client.remove_container.call_args_list],
+            names[2:])
+
+    def test_trim_per_project(self):
+        '''The pool size applies to the containers of each project'''
+        now = int(time.time())
+        containers = [
+            (self.pool.idle_name(0, now - count), path)
+            for (count, path) in enumerate(['/tmp/pip', '/tmp/kong',
+                                            '/tmp/pip', '/tmp/kong',
+                                            '/tmp/pip'])]
+        self.client.containers.return_value = [
+            {'Names': ['/' + name],
+             'Labels': {'org.readthedocs.pool.path': path}}
+            for (name, path) in containers]
+        self.pool.trim()
+        self.assertEqual(
+            [call[0][0] for call in self.client.remove_container.call_args_list],
+            [containers[4][0]])
+
+    def test_release_failed_build(self):
+        self.client.inspect_container.return_value = {
+            'State': {'Running': True}}
+        self.assertFalse(self.pool.release({'Id': 'foo', 'Uses': 0}, 'foo',
+                                           recycle=False))
+        self.client.remove_container.assert_called_with('foo')
+        self.assertEqual(self.client.rename.call_count, 0)
+
+    def test_release_timed_out(self):
+        self.client.inspect_container.return_value = {
+            'State': {'Running': False, 'ExitCode': 42}}
+        self.assertFalse(self.pool.release({'Id': 'foo', 'Uses': 0}, 'foo'))
+        self.client.remove_container.assert_called_with('foo')
+
+    def test_release_replaces_used_up_container(self):
+        self.client.containers.return_value = []
+        self.client.inspect_container.return_value = {
+            'State': {'Running': True},
+            'Config': {'Labels': {'org.readthedocs.pool.path': '/tmp/pip'}}}
+        self.assertFalse(self.pool.release({'Id': 'foo', 'Uses': 2}, 'foo'))
+        self.client.remove_container.assert_called_with('foo')
+        kwargs = self.client.create_container.call_args[1]
+        self.assertTrue(kwargs['name'].startswith('rtd-pool-0-'))
+
 
 class TestBuildCommand(TestCase):
     '''Test build command creation'''
@@ -311,11 +546,34 @@ class TestBuildCommand(TestCase):
         self.assertEqual(cmd.output, '')
         self.assertEqual(cmd.error, 'FOOBAR')
 
+    def test_streamed_output(self):
+        '''Output is sent to the build log as it is read'''
+        build_env = Mock()
+        cmd = BuildCommand(['/bin/bash', '-c', 'echo FOO; echo BAR'],
+                           build_env=build_env)
+        cmd.run()
+        self.assertEqual(cmd.output, 'FOO\nBAR\n')
+        self.assertEqual(
+            [call[0][0] for call in build_env.append_log.call_args_list],
+            [u'FOO\n', u'BAR\n'])
+
+    def test_truncated_output(self):
+        '''Only the start and end of long output is kept'''
+        logged = []
+        output = CommandOutput(limit=10, callback=logged.append)
+        for data in [b'abc', b'defghij', b'klmnopq', b'rstu']:
+            output.write(data)
+        output.close()
+        self.assertEqual(
+            output.getvalue(),
+            u'abcde\n\n[11 characters of output omitted]\n\nqrstu')
+        self.assertEqual(u''.join(logged), u'abcdefghijklmnopqrstu')
+
     @patch('subprocess.Popen')
     def test_unicode_output(self, mock_subprocess):
         '''Unicode output from command'''
         mock_process = Mock(**{
-            'communicate.return_value': (b'HérÉ îß sömê ünïçó∂é', ''),
+            'stdout': BytesIO(b'HérÉ îß sömê ünïçó∂é'),
         })
         mock_subprocess.return_value = mock_process
 
@@ -357,7 +615,10 @@ class TestDockerBuildCommand(TestCase):
         '''Unicode output from command'''
         self.mocks.configure_mock('docker_client', {
             'exec_create.return_value': {'Id': 'container-foobar'},
-            'exec_start.return_value': b'HérÉ îß sömê ünïçó∂é',
+            # Characters can be split across streamed chunks
+            'exec_start.return_value': [b'H\xc3\xa9r\xc3',
+                                        b'\x89 \xc3\xae\xc3\x9f s\xc3\xb6m\xc3\xaa '
+                                        b'\xc3\xbcn\xc3\xaf\xc3\xa7\xc3\xb3\xe2\x88\x82\xc3\xa9'],
             'exec_inspect.return_value': {'ExitCode': 0},
         })
         cmd = DockerBuildCommand(['echo', 'test'], cwd='/tmp/foobar')
@@ -376,7 +637,7 @@ class TestDockerBuildCommand(TestCase):
         '''Command is OOM killed'''
         self.mocks.configure_mock('docker_client', {
             'exec_create.return_value': {'Id': 'container-foobar'},
-            'exec_start.return_value': b'Killed\n',
+            'exec_start.return_value': [b'Killed\n'],
             'exec_inspect.return_value': {'ExitCode': 137},
         })
         cmd = DockerBuildCommand(['echo', 'test'], cwd='/tmp/foobar')
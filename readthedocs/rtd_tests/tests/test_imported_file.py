@@ -1,4 +1,7 @@
 import os
+import shutil
+import tempfile
+
 from django.test import TestCase
 
 from readthedocs.projects.tasks import _manage_imported_files
@@ -47,3 +50,27 @@ class ImportedFileTests(TestCase):
         self.assertNotEqual(ImportedFile.objects.get(name='test.html').md5, 'c7532f22a052d716f7b2310fb52ad981')
 
         self.assertEqual(ImportedFile.objects.count(), 2)
+
+    def test_reconcile_in_bulk(self):
+        '''Changed files are returned, files that are gone are removed'''
+        test_dir = tempfile.mkdtemp()
+        try:
+            for name in ['index.html', 'api.html', 'gone.html']:
+                with open(os.path.join(test_dir, name), 'w') as f:
+                    f.write(name)
+            changed = _manage_imported_files(self.version, test_dir, 'commit01')
+            self.assertEqual(changed,
+                             set(['index.html', 'api.html', 'gone.html']))
+
+            os.remove(os.path.join(test_dir, 'gone.html'))
+            with open(os.path.join(test_dir, 'api.html'), 'w') as f:
+                f.write('changed')
+            with self.assertNumQueries(6):
+                changed = _manage_imported_files(self.version, test_dir,
+                                                 'commit02')
+            self.assertEqual(changed, set(['api.html']))
+            self.assertEqual(
+                sorted(ImportedFile.objects.values_list('name', 'commit')),
+                [('api.html', 'commit02'), ('index.html', 'commit02')])
+        finally:
+            shutil.rmtree(test_dir)
@@ -2,6 +2,8 @@ from django.test import TestCase
 import json
 import logging
 
+import mock
+
 from readthedocs.projects.models import Project
 from readthedocs.projects import tasks
 
@@ -102,6 +104,15 @@ class GitLabWebHookTest(TestCase):
         rtd.default_branch = old_default
         rtd.save()
 
+    @mock.patch('readthedocs.core.views.trigger_build')
+    def test_gitlab_post_commit_records_pushed_commit(self, trigger_build):
+        """The commit pushed is recorded on the build"""
+        r = self.client.post('/gitlab/', {'payload': json.dumps(self.payload)})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(trigger_build.call_count, 1)
+        self.assertEqual(trigger_build.call_args[1]['commit'],
+                         'da1560886d4f094c3e6c9ef40349f7d38b5d27d7')
+
 
 class PostCommitTest(TestCase):
     fixtures = ["eric", "test_data"]
@@ -207,6 +218,38 @@ class PostCommitTest(TestCase):
         rtd.default_branch = old_default
         rtd.save()
 
+    @mock.patch('readthedocs.core.views.trigger_build')
+    def test_github_post_commit_records_pushed_commit(self, trigger_build):
+        """The commit pushed is recorded on the build, unless it was deleted"""
+        r = self.client.post('/github/', {'payload': json.dumps(self.payload)})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(trigger_build.call_count, 1)
+        self.assertEqual(trigger_build.call_args[1]['commit'],
+                         '5ad757394b926e5637ffeafe340f952ef48bd270')
+
+        self.payload['after'] = '0' * 40
+        self.payload['deleted'] = True
+        r = self.client.post('/github/', {'payload': json.dumps(self.payload)})
+        self.assertEqual(trigger_build.call_count, 2)
+        self.assertIsNone(trigger_build.call_args[1]['commit'])
+
+    @mock.patch('readthedocs.core.views.trigger_build')
+    def test_bitbucket_post_commit_records_pushed_commit(self, trigger_build):
+        """The last commit pushed to a branch is recorded on its build"""
+        payload = {
+            'repository': {'absolute_url': '/rtfd/readthedocs.org/'},
+            'commits': [
+                {'branch': 'awesome', 'raw_node': 'a' * 40},
+                {'branch': 'awesome', 'raw_node': 'b' * 40},
+            ],
+        }
+        Project.objects.filter(slug='read-the-docs').update(
+            repo='https://bitbucket.org/rtfd/readthedocs.org')
+        r = self.client.post('/bitbucket/', {'payload': json.dumps(payload)})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(trigger_build.call_count, 1)
+        self.assertEqual(trigger_build.call_args[1]['commit'], 'b' * 40)
+
     def test_core_commit_hook(self):
         rtd = Project.objects.get(slug='read-the-docs')
         rtd.default_branch = 'master'
@@ -3,24 +3,28 @@ from functools import wraps
 
 from mock import patch
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from readthedocs.builds.models import Version
+from readthedocs.core.utils.servers import ServerResult
 from readthedocs.projects.models import Project
-from readthedocs.projects.symlinks import symlink_translations
+from readthedocs.projects.symlinks import SymlinkPlan, symlink_translations
 
 
 def patched(fn):
-    '''Patches calls to run_on_app_servers on instance methods'''
+    '''Patches the commands run on app servers on instance methods'''
 
     @wraps(fn)
     def wrapper(self):
 
-        def _collect_commands(cmd):
-            self.commands.append(cmd)
+        def _collect_commands(servers, commands):
+            for server in servers:
+                for cmd in commands(server):
+                    self.commands.extend(cmd.split(' && '))
+            return []
 
-        with patch('readthedocs.projects.symlinks.run_on_app_servers', _collect_commands):
-            with patch('readthedocs.projects.symlinks.run_on_app_servers', _collect_commands):
-                return fn(self)
+        with patch('readthedocs.projects.symlinks.run_on_servers', _collect_commands):
+            return fn(self)
     return wrapper
 
 
@@ -117,3 +121,65 @@ class TestSymlinkTranslations(TestCase):
                 self.commands.pop(
                     self.commands.index(command.format(**self.args))
                 ))
+
+
+class TestSymlinkPlan(TestCase):
+
+    fixtures = ['eric', 'test_data']
+
+    def setUp(self):
+        self.project = Project.objects.get(slug='kong')
+
+    @override_settings(MULTIPLE_APP_SERVERS=['web1', 'web2'], SYNC_USER='docs')
+    @patch('readthedocs.projects.symlinks.run_on_servers')
+    def test_apply_changes_once_per_server(self, run_on_servers):
+        '''Changes are made in one command, only on servers missing them'''
+        plan = SymlinkPlan(self.project)
+        plan.link('/links/a', '/docs/a')
+        plan.link('/links/sub/b', '/docs/b')
+        plan.remove('/links/c')
+        listed = {
+            'web1': ('rtd-symlink:/links/a\t/docs/a\n'
+                     'rtd-symlink:/links/sub/b\t/docs/b\n'
+                     'rtd-symlink:/links/c\t\n'),
+            'web2': ('Warning: Permanently added web2\n'
+                     'rtd-symlink:/links/a\t/docs/old\n'
+                     'rtd-symlink:/links/c\t\n'),
+        }
+
+        def run(servers, commands, retries=None):
+            results = []
+            for server in servers:
+                (command,) = commands(server)
+                if 'readlink' in command:
+                    output = listed[server]
+                else:
+                    output = command
+                results.append(ServerResult(
+                    server=server, exit_code=0, bytes_transferred=0,
+                    duration=0, attempts=1, output=output))
+            return results
+        run_on_servers.side_effect = run
+
+        (result,) = plan.apply()
+        self.assertEqual(result.server, 'web2')
+        self.assertEqual(result.output,
+                         "ssh docs@web2 'mkdir -p /links /links/sub && "
+                         "ln -nsf /docs/a /links/a && "
+                         "ln -nsf /docs/b /links/sub/b'")
+
+        # The symlinks are read from the servers again, not remembered
+        self.assertEqual(plan.apply()[0].server, 'web2')
+        listed['web2'] = listed['web1']
+        self.assertEqual(plan.apply(), [])
+
+        # Servers that can't be read get all symlinks
+        del listed['web1']
+        run_on_servers.side_effect = lambda servers, commands, retries=None: [
+            ServerResult(server=server,
+                         exit_code=0 if server in listed else 255,
+                         bytes_transferred=0, duration=0, attempts=1,
+                         output=listed.get(server, ''))
+            for server in servers]
+        (result,) = plan.apply()
+        self.assertEqual(result.server, 'web1')
@@ -0,0 +1,257 @@
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from readthedocs.core.utils.publish import (ArtifactPool, current_manifest,
+                                            forget_synced, hash_file, publish,
+                                            read_manifest, releases_path)
+from readthedocs.doc_builder.compress import (compress_release, write_zip,
+                                              zip_manifest_path)
+from readthedocs.privacy.backends.syncers import RemoteSyncer
+
+
+class PublishTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'build')
+        os.makedirs(os.path.join(self.source, 'sub'))
+        self.write('index.html', 'index')
+        self.write('sub/page.html', 'page')
+        self.target = os.path.join(self.root, 'rtd-builds', 'latest')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, content):
+        with open(os.path.join(self.source, name), 'w') as fh:
+            fh.write(content)
+
+    def read(self, name):
+        with open(os.path.join(self.target, name)) as fh:
+            return fh.read()
+
+    def test_publish_swaps_release_symlink(self):
+        first = publish(self.source, self.target)
+        self.assertTrue(os.path.islink(self.target))
+        self.assertEqual(os.path.realpath(self.target), os.path.realpath(first))
+        self.assertEqual(self.read('sub/page.html'), 'page')
+
+        self.write('index.html', 'changed')
+        second = publish(self.source, self.target)
+        self.assertEqual(os.path.realpath(self.target),
+                         os.path.realpath(second))
+        self.assertEqual(self.read('index.html'), 'changed')
+        # Unchanged files are shared with the previous release
+        self.assertEqual(
+            os.stat(os.path.join(first, 'sub', 'page.html')).st_ino,
+            os.stat(os.path.join(second, 'sub', 'page.html')).st_ino)
+        self.assertNotEqual(
+            os.stat(os.path.join(first, 'index.html')).st_ino,
+            os.stat(os.path.join(second, 'index.html')).st_ino)
+        # The first release is kept during the grace period
+        self.assertTrue(os.path.isdir(first))
+
+    def test_publish_collects_superseded_releases(self):
+        first = publish(self.source, self.target)
+        second = publish(self.source, self.target, grace=0)
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(sorted(os.listdir(releases_path(self.target))),
+                         [os.path.basename(second),
+                          os.path.basename(second) + '.manifest'])
+
+    def test_publish_replaces_plain_directory(self):
+        os.makedirs(self.target)
+        with open(os.path.join(self.target, 'stale.html'), 'w') as fh:
+            fh.write('stale')
+        publish(self.source, self.target)
+        self.assertTrue(os.path.islink(self.target))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.target, 'stale.html')))
+        self.assertEqual(self.read('index.html'), 'index')
+
+    def test_publish_writes_manifest(self):
+        publish(self.source, self.target)
+        manifest = current_manifest(self.target)
+        self.assertEqual(sorted(manifest), ['index.html', 'sub/page.html'])
+        self.assertEqual(manifest['index.html'], [
+            5, hash_file(os.path.join(self.source, 'index.html'))])
+
+        # Publishing a published tree reuses its manifest
+        copy = os.path.join(self.root, 'copy')
+        with patch('readthedocs.core.utils.publish.hash_file') as hash_mock:
+            publish(self.target, copy)
+            self.assertFalse(hash_mock.called)
+        self.assertEqual(current_manifest(copy), manifest)
+
+    @override_settings(MULTIPLE_APP_SERVERS=['web1'])
+    def test_remote_syncer_copies_changes(self):
+        commands = []
+        markers = {}
+
+        def run(command, timeout):
+            match = re.search('--files-from=(\\S+)', command)
+            if match:
+                with open(match.group(1)) as fh:
+                    commands.append((command, fh.read().split()))
+            else:
+                commands.append((command, None))
+            match = re.search('test .* = (\\w+)', command)
+            if match:
+                return (0 if markers.get('web1') == match.group(1) else 1, '')
+            match = re.search('echo (\\w+) >', command)
+            if match:
+                markers['web1'] = match.group(1)
+            return (0, '')
+
+        publish(self.source, self.target)
+        with patch('readthedocs.core.utils.servers.run_command', run):
+            RemoteSyncer.copy(self.target, '/srv/latest')
+            self.assertIn('--delete', commands[-2][0])
+            self.assertIsNone(commands[-2][1])
+            self.assertIn('/srv/.releases/latest/.synced-manifest',
+                          commands[-1][0])
+
+            self.write('index.html', 'changed')
+            os.remove(os.path.join(self.source, 'sub', 'page.html'))
+            publish(self.source, self.target)
+            RemoteSyncer.copy(self.target, '/srv/latest')
+            self.assertIn('--delete-missing-args', commands[-2][0])
+            self.assertEqual(commands[-2][1],
+                             ['index.html', 'sub/page.html'])
+
+            # A copy that changed on the server gets all files again
+            markers.clear()
+            self.write('index.html', 'changed again')
+            publish(self.source, self.target)
+            RemoteSyncer.copy(self.target, '/srv/latest')
+            self.assertIn('--delete ', commands[-2][0])
+            self.assertIsNone(commands[-2][1])
+
+            # So does a copy whose artifacts were cleared
+            forget_synced(self.target)
+            del commands[:]
+            RemoteSyncer.copy(self.target, '/srv/latest')
+            self.assertFalse(any('test "' in command
+                                 for (command, _) in commands))
+            self.assertIn('--delete ', commands[-2][0])
+
+    def test_publish_compresses_sidecars(self):
+        self.write('index.html', '<p>index</p>' * 200)
+        self.write('style.css', 'body {}' * 200)
+        first = publish(self.source, self.target, prepare=compress_release)
+        manifest = current_manifest(self.target)
+        self.assertIn('index.html.gz', manifest)
+        self.assertIn('style.css.gz', manifest)
+        # Small files are served as is
+        self.assertNotIn('sub/page.html.gz', manifest)
+        with gzip.open(os.path.join(self.target, 'index.html.gz')) as fh:
+            self.assertEqual(fh.read(), '<p>index</p>' * 200)
+
+        # Sidecars of unchanged files are shared with the previous release
+        self.write('style.css', 'body {margin: 0}' * 200)
+        second = publish(self.source, self.target, prepare=compress_release)
+        self.assertEqual(
+            os.stat(os.path.join(first, 'index.html.gz')).st_ino,
+            os.stat(os.path.join(second, 'index.html.gz')).st_ino)
+        with gzip.open(os.path.join(second, 'style.css.gz')) as fh:
+            self.assertEqual(fh.read(), 'body {margin: 0}' * 200)
+
+    def test_publish_pools_static_files(self):
+        pool = ArtifactPool(root=os.path.join(self.root, 'pool'))
+        os.makedirs(os.path.join(self.source, '_static'))
+        self.write('_static/theme.css', 'body {}')
+        first = publish(self.source, self.target, pool=pool)
+        other = publish(self.source, os.path.join(self.root, 'other'),
+                        pool=pool)
+        # Pooled files are shared across trees, others are not
+        self.assertEqual(
+            os.stat(os.path.join(first, '_static', 'theme.css')).st_ino,
+            os.stat(os.path.join(other, '_static', 'theme.css')).st_ino)
+        self.assertNotEqual(
+            os.stat(os.path.join(first, 'index.html')).st_ino,
+            os.stat(os.path.join(other, 'index.html')).st_ino)
+
+        self.assertEqual(pool.collect(grace=0), (0, 0))
+        # Files are pooled by the sha256 hash of their contents
+        digest = hashlib.sha256('body {}').hexdigest()
+        self.assertEqual(
+            os.stat(os.path.join(first, '_static', 'theme.css')).st_ino,
+            os.stat(pool.entry_path(digest)).st_ino)
+
+        shutil.rmtree(first)
+        shutil.rmtree(other)
+        self.assertEqual(pool.collect(grace=0), (1, 7))
+
+    def test_publish_skips_pool_on_other_filesystem(self):
+        pool = ArtifactPool(root=os.path.join(self.root, 'pool'))
+        os.makedirs(os.path.join(self.source, '_static'))
+        self.write('_static/theme.css', 'body {}')
+        self.assertTrue(pool.usable(self.root))
+        pool.device = -1
+        with patch.object(pool, 'link') as link:
+            release = publish(self.source, self.target, pool=pool)
+            self.assertFalse(link.called)
+        self.assertEqual(
+            os.stat(os.path.join(release, '_static', 'theme.css')).st_nlink, 1)
+
+    def test_write_zip_reuses_entries(self):
+        self.write('index.html', '<p>index</p>' * 200)
+        self.write('logo.png', 'png')
+        zip_file = os.path.join(self.root, 'docs.zip')
+        self.assertEqual(write_zip(self.source, zip_file, prefix='docs'),
+                         (3, 0))
+        archive = zipfile.ZipFile(zip_file)
+        self.assertEqual(archive.getinfo('docs/index.html').compress_type,
+                         zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.getinfo('docs/logo.png').compress_type,
+                         zipfile.ZIP_STORED)
+        archive.close()
+
+        self.write('sub/page.html', 'changed')
+        self.assertEqual(write_zip(self.source, zip_file, prefix='docs'),
+                         (1, 2))
+        archive = zipfile.ZipFile(zip_file)
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.read('docs/index.html'),
+                         '<p>index</p>' * 200)
+        self.assertEqual(archive.read('docs/sub/page.html'), 'changed')
+        # The md5 of each entry is kept next to the archive, not in it
+        self.assertEqual(
+            [zinfo.comment for zinfo in archive.infolist()], ['', '', ''])
+        archive.close()
+        self.assertEqual(
+            sorted(read_manifest(zip_manifest_path(zip_file))),
+            ['docs/index.html', 'docs/logo.png', 'docs/sub/page.html'])
+
+        # Without a manifest, nothing is reused
+        os.remove(zip_manifest_path(zip_file))
+        self.assertEqual(write_zip(self.source, zip_file, prefix='docs'),
+                         (3, 0))
+
+    @patch('readthedocs.doc_builder.compress.RAW_ZIP_ENTRIES', False)
+    def test_write_zip_without_raw_entries(self):
+        self.write('index.html', '<p>index</p>' * 200)
+        self.write('logo.png', 'png')
+        zip_file = os.path.join(self.root, 'docs.zip')
+        self.assertEqual(write_zip(self.source, zip_file, prefix='docs'),
+                         (3, 0))
+        self.assertEqual(write_zip(self.source, zip_file, prefix='docs'),
+                         (3, 0))
+        archive = zipfile.ZipFile(zip_file)
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.getinfo('docs/index.html').compress_type,
+                         zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.getinfo('docs/logo.png').compress_type,
+                         zipfile.ZIP_STORED)
+        self.assertEqual(archive.read('docs/index.html'),
+                         '<p>index</p>' * 200)
+        archive.close()
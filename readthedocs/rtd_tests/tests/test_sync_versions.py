@@ -1,6 +1,7 @@
 import json
 
 from django.test import TestCase
+from guardian.shortcuts import get_perms
 
 from readthedocs.builds.models import Version
 from readthedocs.builds.constants import STABLE
@@ -115,6 +116,50 @@ class TestSyncVersions(TestCase):
         version_9 = Version.objects.get(slug='0.9')
         self.assertTrue(version_9.active is False)
 
+    def test_bulk_sync_unique_slugs(self):
+        version_post_data = {
+            'branches': [
+                {
+                    'identifier': 'origin/master',
+                    'verbose_name': 'master',
+                },
+            ],
+            'tags': [
+                {
+                    'identifier': 'foo/bar',
+                    'verbose_name': 'foo/bar',
+                },
+                {
+                    'identifier': 'foo-bar',
+                    'verbose_name': 'foo-bar',
+                },
+            ] + [
+                {
+                    'identifier': '1.%d' % minor,
+                    'verbose_name': '1.%d' % minor,
+                } for minor in range(500)
+            ],
+        }
+
+        r = self.client.post(
+            '/api/v2/project/%s/sync_versions/' % self.pip.pk,
+            data=json.dumps(version_post_data),
+            content_type='application/json',
+        )
+        json_data = json.loads(r.content)
+        self.assertEqual(json_data['deleted_versions'], ['to_delete'])
+        self.assertIn('foo-bar', json_data['added_versions'])
+        self.assertIn('foo-bar_a', json_data['added_versions'])
+        self.assertEqual(
+            self.pip.versions.get(verbose_name='foo-bar').slug, 'foo-bar_a')
+        tags = [tag['verbose_name'] for tag in version_post_data['tags']]
+        self.assertEqual(
+            self.pip.versions.filter(type='tag', verbose_name__in=tags).count(),
+            502)
+        version = self.pip.versions.get(verbose_name='1.499')
+        for owner in self.pip.users.all():
+            self.assertIn('view_version', get_perms(owner, version))
+
 
 class TestStableVersion(TestCase):
     fixtures = ["eric", "test_data"]
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from readthedocs.doc_builder.cache import VirtualenvCache
+
+
+class TestVirtualenvCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = VirtualenvCache(root=os.path.join(self.tmp, 'cache'),
+                                     max_size=1024)
+        self.venv = self.make_venv(os.path.join(self.tmp, 'a', 'envs', 'latest'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_venv(self, path):
+        os.makedirs(os.path.join(path, 'bin'))
+        os.makedirs(os.path.join(path, 'lib', 'site-packages'))
+        with open(os.path.join(path, 'bin', 'pip'), 'w') as fh:
+            fh.write('#!{0}/bin/python\n'.format(path))
+        with open(os.path.join(path, 'lib', 'site-packages', 'mod.py'), 'w') as fh:
+            fh.write('x = 1\n')
+        os.symlink(os.path.join(path, 'bin'), os.path.join(path, 'local'))
+        return path
+
+    def test_miss(self):
+        self.assertFalse(self.cache.restore('missing',
+                                            os.path.join(self.tmp, 'b')))
+
+    def test_store_and_restore(self):
+        self.cache.store('key', self.venv)
+        target = os.path.join(self.tmp, 'b', 'envs', 'stable')
+        self.assertTrue(self.cache.restore('key', target))
+
+        with open(os.path.join(target, 'bin', 'pip')) as fh:
+            self.assertEqual(fh.read(), '#!{0}/bin/python\n'.format(target))
+        self.assertEqual(os.readlink(os.path.join(target, 'local')),
+                         os.path.join(target, 'bin'))
+        self.assertTrue(os.path.exists(
+            os.path.join(target, 'lib', 'site-packages', 'mod.py')))
+        # The cache entry is untouched by relocating the clone
+        entry_pip = os.path.join(self.cache.entry_path('key'), 'venv',
+                                 'bin', 'pip')
+        with open(entry_pip) as fh:
+            self.assertEqual(fh.read(),
+                             '#!{0}/bin/python\n'.format(self.venv))
+
+        # Installs modify packages in place, the cache entry keeps its copy
+        with open(os.path.join(target, 'lib', 'site-packages', 'mod.py'),
+                  'w') as fh:
+            fh.write('x = 2\n')
+        entry_mod = os.path.join(self.cache.entry_path('key'), 'venv',
+                                 'lib', 'site-packages', 'mod.py')
+        with open(entry_mod) as fh:
+            self.assertEqual(fh.read(), 'x = 1\n')
+
+    def test_make_key(self):
+        self.assertEqual(VirtualenvCache.make_key('python', ['sphinx']),
+                         VirtualenvCache.make_key('python', ['sphinx']))
+        self.assertNotEqual(VirtualenvCache.make_key('python', ['sphinx']),
+                            VirtualenvCache.make_key('python3', ['sphinx']))
+
+    def test_evict_least_recently_used(self):
+        self.cache.max_size = 0
+        self.cache.store('old', self.venv)
+        old_time = time.time() - 100
+        os.utime(self.cache.entry_path('old'), (old_time, old_time))
+        self.cache.store('new', self.venv)
+        self.assertIsNone(self.cache.get_meta('old'))
+        self.assertIsNotNone(self.cache.get_meta('new'))
@@ -33,6 +33,23 @@ def make_test_git():
     return directory
 
 
+def add_git_submodule(directory, submodule, name, path):
+    """Add the repository at ``submodule`` to the repository at ``directory``
+    as a submodule called ``name``, and commit it"""
+    cwd = getcwd()
+    env = environ.copy()
+    env['GIT_DIR'] = pjoin(directory, '.git')
+    # Newer versions of git only clone local submodules when allowed to
+    env.update({'GIT_CONFIG_COUNT': '1',
+                'GIT_CONFIG_KEY_0': 'protocol.file.allow',
+                'GIT_CONFIG_VALUE_0': 'always'})
+    chdir(directory)
+    log.info(check_output(['git', 'submodule', 'add', '--name', name,
+                           submodule, path], env=env))
+    log.info(check_output(['git', 'commit', '-m"submodule"'], env=env))
+    chdir(cwd)
+
+
 def make_test_hg():
     directory = mkdtemp()
     path = getcwd()
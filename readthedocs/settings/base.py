@@ -286,6 +286,7 @@ STRIPE_PUBLISHABLE = None
 
 # RTD Settings
 REPO_LOCK_SECONDS = 30
+REPO_LOCK_WAIT = 60
 ALLOW_PRIVATE_REPOS = False
 
 GLOBAL_ANALYTICS_CODE = 'UA-17997319-1'
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 from .sqlite import *  # noqa
 
@@ -8,6 +9,8 @@ SLUMBER_API_HOST = 'http://localhost:8000'
 # A bunch of our tests check this value in a returned URL/Domain
 PRODUCTION_DOMAIN = 'readthedocs.org'
 GROK_API_HOST = 'http://localhost:8888'
+# Keep lock files of the local lock backend out of the checkout
+REPO_LOCK_ROOT = os.path.join(tempfile.gettempdir(), 'rtd-test-locks')
 
 
 if not os.environ.get('DJANGO_SETTINGS_SKIP_LOCAL', False):
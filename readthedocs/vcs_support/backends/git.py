@@ -1,9 +1,15 @@
 import re
 import logging
 import csv
+import fcntl
+import hashlib
 import os
+import time
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
 
+from django.conf import settings
+
 from readthedocs.projects.exceptions import ProjectImportError
 from readthedocs.vcs_support.base import BaseVCS, VCSVersion
 
@@ -11,14 +17,36 @@ log = logging.getLogger(__name__)
 
 
 class Backend(BaseVCS):
+    """
+    Git backend
+
+    With a ``mirror_path``, the remote is only fetched into a bare mirror of
+    the repository, shared by the checkouts of all versions of the project.
+    Checkouts are cloned from the mirror with ``--shared``, so they borrow its
+    objects instead of keeping a copy, and are updated by fetching from the
+    mirror. Submodules are cached in the same way, in a bare repository at
+    ``submodule_cache_path``.
+
+    A recent fetch into the mirror is only reused if the mirror has the
+    ``required_commit``, where one is given.
+    """
     supports_tags = True
     supports_branches = True
     fallback_branch = 'master'  # default branch
 
+    mirror_refspecs = ['+refs/heads/*:refs/heads/*',
+                       '+refs/tags/*:refs/tags/*']
+    checkout_refspecs = ['+refs/heads/*:refs/remotes/origin/*',
+                         '+refs/tags/*:refs/tags/*']
+
     def __init__(self, *args, **kwargs):
         super(Backend, self).__init__(*args, **kwargs)
         self.token = kwargs.get('token', None)
+        self.mirror_path = kwargs.get('mirror_path', None)
+        self.submodule_cache_path = kwargs.get('submodule_cache_path', None)
+        self.required_commit = kwargs.get('required_commit', None)
         self.repo_url = self._get_clone_url()
+        self._refs = None
 
     def _get_clone_url(self):
         if '://' in self.repo_url:
@@ -46,7 +74,14 @@ class Backend(BaseVCS):
         return code == 0
 
     def fetch(self):
-        code, out, err = self.run('git', 'fetch', '--tags', '--prune')
+        if self.mirror_path is not None:
+            self.update_mirror()
+            code, out, err = self.run('git', 'fetch', '--prune',
+                                      self.mirror_path,
+                                      *self.checkout_refspecs)
+        else:
+            code, out, err = self.run('git', 'fetch', '--tags', '--prune')
+        self._refs = None
         if code != 0:
             raise ProjectImportError(
                 "Failed to get code from '%s' (git fetch): %s\n\nStderr:\n\n%s\n\n" % (
@@ -66,6 +101,7 @@ class Backend(BaseVCS):
         return [code, out, err]
 
     def clone(self):
+        self._refs = None
         code, out, err = self.run('git', 'clone', '--recursive', '--quiet',
                                   self.repo_url, '.')
         if code != 0:
@@ -74,13 +110,164 @@ class Backend(BaseVCS):
                     self.repo_url, code)
             )
 
+    def clone_from_mirror(self):
+        self._refs = None
+        self.update_mirror()
+        code, out, err = self.run('git', 'clone', '--shared', '--no-checkout',
+                                  '--quiet', self.mirror_path, '.')
+        if code != 0:
+            raise ProjectImportError(
+                "Failed to get code from '%s' (git clone): %s" % (
+                    self.mirror_path, code)
+            )
+        # Relative submodule URLs are resolved against the origin remote
+        self.set_remote_url(self.repo_url)
+
+    def update_mirror(self):
+        """
+        Fetch the remote into the bare mirror
+
+        Fetches are serialized with a lock in the mirror. A checkout that
+        waited for the lock while another checkout fetched uses that fetch, if
+        it started after this one was requested, instead of fetching again.
+        Fetches up to ``settings.REPO_FETCH_TTL`` seconds older are used too,
+        if the mirror has the ``required_commit``. The remote is only fetched
+        from if ``git ls-remote`` shows its heads or tags differ from the
+        mirror's.
+        """
+        requested = time.time()
+        ttl = getattr(settings, 'REPO_FETCH_TTL', 60)
+        if not os.path.exists(self.mirror_path):
+            os.makedirs(self.mirror_path)
+        fetched_path = os.path.join(self.mirror_path, 'rtd_fetched')
+        with open(os.path.join(self.mirror_path, 'rtd_fetch.lock'),
+                  'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(os.path.join(self.mirror_path, 'HEAD')):
+                    self.run('git', '--git-dir=' + self.mirror_path,
+                             'init', '--bare', '--quiet')
+                    # Checkouts borrow objects from the mirror, objects
+                    # dropped from the remote's history must be kept
+                    self.run('git', '--git-dir=' + self.mirror_path,
+                             'config', 'gc.pruneExpire', 'never')
+                elif (self.mirror_fetched(fetched_path) >= requested - ttl and
+                      self.mirror_has(self.required_commit)):
+                    return
+                started = time.time()
+                if self.remote_refs() == self.mirror_refs():
+                    log.info("Remote of %s unchanged, skipping fetch" %
+                             self.name)
+                else:
+                    code, out, err = self.run('git',
+                                              '--git-dir=' + self.mirror_path,
+                                              'fetch', '--prune',
+                                              self.repo_url,
+                                              *self.mirror_refspecs)
+                    if code != 0:
+                        raise ProjectImportError(
+                            "Failed to get code from '%s' (git fetch): %s\n\n"
+                            "Stderr:\n\n%s\n\n" % (self.repo_url, code, err)
+                        )
+                with open(fetched_path, 'w') as fetched_file:
+                    fetched_file.write(repr(started))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def remote_refs(self):
+        """
+        Heads and tags of the remote, listed with ``git ls-remote``
+
+        :returns: dict of ref names to objects, or ``None`` if the remote
+            couldn't be listed
+        """
+        code, out, err = self.run('git', 'ls-remote', '--heads', '--tags',
+                                  self.repo_url)
+        if code != 0:
+            return None
+        refs = {}
+        for line in out.splitlines():
+            fields = line.split()
+            # Skip the commits annotated tags point to
+            if len(fields) == 2 and not fields[1].endswith('^{}'):
+                refs[fields[1]] = fields[0]
+        return refs
+
+    def mirror_refs(self):
+        """Heads and tags of the mirror, as dict of ref names to objects"""
+        code, out, err = self.run('git', '--git-dir=' + self.mirror_path,
+                                  'for-each-ref',
+                                  '--format=%(refname) %(objectname)',
+                                  'refs/heads', 'refs/tags')
+        if code != 0:
+            return {}
+        return dict((name, obj) for (name, obj, _) in self.parse_refs(out))
+
+    def mirror_has(self, commit):
+        """Whether the mirror has ``commit``, or ``commit`` is ``None``"""
+        if commit is None:
+            return True
+        code, out, err = self.run('git', '--git-dir=' + self.mirror_path,
+                                  'cat-file', '-e', commit + '^{commit}')
+        return code == 0
+
+    def mirror_fetched(self, fetched_path):
+        """Start time of the last fetch into the mirror, or check of it"""
+        try:
+            with open(fetched_path) as fetched_file:
+                return float(fetched_file.read())
+        except (IOError, ValueError):
+            return 0
+
+    @property
+    def refs(self):
+        """
+        Snapshot of the refs of the checkout
+
+        All refs are read with a single ``git for-each-ref``, and the snapshot
+        is kept until the next fetch.
+
+        :returns: list of ``(ref name, object, commit)`` tuples, sorted by ref
+            name. The commit of annotated tags is the commit they point to.
+        """
+        if self._refs is None:
+            retcode, stdout, err = self.run(
+                'git', 'for-each-ref',
+                '--format=%(refname) %(objectname) %(*objectname)')
+            if retcode != 0:
+                return []
+            self._refs = self.parse_refs(stdout)
+        return self._refs
+
+    def parse_refs(self, data):
+        """
+        Parses output of for-each-ref, eg:
+
+            refs/remotes/origin/HEAD 1d3a2c8d2a5e3bcb0be8bd2e1d40ba3c1e6ae1a5
+            refs/remotes/origin/master 1d3a2c8d2a5e3bcb0be8bd2e1d40ba3c1e6ae1a5
+            refs/tags/2.0.0 3b32886c8d3cb815df3793b3937b2e91d0fb00f1 c0288a17899b2c6818f74e3a90b77e2a1779f96a
+
+        Into ``(ref name, object, commit)`` tuples. The last column is only
+        set for annotated tags, with the commit the tag points to.
+        """
+        refs = []
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            (name, obj) = fields[:2]
+            commit = obj
+            if len(fields) > 2:
+                commit = fields[2]
+            refs.append((name, obj, commit))
+        return refs
+
     @property
     def tags(self):
-        retcode, stdout, err = self.run('git', 'show-ref', '--tags')
-        # error (or no tags found)
-        if retcode != 0:
-            return []
-        return self.parse_tags(stdout)
+        prefix = 'refs/tags/'
+        return [VCSVersion(self, obj, name.split('/')[-1])
+                for (name, obj, _) in self.refs
+                if name.startswith(prefix)]
 
     def parse_tags(self, data):
         """
@@ -111,11 +298,10 @@ class Backend(BaseVCS):
     @property
     def branches(self):
         # Only show remote branches
-        retcode, stdout, err = self.run('git', 'branch', '-r')
-        # error (or no tags found)
-        if retcode != 0:
-            return []
-        return self.parse_branches(stdout)
+        prefix = 'refs/remotes/'
+        return self.parse_branches('\n'.join(
+            name[len(prefix):] for (name, _, _) in self.refs
+            if name.startswith(prefix)))
 
     def parse_branches(self, data):
         """
@@ -148,8 +334,22 @@ class Backend(BaseVCS):
 
     @property
     def commit(self):
-        retcode, stdout, err = self.run('git', 'rev-parse', 'HEAD')
-        return stdout.strip()
+        # Checkouts are detached, so HEAD is usually the commit itself
+        try:
+            with open(os.path.join(self.working_dir, '.git', 'HEAD')) as head:
+                head = head.read().strip()
+        except IOError:
+            head = ''
+        if head.startswith('ref: '):
+            ref = head[len('ref: '):]
+            head = ''
+            for (name, _, commit) in self.refs:
+                if name == ref:
+                    head = commit
+        if not head:
+            retcode, stdout, err = self.run('git', 'rev-parse', 'HEAD')
+            head = stdout.strip()
+        return head
 
     def checkout(self, identifier=None):
         self.check_working_dir()
@@ -158,6 +358,9 @@ class Backend(BaseVCS):
         if self.repo_exists():
             self.set_remote_url(self.repo_url)
             self.fetch()
+        elif self.mirror_path is not None:
+            self.make_clean_working_dir()
+            self.clone_from_mirror()
         else:
             self.make_clean_working_dir()
             self.clone()
@@ -176,13 +379,175 @@ class Backend(BaseVCS):
         # Clean any remains of previous checkouts
         self.run('git', 'clean', '-d', '-f', '-f')
 
-        # Update submodules
-        self.run('git', 'submodule', 'sync')
-        self.run('git', 'submodule', 'update',
-                 '--init', '--recursive', '--force')
+        self.update_submodules()
 
         return code, out, err
 
+    def update_submodules(self):
+        """
+        Check out the submodules of the checked out commit
+
+        This is skipped when ``.gitmodules`` and the commits recorded for the
+        submodules haven't changed since the last update of this checkout, and
+        the submodules are checked out at those commits without changes.
+
+        With a ``submodule_cache_path``, the remote of each submodule is first
+        fetched into a bare repository of its own, shared by all versions of
+        the project, ``settings.REPO_SUBMODULE_JOBS`` at a time. The bare
+        repository at ``submodule_cache_path`` borrows the objects of all of
+        them, and submodules are cloned with it as reference, so objects are
+        only fetched once for all versions.
+        """
+        gitmodules = os.path.join(self.working_dir, '.gitmodules')
+        if not os.path.exists(gitmodules):
+            return
+        gitlinks = self.submodule_gitlinks()
+        state = self.submodule_state(gitmodules, gitlinks)
+        state_path = os.path.join(self.working_dir, '.git', 'rtd_submodules')
+        try:
+            with open(state_path) as state_file:
+                if (state_file.read() == state and
+                        self.submodules_clean(gitlinks)):
+                    log.info("Submodules of %s unchanged, skipping update" %
+                             self.name)
+                    return
+        except IOError:
+            pass
+
+        self.run('git', 'submodule', 'sync')
+        update = ['git', 'submodule', 'update', '--init', '--recursive',
+                  '--force']
+        if self.submodule_cache_path is not None:
+            self.run('git', 'submodule', 'init')
+            self.update_submodule_cache()
+            update += ['--reference', self.submodule_cache_path]
+        code, out, err = self.run(*update)
+        if code == 0:
+            with open(state_path, 'w') as state_file:
+                state_file.write(state)
+
+    def submodule_gitlinks(self):
+        """Entries of the index recording the commits of submodules"""
+        code, out, err = self.run('git', 'ls-files', '--stage')
+        # Submodules are recorded as gitlinks
+        return [line for line in out.splitlines()
+                if line.startswith('160000 ')]
+
+    def submodule_state(self, gitmodules, gitlinks):
+        """Hash of ``.gitmodules`` and the commits recorded for submodules"""
+        state = hashlib.sha1()
+        with open(gitmodules) as gitmodules_file:
+            state.update(gitmodules_file.read())
+        for line in gitlinks:
+            state.update(line)
+        return state.hexdigest()
+
+    def submodules_clean(self, gitlinks):
+        """
+        Whether all submodules are checked out at their recorded commits,
+        without changes to their files
+        """
+        if not gitlinks:
+            return True
+        code, out, err = self.run('git', 'submodule', 'status', '--recursive')
+        # Uninitialized, out of sync and conflicting submodules are prefixed
+        # with one of '-+U'
+        if code != 0 or any(not line.startswith(' ')
+                            for line in out.splitlines()):
+            return False
+        paths = [line.split('\t', 1)[1] for line in gitlinks]
+        code, out, err = self.run('git', 'status', '--porcelain',
+                                  '--ignore-submodules=none', '--', *paths)
+        return code == 0 and not out.strip()
+
+    def submodule_urls(self):
+        """
+        The remotes of the submodules of the checkout
+
+        :returns: sorted list of the unique submodule remote urls
+        """
+        code, out, err = self.run('git', 'config', '-z', '--get-regexp',
+                                  r'^submodule\..*\.url$')
+        urls = set()
+        # Entries are the key and value separated by a newline, each entry
+        # ends with a null byte, so names with spaces can be parsed
+        for entry in out.split('\0'):
+            (key, _, url) = entry.partition('\n')
+            if url:
+                urls.add(url)
+        return sorted(urls)
+
+    def submodule_repo_path(self, url):
+        """The path to the bare repository caching the submodule at ``url``"""
+        return os.path.join(self.submodule_cache_path, 'rtd_modules',
+                            hashlib.sha1(url).hexdigest())
+
+    def update_submodule_cache(self):
+        """
+        Fetch the remotes of submodules into the submodule cache
+
+        Each remote is fetched into a repository of its own, so fetches run at
+        the same time don't compete for the locks and ``FETCH_HEAD`` of one
+        repository. The cache repository lists all of them as alternates.
+        """
+        urls = self.submodule_urls()
+        if not urls:
+            return
+        if not os.path.exists(self.submodule_cache_path):
+            os.makedirs(self.submodule_cache_path)
+        with open(os.path.join(self.submodule_cache_path, 'rtd_fetch.lock'),
+                  'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                for path in [self.submodule_cache_path] + [
+                        self.submodule_repo_path(url) for url in urls]:
+                    if not os.path.exists(os.path.join(path, 'HEAD')):
+                        if not os.path.exists(path):
+                            os.makedirs(path)
+                        self.run('git', '--git-dir=' + path, 'init', '--bare',
+                                 '--quiet')
+                        # Checkouts borrow objects from the cache
+                        self.run('git', '--git-dir=' + path, 'config',
+                                 'gc.pruneExpire', 'never')
+                jobs = getattr(settings, 'REPO_SUBMODULE_JOBS', 4)
+                pool = ThreadPool(processes=max(1, min(jobs, len(urls))))
+                try:
+                    pool.map(self.fetch_submodule, urls)
+                finally:
+                    pool.close()
+                    pool.join()
+                self.link_submodule_repos()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def fetch_submodule(self, url):
+        """Fetch the remote of a submodule into its cache repository
+
+        If the fetch fails, the submodule update fetches from the remote
+        instead.
+        """
+        code, out, err = self.run(
+            'git', '--git-dir=' + self.submodule_repo_path(url), 'fetch',
+            '--quiet', '--prune', url,
+            '+refs/heads/*:refs/heads/*',
+            '+refs/tags/*:refs/tags/*')
+        if code != 0:
+            log.warning("Failed to fetch submodule %s of %s: %s" % (
+                url, self.name, err))
+
+    def link_submodule_repos(self):
+        """List the objects of all submodule repositories as alternates of
+        the submodule cache, including those of other versions"""
+        modules = os.path.join(self.submodule_cache_path, 'rtd_modules')
+        alternates = os.path.join(self.submodule_cache_path, 'objects',
+                                  'info', 'alternates')
+        tmp_path = '%s.%s.tmp' % (alternates, os.getpid())
+        with open(tmp_path, 'w') as alternates_file:
+            for name in sorted(os.listdir(modules)):
+                alternates_file.write(
+                    os.path.join(modules, name, 'objects') + '\n')
+        os.rename(tmp_path, alternates)
+
     def find_ref(self, ref):
         # Check if ref starts with 'origin/'
         if ref.startswith('origin/'):
@@ -195,8 +560,9 @@ class Backend(BaseVCS):
         return ref
 
     def ref_exists(self, ref):
-        code, out, err = self.run('git', 'show-ref', ref)
-        return code == 0
+        # Matches like git show-ref, on whole trailing components of ref names
+        return any(name == ref or name.endswith('/' + ref)
+                   for (name, _, _) in self.refs)
 
     @property
     def env(self):
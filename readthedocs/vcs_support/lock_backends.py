@@ -0,0 +1,195 @@
+'''
+Backends for locks on version checkouts
+
+Locks are identified by a key, and each acquire of a lock returns a fencing
+token, larger than the tokens returned for earlier acquires of the same lock.
+'''
+
+import errno
+import fcntl
+import logging
+import math
+import os
+import time
+
+import redis
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+class RedisLockBackend(object):
+    '''
+    Locks held as leases on keys in Redis, shared by all builders
+
+    A held lock is a key holding the fencing token of its holder, which expires
+    unless the lease is renewed. Releasing a lock pushes to a list that waiters
+    block on, Redis serves blocked clients in order, so the waiter that has
+    been waiting longest is woken up right away.
+
+    :param client: Redis client, defaults to a client for ``settings.REDIS``
+    '''
+
+    name = 'redis'
+    leases = True
+
+    acquire_script = '''
+if redis.call('exists', KEYS[1]) == 1 then
+    return nil
+end
+local token = redis.call('incr', KEYS[2])
+redis.call('set', KEYS[1], token)
+redis.call('pexpire', KEYS[1], ARGV[1])
+return token
+'''
+
+    renew_script = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+    release_script = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1], KEYS[2])
+    redis.call('rpush', KEYS[2], ARGV[1])
+    redis.call('pexpire', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+'''
+
+    def __init__(self, client=None):
+        if client is None:
+            client = redis.Redis(**settings.REDIS)
+        self.client = client
+        self._acquire = client.register_script(self.acquire_script)
+        self._renew = client.register_script(self.renew_script)
+        self._release = client.register_script(self.release_script)
+
+    @staticmethod
+    def keys(key):
+        '''Keys of the lock, its fencing token counter and its wait list'''
+        return ('rtd_lock:v1:%s' % key,
+                'rtd_lock:v1:%s:fence' % key,
+                'rtd_lock:v1:%s:released' % key)
+
+    def acquire(self, key, lease):
+        '''Acquire the lock if it isn't held
+
+        :returns: fencing token, or ``None`` if the lock is held
+        '''
+        (lock_key, fence_key, _) = self.keys(key)
+        token = self._acquire(keys=[lock_key, fence_key],
+                              args=[int(lease * 1000)])
+        if token is not None:
+            return int(token)
+
+    def wait(self, key, timeout, polling_interval):
+        '''Block until the lock is released, or ``timeout`` passes'''
+        (_, _, released_key) = self.keys(key)
+        # A timeout of 0 blocks forever
+        self.client.blpop([released_key],
+                          timeout=max(1, int(math.ceil(timeout))))
+
+    def renew(self, key, token, lease):
+        '''Extend the lease on a held lock
+
+        :returns: whether the lock was still held
+        '''
+        (lock_key, _, _) = self.keys(key)
+        return bool(self._renew(keys=[lock_key],
+                                args=[token, int(lease * 1000)]))
+
+    def release(self, key, token, lease):
+        '''Release a held lock and wake up the next waiter
+
+        :returns: whether the lock was still held
+        '''
+        (lock_key, _, released_key) = self.keys(key)
+        return bool(self._release(keys=[lock_key, released_key],
+                                  args=[token, int(lease * 1000)]))
+
+
+class LocalLockBackend(object):
+    '''
+    Locks held with ``flock`` on files, for builders on a single host
+
+    Locks are released when the holding process exits, so they are not leased.
+    The fencing token is stored in the lock file. Waiters poll for the lock.
+
+    :param path: Directory to keep lock files in
+    '''
+
+    name = 'local'
+    leases = False
+
+    def __init__(self, path=None):
+        if path is None:
+            path = getattr(settings, 'REPO_LOCK_ROOT',
+                           os.path.join(settings.SITE_ROOT, 'locks'))
+        self.path = path
+        self.held = {}
+
+    def acquire(self, key, lease):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        fd = os.open(os.path.join(self.path, '%s.lock' % key),
+                     os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        token = int(os.read(fd, 32) or 0) + 1
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, str(token))
+        self.held[(key, token)] = fd
+        return token
+
+    def wait(self, key, timeout, polling_interval):
+        time.sleep(min(timeout, polling_interval))
+
+    def renew(self, key, token, lease):
+        return (key, token) in self.held
+
+    def release(self, key, token, lease):
+        fd = self.held.pop((key, token), None)
+        if fd is None:
+            return False
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        return True
+
+
+_backends = {}
+
+
+def get_lock_backend(name=None):
+    '''Return the shared lock backend
+
+    :param name: ``redis`` or ``local``, defaults to
+        ``settings.REPO_LOCK_BACKEND``, which is ``redis`` if
+        ``settings.REDIS`` is set. If Redis can't be reached, the local
+        backend is returned.
+    '''
+    if name is None:
+        name = getattr(settings, 'REPO_LOCK_BACKEND', None)
+    if name is None:
+        name = 'redis' if getattr(settings, 'REDIS', None) else 'local'
+    if name not in _backends:
+        if name == 'redis':
+            try:
+                _backends[name] = RedisLockBackend()
+            except redis.ConnectionError:
+                # Scripts are loaded into Redis right away, try again later
+                log.warning("Redis unavailable, using local locks",
+                            exc_info=True)
+                return get_lock_backend('local')
+        else:
+            _backends[name] = LocalLockBackend()
+    return _backends[name]
@@ -3,10 +3,12 @@ import shutil
 import unittest
 
 import mock
+import redis
 
 from django.conf import settings
 
 from readthedocs.vcs_support import utils
+from readthedocs.vcs_support.lock_backends import LocalLockBackend
 
 TEST_STATICS = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_statics')
 
@@ -29,39 +31,88 @@ class TestNonBlockingLock(unittest.TestCase):
         self.project_mock.doc_path = TEST_STATICS
         self.version_mock = mock.Mock()
         self.version_mock.slug = 'test-version-slug'
+        self.backend = LocalLockBackend(path=TEST_STATICS)
 
     def test_simplelock(self):
         with utils.NonBlockingLock(project=self.project_mock,
-                                   version=self.version_mock) as f_lock:
-            self.assertTrue(os.path.exists(f_lock.fpath))
+                                   version=self.version_mock,
+                                   backend=self.backend) as f_lock:
+            self.assertTrue(f_lock.held)
+            self.assertIsNotNone(f_lock.token)
 
     def test_simplelock_cleanup(self):
-        lock_path = None
         with utils.NonBlockingLock(project=self.project_mock,
-                                   version=self.version_mock) as f_lock:
-            lock_path = f_lock.fpath
-        self.assertTrueok_(lock_path is not None and not os.path.exists(lock_path))
+                                   version=self.version_mock,
+                                   backend=self.backend) as f_lock:
+            token = f_lock.token
+        self.assertFalse(f_lock.held)
+        self.assertEqual(self.backend.held, {})
+        with utils.NonBlockingLock(project=self.project_mock,
+                                   version=self.version_mock,
+                                   backend=self.backend) as f_lock:
+            self.assertGreater(f_lock.token, token)
 
     def test_nonreentrant(self):
         with utils.NonBlockingLock(project=self.project_mock,
-                                   version=self.version_mock) as f_lock:
+                                   version=self.version_mock,
+                                   backend=self.backend) as f_lock:
             try:
                 with utils.NonBlockingLock(project=self.project_mock,
-                                           version=self.version_mock) as f_lock:
+                                           version=self.version_mock,
+                                           backend=self.backend) as f_lock:
                     pass
             except utils.LockTimeout:
                 pass
             else:
                 raise AssertionError('Should have thrown LockTimeout')
 
-    def test_forceacquire(self):
-        with utils.NonBlockingLock(project=self.project_mock,
-                                   version=self.version_mock) as f_lock:
-            try:
-                with utils.NonBlockingLock(project=self.project_mock,
-                                           version=self.version_mock, max_lock_age=0) as f_lock:
+    def test_blocking_timeout(self):
+        with utils.Lock(project=self.project_mock, version=self.version_mock,
+                        backend=self.backend):
+            with self.assertRaises(utils.LockTimeout):
+                with utils.Lock(project=self.project_mock,
+                                version=self.version_mock, timeout=0.2,
+                                polling_interval=0.05, backend=self.backend):
                     pass
-            except utils.LockTimeout:
-                raise AssertionError('Should have thrown LockTimeout')
 
+    def test_redis_unavailable(self):
+        backend = mock.Mock()
+        backend.acquire.side_effect = redis.ConnectionError()
+        with mock.patch('readthedocs.vcs_support.utils.get_lock_backend',
+                        return_value=self.backend):
+            with utils.NonBlockingLock(project=self.project_mock,
+                                       version=self.version_mock,
+                                       backend=backend) as f_lock:
+                self.assertIs(f_lock.backend, self.backend)
+                self.assertTrue(f_lock.held)
 
+    def test_lost_lease(self):
+        backend = mock.Mock()
+        backend.leases = True
+        backend.acquire.return_value = 1
+        backend.renew.return_value = False
+        with self.assertRaises(utils.LockLost):
+            with utils.NonBlockingLock(project=self.project_mock,
+                                       version=self.version_mock,
+                                       max_lock_age=0.03,
+                                       backend=backend) as f_lock:
+                f_lock.renewer.join(1)
+                self.assertFalse(f_lock.held)
+                self.assertRaises(utils.LockLost, f_lock.fence)
+        backend.renew.assert_called_once_with(
+            'test-project-slug:test-version-slug', 1, 0.03)
+        backend.release.assert_called_once_with(
+            'test-project-slug:test-version-slug', 1, 0.03)
+
+    def test_fence(self):
+        with utils.NonBlockingLock(project=self.project_mock,
+                                   version=self.version_mock,
+                                   backend=self.backend) as f_lock:
+            f_lock.fence()
+            stale = utils.NonBlockingLock(project=self.project_mock,
+                                          version=self.version_mock,
+                                          backend=self.backend)
+            stale.token = f_lock.token - 1
+            # Writes of an earlier holder are refused once a later one wrote
+            self.assertRaises(utils.LockLost, stale.fence)
+            f_lock.fence()
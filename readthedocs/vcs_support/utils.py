@@ -1,7 +1,14 @@
+import errno
+import fcntl
 import logging
 import os
+import threading
 import time
-import stat
+
+import redis
+from django.conf import settings
+
+from readthedocs.vcs_support.lock_backends import get_lock_backend
 
 log = logging.getLogger(__name__)
 
@@ -10,88 +17,183 @@ class LockTimeout(Exception):
     pass
 
 
+class LockLost(Exception):
+    pass
+
+
+def check_fence(path, backend, token):
+    """
+    Record ``token`` as the newest token that wrote under a lock
+
+    Raises :py:exc:`LockLost` if a larger token of the same ``backend`` was
+    recorded in the fence file at ``path`` already, as the lock was acquired
+    again since by another holder.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    with open(path, 'a+') as fence_file:
+        fcntl.flock(fence_file, fcntl.LOCK_EX)
+        try:
+            fence_file.seek(0)
+            (name, _, last) = fence_file.read().strip().partition(':')
+            if name == backend and last and int(last) > token:
+                raise LockLost("Lock superseded by token %s" % last)
+            fence_file.seek(0)
+            fence_file.truncate()
+            fence_file.write('%s:%s' % (backend, token))
+            fence_file.flush()
+        finally:
+            fcntl.flock(fence_file, fcntl.LOCK_UN)
+
+
 class Lock(object):
     """
-    A simple file based lock with timeout
+    A lock on the checkout of a version, shared by all builders
+
+    On entering the context, it will wait up to ``timeout`` seconds for the
+    lock, and throw LockTimeout if it is still held. Waiters are woken up as
+    soon as the lock is released.
 
-    On entering the context, it will try to aquire the lock. If timeout passes,
-    it just gets the lock anyway.
+    The lock is held as a lease of ``lease`` seconds, which is renewed in the
+    background while the context is active, so the lock of a builder that went
+    away expires on its own. While the lock is held, ``token`` is a fencing
+    token, larger than the token of any earlier holder of the lock.
 
-    If we're in the same thread as the one holding this lock, ignore the lock.
+    Writes the lock protects call :py:meth:`fence` first, which raises
+    :py:exc:`LockLost` if the lease was lost, or another holder has written
+    under the lock since. A context that lost its lease raises
+    :py:exc:`LockLost` on exit as well, so its work isn't taken as done.
+
+    Locks are kept in Redis, see :py:mod:`readthedocs.vcs_support.lock_backends`.
+    If Redis can't be reached, locks fall back to lock files on this host.
+
+    :param project: Project being built
+    :param version: Version to build
+    :param timeout: Seconds to wait for the lock
+    :param polling_interval: Seconds between checks of a lock file
+    :param lease: Seconds the lock is held without being renewed
     """
 
-    def __init__(self, project, version, timeout=5, polling_interval=0.1):
+    def __init__(self, project, version, timeout=5, polling_interval=0.1,
+                 lease=None, backend=None):
         self.name = project.slug
-        self.fpath = os.path.join(project.doc_path, '%s__rtdlock' % version.slug)
+        self.key = '%s:%s' % (project.slug, version.slug)
+        self.project = project
+        self.version = version
         self.timeout = timeout
         self.polling_interval = polling_interval
+        if not lease:
+            lease = getattr(settings, 'REPO_LOCK_SECONDS', 30)
+        self.lease = lease
+        if backend is None:
+            backend = get_lock_backend()
+        self.backend = backend
+        self.token = None
+        self.lost = False
+        self.renewer = None
+        self.released = threading.Event()
 
     def __enter__(self):
         start = time.time()
-        while os.path.exists(self.fpath):
-            lock_age = time.time() - os.stat(self.fpath)[stat.ST_MTIME]
-            if lock_age > self.timeout:
-                log.info("Lock (%s): Force unlock, old lockfile" %
-                         self.name)
-                os.remove(self.fpath)
+        while True:
+            self.token = self.acquire()
+            if self.token is not None:
                 break
+            remaining = self.timeout - (time.time() - start)
+            if remaining <= 0:
+                raise LockTimeout("Lock (%s): Lock still active" % self.name)
             log.info("Lock (%s): Locked, waiting.." % self.name)
-            time.sleep(self.polling_interval)
-            timesince = time.time() - start
-            if timesince > self.timeout:
-                log.info("Lock (%s): Force unlock, timeout reached" %
-                         self.name)
-                os.remove(self.fpath)
-                break
-            log.info(("%s still locked after %.2f seconds; retry for %.2f"
-                      " seconds") % (self.name, timesince, self.timeout))
-        open(self.fpath, 'w').close()
-        log.info("Lock (%s): Lock aquired" % self.name)
+            self.backend.wait(self.key, min(remaining, self.lease),
+                              self.polling_interval)
+        log.info("Lock (%s): Lock acquired, token %s" % (self.name, self.token))
+        if self.backend.leases:
+            self.renewer = threading.Thread(target=self.renew)
+            self.renewer.daemon = True
+            self.renewer.start()
+        return self
 
-    def __exit__(self, exc, value, tb):
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.token is None:
+            return
+        self.released.set()
+        if self.renewer is not None:
+            self.renewer.join()
+        log.info("Lock (%s): Releasing" % self.name)
         try:
-            log.info("Lock (%s): Releasing" % self.name)
-            os.remove(self.fpath)
-        except:
+            if not self.backend.release(self.key, self.token, self.lease):
+                log.error("Lock (%s): Lock expired before it was released" %
+                          self.name)
+        except (redis.RedisError, IOError, OSError):
             log.error("Lock (%s): Failed to release, ignoring..." % self.name,
                       exc_info=True)
+        self.token = None
+        if self.lost and exc_type is None:
+            raise LockLost("Lock (%s): Lock expired while held" % self.name)
 
-
-class NonBlockingLock(object):
+    def acquire(self):
+        try:
+            return self.backend.acquire(self.key, self.lease)
+        except redis.ConnectionError:
+            log.warning("Lock (%s): Redis unavailable, using a local lock" %
+                        self.name, exc_info=True)
+            self.backend = get_lock_backend('local')
+            return self.backend.acquire(self.key, self.lease)
+
+    def renew(self):
+        '''Renew the lease until the lock is released'''
+        while not self.released.wait(self.lease / 3.0):
+            try:
+                if self.backend.renew(self.key, self.token, self.lease):
+                    continue
+            except redis.RedisError:
+                log.warning("Lock (%s): Failed to renew" % self.name,
+                            exc_info=True)
+                continue
+            log.error("Lock (%s): Lock expired while held" % self.name)
+            self.lost = True
+            return
+
+    @property
+    def held(self):
+        '''Is the lock still held by this context'''
+        return self.token is not None and not self.lost
+
+    @property
+    def fence_path(self):
+        '''The file the newest token that wrote under the lock is kept in'''
+        return os.path.join(self.project.doc_path, 'fences',
+                            '%s.fence' % self.version.slug)
+
+    def fence(self):
+        '''Check the lock is still held, before a write it protects
+
+        The token is recorded in the fence file of the lock, a holder that
+        lost its lease is refused once a later holder wrote under the lock.
+
+        :raises LockLost: if the lock isn't held anymore
+        '''
+        if not self.held:
+            raise LockLost("Lock (%s): Lock not held" % self.name)
+        check_fence(self.fence_path, self.backend.name, self.token)
+
+
+class NonBlockingLock(Lock):
     """
-    Instead of waiting for a lock, depending on the lock file age, either
-    acquire it immediately or throw LockTimeout
+    Instead of waiting for a lock, either acquire it immediately or throw
+    LockTimeout
 
     :param project: Project being built
     :param version: Version to build
-    :param max_lock_age: If file lock is older than this, forcibly acquire.
-        None means never force
+    :param max_lock_age: Seconds the lock is leased for, a lock that isn't
+        renewed for this long is given up. None means the default lease
     """
 
-    def __init__(self, project, version, max_lock_age=None):
-        self.fpath = os.path.join(project.doc_path, '%s__rtdlock' % version.slug)
-        self.max_lock_age = max_lock_age
-        self.name = project.slug
-
-    def __enter__(self):
-        path_exists = os.path.exists(self.fpath)
-        if path_exists and self.max_lock_age is not None:
-            lock_age = time.time() - os.stat(self.fpath)[stat.ST_MTIME]
-            if lock_age > self.max_lock_age:
-                log.info("Lock (%s): Force unlock, old lockfile" %
-                         self.name)
-                os.remove(self.fpath)
-            else:
-                raise LockTimeout("Lock (%s): Lock still active" % self.name)
-        elif path_exists:
-            raise LockTimeout("Lock (%s): Lock still active" % self.name)
-        open(self.fpath, 'w').close()
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        try:
-            log.info("Lock (%s): Releasing" % self.name)
-            os.remove(self.fpath)
-        except (IOError, OSError):
-            log.error("Lock (%s): Failed to release, ignoring..." % self.name,
-                      exc_info=True)
+    def __init__(self, project, version, max_lock_age=None, backend=None):
+        super(NonBlockingLock, self).__init__(project, version, timeout=0,
+                                              lease=max_lock_age,
+                                              backend=backend)